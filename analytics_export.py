@@ -0,0 +1,189 @@
+"""
+Export patients and medical_records to partitioned Parquet for offline analytics.
+
+Run from the project root:
+    python analytics_export.py [--output-dir analytics_export] [--chunk-size 50000] [--full]
+
+Rows are read in short id-range chunks from a read-only connection, so the export never
+holds the database lock for long. medical_records is partitioned by month of record_date
+(medical_records/month=YYYY-MM/part-*.parquet). The last exported id of each table is saved
+in _export_state.json, so the next run only exports rows added since. In sharded mode every
+shard is exported into the same tree (shard ids do not overlap), with its own saved ids;
+run with --full after splitting or rebalancing, as patients get new ids.
+Requires pyarrow.
+"""
+import json
+import os
+import shutil
+import time
+import traceback
+from datetime import datetime
+
+import database
+
+EXPORT_DIR = "analytics_export"
+STATE_FILE_NAME = "_export_state.json"
+
+# Column name -> Arrow type name, fixed so every chunk writes the same schema
+PATIENT_COLUMNS = [
+    ("id", "int64"),
+    ("national_id", "string"),
+    ("name", "string"),
+    ("date_of_birth", "string"),
+    ("gender", "string"),
+    ("phone", "string"),
+    ("address", "string"),
+    ("registration_date", "string"),
+]
+
+MEDICAL_RECORD_COLUMNS = [
+    ("id", "int64"),
+    ("patient_id", "int64"),
+    ("record_date", "string"),
+    ("blood_pressure", "string"),
+    ("glucose_level", "float64"),
+    ("temperature", "float64"),
+    ("notes", "string"),
+]
+
+def _require_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise RuntimeError("Parquet export requires pyarrow (pip install pyarrow)")
+    return pyarrow, pyarrow.parquet
+
+def _load_state(output_dir):
+    path = os.path.join(output_dir, STATE_FILE_NAME)
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def _save_state(output_dir, state):
+    # Write then rename, so an interrupted export never leaves a truncated state file
+    path = os.path.join(output_dir, STATE_FILE_NAME)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp_path, path)
+
+def _to_arrow(pa, columns, rows):
+    schema = pa.schema([(name, getattr(pa, type_name)()) for name, type_name in columns])
+    values = list(zip(*rows))
+    return pa.Table.from_arrays(
+        [pa.array(values[i], type=schema.field(i).type) for i in range(len(columns))],
+        schema=schema
+    )
+
+def _write_part(pq, table, directory, first_id, last_id):
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"part-{first_id:012d}-{last_id:012d}.parquet")
+    pq.write_table(table, path, compression="zstd")
+    return path
+
+def _export_table(conn, pa, pq, table_name, columns, output_dir, state, chunk_size, partition_by_month, state_key=None):
+    """Export rows of one table with id greater than the saved state, chunk by chunk"""
+    state_key = state_key or table_name
+    last_id = state.get(state_key, 0)
+    column_list = ", ".join(name for name, _ in columns)
+    rows_exported = 0
+    files_written = 0
+
+    while True:
+        rows = conn.execute(
+            f"SELECT {column_list} FROM {table_name} WHERE id > ? ORDER BY id LIMIT ?",
+            (last_id, chunk_size)
+        ).fetchall()
+        if not rows:
+            break
+
+        if partition_by_month:
+            date_index = [name for name, _ in columns].index("record_date")
+            partitions = {}
+            for row in rows:
+                month = (row[date_index] or "unknown")[:7]
+                partitions.setdefault(month, []).append(row)
+            for month, month_rows in sorted(partitions.items()):
+                directory = os.path.join(output_dir, table_name, f"month={month}")
+                _write_part(pq, _to_arrow(pa, columns, month_rows), directory, month_rows[0][0], month_rows[-1][0])
+                files_written += 1
+        else:
+            directory = os.path.join(output_dir, table_name)
+            _write_part(pq, _to_arrow(pa, columns, rows), directory, rows[0][0], rows[-1][0])
+            files_written += 1
+
+        last_id = rows[-1][0]
+        rows_exported += len(rows)
+        # Checkpoint after every chunk so an interrupted export resumes here
+        state[state_key] = last_id
+        _save_state(output_dir, state)
+
+    return {"rows": rows_exported, "files": files_written, "last_id": last_id}
+
+def _add_counts(total, result):
+    total["rows"] += result["rows"]
+    total["files"] += result["files"]
+
+def export_to_parquet(output_dir=EXPORT_DIR, chunk_size=50000, full=False, db_files=None):
+    """
+    Export patients and medical_records of db_files (default: the current database) to
+    Parquet under output_dir. Incremental by default: only rows with an id above the last
+    exported one are written. With full=True the saved state is ignored and everything is
+    exported again.
+    """
+    started = time.perf_counter()
+    try:
+        pa, pq = _require_pyarrow()
+        os.makedirs(output_dir, exist_ok=True)
+        if full:
+            # Start from a clean tree so re-exported rows are not duplicated
+            for table_name in ("patients", "medical_records"):
+                shutil.rmtree(os.path.join(output_dir, table_name), ignore_errors=True)
+            state = {}
+        else:
+            state = _load_state(output_dir)
+
+        patients = {"rows": 0, "files": 0}
+        records = {"rows": 0, "files": 0}
+        for db_file in db_files or [None]:
+            # Each shard keeps its own last ids; the single database keeps the plain table names
+            prefix = f"{os.path.basename(db_file)}:" if db_file else ""
+            with database.use_database(db_file or database.current_db_file()):
+                conn = database.connect_readonly()
+            try:
+                _add_counts(patients, _export_table(conn, pa, pq, "patients", PATIENT_COLUMNS, output_dir, state,
+                                                    chunk_size, False, prefix + "patients"))
+                _add_counts(records, _export_table(conn, pa, pq, "medical_records", MEDICAL_RECORD_COLUMNS, output_dir, state,
+                                                   chunk_size, True, prefix + "medical_records"))
+            finally:
+                conn.close()
+
+        state["exported_at"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        _save_state(output_dir, state)
+
+        return {
+            "success": True,
+            "output_dir": output_dir,
+            "patients": patients,
+            "medical_records": records,
+            "seconds": round(time.perf_counter() - started, 3),
+        }
+    except Exception as e:
+        print(f"Error exporting to Parquet: {str(e)}")
+        print(traceback.format_exc())
+        return {"success": False, "error": str(e)}
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Export the database to partitioned Parquet")
+    parser.add_argument("--output-dir", default=EXPORT_DIR)
+    parser.add_argument("--chunk-size", type=int, default=50000, help="rows read per query")
+    parser.add_argument("--full", action="store_true", help="ignore the saved state and export everything")
+    args = parser.parse_args()
+
+    import sharding
+    db_files = sharding.shard_paths() if sharding.sharding_enabled() else None
+    print(json.dumps(export_to_parquet(args.output_dir, args.chunk_size, args.full, db_files), indent=2))
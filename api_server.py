@@ -0,0 +1,498 @@
+"""
+Headless JSON API over the database layer, for integrations such as lab systems and devices.
+
+Run from the project root:
+    python api_server.py [--host 127.0.0.1] [--port 8080] [--workers 8]
+
+A plain asyncio HTTP/1.1 server (standard library only). Connections are kept alive and
+requests may be pipelined: reads from one connection are handled concurrently, writes (POST)
+wait for the requests before them and are waited for by the ones after, and the responses
+are written back in request order. Database calls are blocking, so they run in a
+bounded thread pool; file downloads are streamed in chunks instead of loaded into memory.
+
+Endpoints (JSON in and out):
+    GET  /health
+    POST /patients                                {"national_id", "name", "date_of_birth", "gender", "phone", "address"}
+    GET  /patients/{id}
+    GET  /patients/by-national-id/{national_id}
+    POST /patients/{id}/records                   {"blood_pressure", "glucose_level", "temperature", "notes"}
+    GET  /patients/{id}/records[?full_history=1]
+    GET  /patients/{id}/files
+    GET  /files/{id}/content                      file stored on disk
+    GET  /stored-files/{id}/content               file stored in the database
+    GET  /patients/{id}/chart                     full chart ZIP (chart_export.py), streamed
+
+Set MEDICAL_API_TOKEN to require an "Authorization: Bearer <token>" header. Chart downloads
+may instead carry a short-lived signed link made by chart_download_url (used by the app).
+The server listens on 127.0.0.1 by default; put it behind TLS before exposing it.
+"""
+import asyncio
+import functools
+import hashlib
+import hmac
+import json
+import os
+import re
+import time
+import traceback
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from urllib.parse import parse_qs, quote, unquote, urlencode, urlsplit
+
+import chart_export
+import database
+import sharding
+
+DEFAULT_PORT = 8080
+DEFAULT_WORKERS = 8
+MAX_HEADER_BYTES = 16 * 1024
+MAX_BODY_BYTES = 1024 * 1024
+# Requests of one connection that may be in flight before the server stops reading more
+MAX_PIPELINE_DEPTH = 16
+FILE_CHUNK_SIZE = 256 * 1024
+# Lifetime of a signed chart download link
+CHART_LINK_TTL_SECONDS = 15 * 60
+
+_CHART_PATH = re.compile(r"^/patients/(?P<patient_id>\d+)/chart$")
+
+Request = namedtuple("Request", ["method", "path", "query", "headers", "body"])
+
+class Response:
+    """Status, headers and a body that is either bytes or an async iterator of byte chunks"""
+
+    def __init__(self, status, body=b"", content_type="application/json", headers=None, length=None):
+        self.status = status
+        self.body = body
+        self.content_type = content_type
+        self.headers = headers or {}
+        self.length = len(body) if isinstance(body, bytes) else length
+
+def json_response(status, payload):
+    return Response(status, json.dumps(payload, ensure_ascii=False, default=str).encode("utf-8"))
+
+def error_response(status, message):
+    return json_response(status, {"success": False, "error": message})
+
+class _BadRequest(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+def _db():
+    """The database functions to call: routed through the shards in sharded mode"""
+    return sharding if sharding.sharding_enabled() else database
+
+def _rows_payload(rows):
+    return [row._asdict() for row in rows]
+
+def _chart_signature(token, patient_id, expires):
+    return hmac.new(token.encode("utf-8"), f"chart:{patient_id}:{expires}".encode("utf-8"), hashlib.sha256).hexdigest()
+
+def chart_download_url(base_url, patient_id, token=None, ttl_seconds=CHART_LINK_TTL_SECONDS):
+    """
+    URL of a patient's chart ZIP on the API at base_url. With a token (MEDICAL_API_TOKEN of
+    the server) the link is signed and valid for ttl_seconds, so a browser can follow it
+    without the bearer header.
+    """
+    url = f"{base_url.rstrip('/')}/patients/{int(patient_id)}/chart"
+    if not token:
+        return url
+    expires = int(time.time()) + ttl_seconds
+    return url + "?" + urlencode({"expires": expires, "signature": _chart_signature(token, int(patient_id), expires)})
+
+class ApiServer:
+    def __init__(self, max_workers=DEFAULT_WORKERS, token=None):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="api-db")
+        # Bounds the calls waiting for a worker, so a flood of requests queues here, not in the pool
+        self.slots = asyncio.Semaphore(max_workers * 4)
+        self.token = token
+        self.routes = [
+            ("GET", re.compile(r"^/health$"), self.health),
+            ("POST", re.compile(r"^/patients$"), self.add_patient),
+            ("GET", re.compile(r"^/patients/by-national-id/(?P<national_id>[^/]+)$"), self.get_patient_by_national_id),
+            ("GET", re.compile(r"^/patients/(?P<patient_id>\d+)$"), self.get_patient),
+            ("POST", re.compile(r"^/patients/(?P<patient_id>\d+)/records$"), self.add_medical_record),
+            ("GET", re.compile(r"^/patients/(?P<patient_id>\d+)/records$"), self.get_records),
+            ("GET", re.compile(r"^/patients/(?P<patient_id>\d+)/files$"), self.get_files),
+            ("GET", re.compile(r"^/files/(?P<file_id>\d+)/content$"), self.download_file),
+            ("GET", re.compile(r"^/stored-files/(?P<file_id>\d+)/content$"), self.download_stored_file),
+            ("GET", _CHART_PATH, self.download_chart),
+        ]
+
+    async def call(self, func, *args, **kwargs):
+        """Run a blocking database call in the thread pool"""
+        async with self.slots:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+    # Handlers
+
+    async def health(self, request):
+        return json_response(200, {"success": True, "status": "ok"})
+
+    async def add_patient(self, request):
+        data = self._json_body(request)
+        if not data.get("national_id") or not data.get("name"):
+            return error_response(400, "national_id and name are required")
+        result = await self.call(
+            _db().add_patient, data["national_id"], data["name"], data.get("date_of_birth"),
+            data.get("gender"), data.get("phone"), data.get("address")
+        )
+        if result["success"]:
+            return json_response(201, result)
+        return json_response(409 if "already exists" in result.get("error", "") else 400, result)
+
+    async def get_patient(self, request, patient_id):
+        result = await self.call(_db().get_patient_by_id, int(patient_id))
+        return json_response(200 if result["success"] else 404, result)
+
+    async def get_patient_by_national_id(self, request, national_id):
+        result = await self.call(_db().get_patient_by_national_id, unquote(national_id))
+        return json_response(200 if result["success"] else 404, result)
+
+    async def add_medical_record(self, request, patient_id):
+        data = self._json_body(request)
+        patient = await self.call(_db().get_patient_by_id, int(patient_id))
+        if not patient["success"]:
+            return json_response(404, patient)
+        try:
+            glucose_level = float(data["glucose_level"]) if data.get("glucose_level") is not None else None
+            temperature = float(data["temperature"]) if data.get("temperature") is not None else None
+        except (TypeError, ValueError):
+            return error_response(400, "glucose_level and temperature must be numbers")
+        result = await self.call(
+            _db().add_medical_record, int(patient_id), data.get("blood_pressure"), glucose_level, temperature, data.get("notes")
+        )
+        return json_response(201 if result["success"] else 400, result)
+
+    async def get_records(self, request, patient_id):
+        full_history = request.query.get("full_history", ["0"])[0] in ("1", "true", "yes")
+        rows = await self.call(_db().get_patient_medical_records_rows, int(patient_id), full_history)
+        return json_response(200, {"success": True, "records": _rows_payload(rows)})
+
+    async def get_files(self, request, patient_id):
+        files = await self.call(_db().get_patient_files_rows, int(patient_id))
+        stored = await self.call(_db().get_blob_files_rows, int(patient_id), True)
+        return json_response(200, {
+            "success": True,
+            "files": [dict(row._asdict(), file_path=None, content_url=f"/files/{row.id}/content") for row in files],
+            "stored_files": [dict(row._asdict(), content_url=f"/stored-files/{row.id}/content") for row in stored],
+        })
+
+    async def download_file(self, request, file_id):
+        result = await self.call(_db().get_patient_file, int(file_id))
+        if not result["success"]:
+            return json_response(404, result)
+        path = result["file"]["file_path"]
+        try:
+            size = await self.call(os.path.getsize, path)
+        except OSError:
+            return error_response(404, "File is missing from the file store")
+        return Response(200, self._stream_file(path), "application/octet-stream",
+                        self._attachment(result["file"]["file_name"]), length=size)
+
+    async def download_stored_file(self, request, file_id):
+        result = await self.call(_db().get_blob_content, int(file_id))
+        if not result or not result["success"]:
+            return error_response(404, "File not found")
+        # Stored files are small (see storage.SizePolicy); send them in chunks all the same
+        content = bytes(result["file_content"] or b"")
+        return Response(200, self._stream_bytes(content), "application/octet-stream",
+                        self._attachment(result["file_name"]), length=len(content))
+
+    async def download_chart(self, request, patient_id):
+        patient_id = int(patient_id)
+        result = await self.call(_db().get_patient_by_id, patient_id)
+        if not result["success"]:
+            return json_response(404, result)
+        if sharding.sharding_enabled():
+            chunks = sharding.stream_patient_chart_zip(patient_id)
+        else:
+            chunks = chart_export.stream_patient_chart_zip(patient_id)
+        # The size is only known at the end, so the body is sent chunked
+        return Response(200, self._stream_generator(chunks), "application/zip",
+                        self._attachment(f"patient_{patient_id}_chart.zip"))
+
+    # Helpers
+
+    def _json_body(self, request):
+        if not request.body:
+            return {}
+        try:
+            data = json.loads(request.body)
+        except ValueError:
+            raise _BadRequest(400, "Body is not valid JSON")
+        if not isinstance(data, dict):
+            raise _BadRequest(400, "Body must be a JSON object")
+        return data
+
+    def _attachment(self, file_name):
+        """Content-Disposition with an ASCII filename fallback and the UTF-8 name in filename* (RFC 6266)"""
+        file_name = file_name or "file"
+        ascii_name = re.sub(r'[^A-Za-z0-9.\- ]+', "_", file_name)
+        return {"Content-Disposition": f"attachment; filename=\"{ascii_name}\"; filename*=UTF-8''{quote(file_name, safe='')}"}
+
+    async def _stream_file(self, path):
+        f = await self.call(open, path, "rb")
+        try:
+            while True:
+                chunk = await self.call(f.read, FILE_CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            await self.call(f.close)
+
+    async def _stream_generator(self, chunks):
+        """Drive a blocking generator from one dedicated thread (it holds a SQLite connection)"""
+        thread = ThreadPoolExecutor(max_workers=1, thread_name_prefix="api-stream")
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                chunk = await loop.run_in_executor(thread, next, chunks, None)
+                if chunk is None:
+                    break
+                yield chunk
+        finally:
+            await loop.run_in_executor(thread, chunks.close)
+            thread.shutdown(wait=False)
+
+    async def _stream_bytes(self, content):
+        for start in range(0, len(content), FILE_CHUNK_SIZE):
+            yield content[start:start + FILE_CHUNK_SIZE]
+
+    def _authorized(self, request):
+        if not self.token:
+            return True
+        supplied = request.headers.get("authorization", "")
+        if hmac.compare_digest(supplied.encode("utf-8"), f"Bearer {self.token}".encode("utf-8")):
+            return True
+        return self._signed_chart_link(request)
+
+    def _signed_chart_link(self, request):
+        """A GET of a chart with a valid, unexpired signature from chart_download_url"""
+        match = _CHART_PATH.match(request.path)
+        if request.method != "GET" or not match:
+            return False
+        try:
+            expires = int(request.query.get("expires", ["0"])[0])
+        except ValueError:
+            return False
+        signature = request.query.get("signature", [""])[0]
+        expected = _chart_signature(self.token, int(match.group("patient_id")), expires)
+        return expires >= time.time() and hmac.compare_digest(signature.encode("utf-8"), expected.encode("utf-8"))
+
+    async def dispatch(self, request):
+        """Route a request to its handler and turn failures into JSON errors"""
+        try:
+            if not self._authorized(request):
+                return error_response(401, "Missing or invalid token")
+            path_matched = False
+            for method, pattern, handler in self.routes:
+                match = pattern.match(request.path)
+                if match:
+                    path_matched = True
+                    if method == request.method:
+                        return await handler(request, **match.groupdict())
+            if path_matched:
+                return error_response(405, "Method not allowed")
+            return error_response(404, "Not found")
+        except _BadRequest as e:
+            return error_response(e.status, str(e))
+        except sharding.ShardLookupError as e:
+            return error_response(404, str(e))
+        except Exception as e:
+            print(f"Error handling {request.method} {request.path}: {str(e)}")
+            print(traceback.format_exc())
+            return error_response(500, "Internal server error")
+
+    # HTTP/1.1 connection handling
+
+    async def _read_request(self, reader):
+        """Read one request; None when the client closed the connection between requests"""
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+        except asyncio.IncompleteReadError as e:
+            if not e.partial.strip():
+                return None
+            raise _BadRequest(400, "Incomplete request")
+        except asyncio.LimitOverrunError:
+            raise _BadRequest(431, "Request headers too large")
+
+        lines = head.decode("latin-1").split("\r\n")
+        try:
+            method, target, version = lines[0].split(" ")
+        except ValueError:
+            raise _BadRequest(400, "Malformed request line")
+        headers = {}
+        for line in lines[1:]:
+            if line:
+                name, _, value = line.partition(":")
+                headers[name.strip().lower()] = value.strip()
+        if version == "HTTP/1.0" and headers.get("connection", "").lower() != "keep-alive":
+            headers.setdefault("connection", "close")
+
+        if "chunked" in headers.get("transfer-encoding", "").lower():
+            raise _BadRequest(411, "Send a Content-Length instead of a chunked body")
+        try:
+            length = int(headers.get("content-length", "0"))
+        except ValueError:
+            raise _BadRequest(400, "Invalid Content-Length")
+        if length > MAX_BODY_BYTES:
+            raise _BadRequest(413, "Request body too large")
+        body = await reader.readexactly(length) if length else b""
+
+        url = urlsplit(target)
+        return Request(method.upper(), url.path, parse_qs(url.query), headers, body)
+
+    def _response_head(self, response, keep_alive):
+        reason = HTTPStatus(response.status).phrase
+        headers = {"Content-Type": response.content_type}
+        if response.length is None:
+            headers["Transfer-Encoding"] = "chunked"
+        else:
+            headers["Content-Length"] = str(response.length)
+        headers["Connection"] = "keep-alive" if keep_alive else "close"
+        headers.update(response.headers)
+        head = f"HTTP/1.1 {response.status} {reason}\r\n" + "".join(f"{name}: {value}\r\n" for name, value in headers.items())
+        return head.encode("latin-1") + b"\r\n"
+
+    async def _write_response(self, writer, head, response):
+        writer.write(head)
+        if isinstance(response.body, bytes):
+            writer.write(response.body)
+        else:
+            try:
+                async for chunk in response.body:
+                    if response.length is None:
+                        if not chunk:
+                            continue
+                        chunk = b"%x\r\n%s\r\n" % (len(chunk), chunk)
+                    writer.write(chunk)
+                    # Wait for the socket to drain, so a slow client does not buffer the whole file
+                    await writer.drain()
+            finally:
+                # Closes the file right away if the client went away mid-download
+                await response.body.aclose()
+            if response.length is None:
+                writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+    async def _respond_in_order(self, queue, writer):
+        """
+        Write responses in request order. A response that fails before anything was sent is
+        replaced by a 500; after a failure mid-response (or a write error) the connection is
+        closed and what is left is cancelled.
+        """
+        broken = False
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            task, keep_alive = item
+            if broken:
+                task.cancel()
+                continue
+            try:
+                response = await task
+                try:
+                    head = self._response_head(response, keep_alive)
+                except Exception as e:
+                    print(f"Error encoding response headers: {str(e)}")
+                    print(traceback.format_exc())
+                    if not isinstance(response.body, bytes):
+                        await response.body.aclose()
+                    response = error_response(500, "Internal server error")
+                    head = self._response_head(response, keep_alive)
+                await self._write_response(writer, head, response)
+                if not keep_alive:
+                    broken = True
+            except (ConnectionError, asyncio.CancelledError):
+                broken = True
+            except Exception as e:
+                print(f"Error writing response: {str(e)}")
+                print(traceback.format_exc())
+                broken = True
+            if broken:
+                # Also ends the read loop, which would otherwise wait for a request that never comes
+                writer.close()
+
+    async def _dispatch_after(self, request, earlier):
+        if earlier:
+            await asyncio.wait(earlier)
+        return await self.dispatch(request)
+
+    async def handle_connection(self, reader, writer):
+        queue = asyncio.Queue(MAX_PIPELINE_DEPTH)
+        responder = asyncio.create_task(self._respond_in_order(queue, writer))
+        in_flight = []
+        last_write = None
+        try:
+            while not responder.done():
+                try:
+                    request = await self._read_request(reader)
+                except _BadRequest as e:
+                    await queue.put((asyncio.ensure_future(asyncio.sleep(0, error_response(e.status, str(e)))), False))
+                    break
+                if request is None:
+                    break
+                keep_alive = request.headers.get("connection", "").lower() != "close"
+                in_flight = [task for task in in_flight if not task.done()]
+                if request.method in ("GET", "HEAD"):
+                    earlier = [last_write] if last_write is not None and not last_write.done() else []
+                else:
+                    # A write must see (and be seen by) the requests pipelined around it
+                    earlier = list(in_flight)
+                # Start handling now; the responder writes it once the earlier responses are out
+                task = asyncio.create_task(self._dispatch_after(request, earlier))
+                in_flight.append(task)
+                if request.method not in ("GET", "HEAD"):
+                    last_write = task
+                await queue.put((task, keep_alive))
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            await queue.put(None)
+            try:
+                await responder
+            except Exception as e:
+                print(f"Error responding: {str(e)}")
+                print(traceback.format_exc())
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+async def serve(host="127.0.0.1", port=DEFAULT_PORT, max_workers=DEFAULT_WORKERS, token=None, ready=None):
+    """Start the API and serve until cancelled; `ready` (an asyncio.Event or None) is set once listening"""
+    if sharding.sharding_enabled():
+        sharding.init_shards_once()
+    else:
+        database.init_db_once()
+    api = ApiServer(max_workers, token)
+    server = await asyncio.start_server(api.handle_connection, host, port, limit=MAX_HEADER_BYTES)
+    print(f"Medical records API listening on http://{host}:{port}")
+    if ready is not None:
+        ready.set()
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        api.executor.shutdown(wait=False)
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Serve the medical records database as a JSON API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="threads for database calls")
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(serve(args.host, args.port, args.workers, os.environ.get("MEDICAL_API_TOKEN")))
+    except KeyboardInterrupt:
+        pass
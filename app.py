@@ -1,22 +1,50 @@
 import streamlit as st
-import pandas as pd
 import os
 import base64
+import tempfile
+import time
 import traceback
+import weakref
 from datetime import datetime
 from datetime import date
 import sqlite3
+from profiling import timed
+import query_log
 from database import (
-    init_db, add_patient, get_patient_by_national_id, get_all_patients,
+    init_db_once, add_patient, get_patient_by_national_id, get_patients_page_rows, count_patients,
     add_medical_record, get_patient_medical_records, get_patient_files,
-    save_patient_file, debug_database, save_patient_file_debug, get_patient_files_debug
+    save_patient_file, debug_database, save_patient_file_debug, get_patient_files_debug,
+    get_patient_medical_records_rows, get_blob_files_rows, get_blob_content, get_statistics,
+    save_patient_files_batch, use_database, changes_since, change_log_bounds, DB_FILE, read_only_mode
 )
+from document_index import search_documents, start_background_indexing, upload_keys
+from chart_export import stream_patient_chart_zip
+from vitals_screening import get_patient_alerts
+from sharding import sharding_enabled, init_shards_once, shard_paths
+if sharding_enabled():
+    # Sharded mode: the same functions, routed to the shard that owns each patient
+    from sharding import (
+        add_patient, get_patient_by_national_id, get_patients_page_rows, count_patients,
+        add_medical_record, get_patient_medical_records, get_patient_files,
+        save_patient_file, save_patient_file_debug, get_patient_files_debug,
+        get_patient_medical_records_rows, get_blob_files_rows, get_blob_content, get_statistics,
+        save_patient_files_batch, stream_patient_chart_zip,
+        search_documents, start_background_indexing,
+        get_patient_alerts
+    )
+from patient_directory import search_patients
+
 
-# Database file path
-DB_FILE = "medical_records.db"
+# Initialize the database (only the first run in this process does any work, including
+# starting the background optimize / incremental vacuum / WAL checkpoint scheduler)
+with timed("init_db"):
+    if sharding_enabled():
+        init_shards_once(start_maintenance=True)
+    else:
+        init_db_once(start_maintenance=True)
 
-# Initialize the database
-init_db()
+# Database files this app writes to (one per shard in sharded mode)
+DB_FILES = shard_paths() if sharding_enabled() else [DB_FILE]
 
 # Session state for authentication
 if 'authenticated' not in st.session_state:
@@ -47,9 +75,13 @@ def main_app():
     st.title("Medical Records Management System")
     
     # Sidebar menu
+    menu_items = ["Home", "Add Patient", "Search Patient", "View All Patients", "File Upload Test", "Debug"]
+    if read_only_mode():
+        st.sidebar.info(f"Read-only snapshot: {DB_FILE}")
+        menu_items = [item for item in menu_items if item not in ("Add Patient", "File Upload Test")]
     menu = st.sidebar.selectbox(
         "Menu", 
-        ["Home", "Add Patient", "Search Patient", "View All Patients", "File Upload Test", "Debug"]
+        menu_items
     )
     
     # Add logout button
@@ -77,39 +109,37 @@ def file_upload_test_page():
     current_dir = os.getcwd()
     st.write(f"Current Directory: {current_dir}")
    
-    # Upload file
-    uploaded_file = st.file_uploader("Choose a file to upload", type=["jpg", "jpeg", "png", "pdf", "txt", "doc", "docx"])
+    # Upload files
+    uploaded_files = st.file_uploader("Choose files to upload", type=["jpg", "jpeg", "png", "pdf", "txt", "doc", "docx"],
+                                      accept_multiple_files=True)
    
-    if uploaded_file is not None:
+    if uploaded_files:
         st.write("File details:")
-        st.json({
-            "Name": uploaded_file.name,
-            "Type": uploaded_file.type,
-            "Size": uploaded_file.size
-        })
+        st.json([
+            {"Name": uploaded_file.name, "Type": uploaded_file.type, "Size": uploaded_file.size}
+            for uploaded_file in uploaded_files
+        ])
         
         # Show preview for images
-        if uploaded_file.type.startswith('image'):
-            st.image(uploaded_file, width=200, caption="Preview")
+        for uploaded_file in uploaded_files:
+            if uploaded_file.type.startswith('image'):
+                st.image(uploaded_file, width=200, caption=uploaded_file.name)
        
        
         # Save file button
-        if st.button("Save File to Database"):
+        if st.button("Save Files to Database"):
             try:
-                # Use the debug version of save_patient_file
-                result = save_patient_file_debug(1, uploaded_file)  # Using patient_id=1 for testing
+                result = save_patient_files_batch(1, uploaded_files)  # Using patient_id=1 for testing
                 
                 if result["success"]:
-                    st.success(f"File saved successfully to database! ID: {result.get('file_id', '')}")
-                    
-                    # Show image if it's an image
-                    if uploaded_file.type.startswith('image'):
-                        st.image(uploaded_file, width=300, caption="Uploaded image")
+                    st.success(f"{result['files']} file(s) saved successfully to database! File IDs: {result['file_ids']}, stored file IDs: {result['blob_file_ids']}")
+                    st.write(f"{result['bytes'] / (1024 * 1024):.2f} MB in {result['seconds']} s ({result['mb_per_sec']} MB/s)")
+                    start_background_indexing(keys=upload_keys(result))
                 else:
-                    st.error(f"Failed to save file: {result.get('error', 'Unknown error')}")
+                    st.error(f"Failed to save files: {result.get('error', 'Unknown error')}")
            
             except Exception as e:
-                st.error(f"Error while saving file: {str(e)}")
+                st.error(f"Error while saving files: {str(e)}")
                 st.code(traceback.format_exc())
 
 def home_page():
@@ -124,18 +154,18 @@ def home_page():
     
     with col1:
         try:
-            patients_df = get_all_patients()
-            st.metric(label="Total Patients", value=len(patients_df))
+            stats = get_statistics()
+            st.metric(label="Total Patients", value=stats["patients"])
         except Exception as e:
             st.error(f"Error loading statistics: {str(e)}")
             st.metric(label="Total Patients", value="Error")
     
-    # Display last 5 added patients
-    st.subheader("Recently Added Patients")
+    # Display the first 5 patients (one page query instead of loading every patient)
+    st.subheader("Patients")
     try:
-        patients_df = get_all_patients()
-        if not patients_df.empty:
-            st.dataframe(patients_df.head(5))
+        patient_rows = get_patients_page_rows(0, 5)
+        if patient_rows:
+            st.dataframe([row._asdict() for row in patient_rows])
         else:
             st.info("No patients registered yet.")
     except Exception as e:
@@ -165,6 +195,12 @@ def add_patient_page():
                     
                     if result["success"]:
                         st.success(f"Patient {name} added successfully!")
+                        if result.get("possible_duplicates"):
+                            st.warning("This patient may already be registered under another national ID:")
+                            st.dataframe([
+                                dict(duplicate, reasons=", ".join(duplicate["reasons"]))
+                                for duplicate in result["possible_duplicates"]
+                            ])
                         st.session_state.current_patient_id = result["patient_id"]
                         # Store the national ID in session state for later use
                         st.session_state.last_added_national_id = national_id
@@ -242,7 +278,7 @@ def search_patient_page():
         st.write(f"**Address:** {patient['address'] if patient['address'] else 'Not provided'}")
         
         # علامات تبويب للسجلات الطبية والملفات
-        tab1, tab2, tab3 = st.tabs(["Medical Records", "Files", "Add New Data"])
+        tab1, tab2, tab3, tab4 = st.tabs(["Medical Records", "Files", "Add New Data", "Export Chart"])
         
         with tab1:
             display_medical_records(patient["id"])
@@ -252,27 +288,114 @@ def search_patient_page():
         
         with tab3:
             add_patient_data_improved(patient["id"])
+        
+        with tab4:
+            export_patient_chart_tab(patient["id"])
+
+# Base URL of api_server.py as the browser reaches it; when set, charts are streamed from there
+CHART_API_URL = os.environ.get("MEDICAL_API_URL")
+# Charts up to this size are offered by the app itself (Streamlit holds a download in memory)
+CHART_INLINE_MAX_BYTES = 50 * 1024 * 1024
+
+class _ChartExport:
+    """A chart ZIP in a private temp file, deleted after download or with the session"""
+
+    def __init__(self, path):
+        self.path = path
+        self._finalizer = weakref.finalize(self, _remove_file, path)
+
+    def remove(self):
+        self._finalizer()
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+def _discard_chart_export(export_key):
+    export = st.session_state.pop(export_key, None)
+    if export is not None:
+        export.remove()
+
+def export_patient_chart_tab(patient_id):
+    """تصدير ملف المريض الكامل كملف ZIP"""
+    st.subheader("Export Full Chart")
+    st.write("Builds a ZIP with the patient's details, all medical records (CSV and JSON) and every stored file.")
+    
+    if CHART_API_URL:
+        # يُبث الملف مباشرة من واجهة API دون تحميله في ذاكرة التطبيق
+        from api_server import chart_download_url
+        st.link_button("Download Chart ZIP", chart_download_url(CHART_API_URL, patient_id, os.environ.get("MEDICAL_API_TOKEN")))
+        return
+    
+    export_key = f"chart_export_{patient_id}"
+    if st.button("Prepare Chart Export", key=f"prepare_export_{patient_id}"):
+        _discard_chart_export(export_key)
+        # ملف مؤقت خاص بهذه الجلسة (صلاحيات 0600) يُكتب قطعة بقطعة
+        fd, export_path = tempfile.mkstemp(prefix="chart_", suffix=".zip")
+        export = _ChartExport(export_path)
+        try:
+            written = 0
+            with st.spinner("Building chart export..."):
+                with os.fdopen(fd, "wb") as f:
+                    for chunk in stream_patient_chart_zip(patient_id):
+                        f.write(chunk)
+                        written += len(chunk)
+            if written > CHART_INLINE_MAX_BYTES:
+                export.remove()
+                st.warning(
+                    f"The chart is {written / (1024 * 1024):.0f} MB, too large to download here. Set MEDICAL_API_URL "
+                    f"to stream it from api_server.py, or run: python chart_export.py {patient_id}"
+                )
+            else:
+                st.session_state[export_key] = export
+                st.success(f"Chart export ready ({written / (1024 * 1024):.2f} MB)")
+        except Exception as e:
+            export.remove()
+            st.error(f"Error exporting chart: {str(e)}")
+            st.error(traceback.format_exc())
+    
+    export = st.session_state.get(export_key)
+    if export is not None and os.path.exists(export.path):
+        with open(export.path, "rb") as f:
+            st.download_button(
+                label="Download Chart ZIP",
+                data=f,
+                file_name=f"patient_{patient_id}_chart.zip",
+                mime="application/zip",
+                key=f"download_export_{patient_id}",
+                on_click=_discard_chart_export,
+                args=(export_key,)
+            )
 
 def display_medical_records(patient_id):
     st.subheader("Medical Records")
     
     try:
-        records_df = get_patient_medical_records(patient_id)
+        # تنبيهات فحص العلامات الحيوية
+        alerts = get_patient_alerts(patient_id)
+        if alerts:
+            st.warning(f"{len(alerts)} vitals alert(s) from screening")
+            st.dataframe(alerts)
+        
+        full_history = st.checkbox("Include archived history", key=f"full_history_{patient_id}")
+        records = get_patient_medical_records_rows(patient_id, full_history=full_history)
         
-        if not records_df.empty:
+        if records:
             # Add a column for showing detailed view
-            for i, record in records_df.iterrows():
-                st.write(f"**Date:** {record['record_date']}")
+            for record in records:
+                st.write(f"**Date:** {record.record_date}")
                 
                 col1, col2, col3 = st.columns(3)
                 with col1:
-                    st.write(f"Blood Pressure: {record['blood_pressure'] if record['blood_pressure'] else 'Not recorded'}")
+                    st.write(f"Blood Pressure: {record.blood_pressure if record.blood_pressure else 'Not recorded'}")
                 with col2:
-                    st.write(f"Glucose: {record['glucose_level'] if not pd.isna(record['glucose_level']) else 'Not recorded'} mg/dL")
+                    st.write(f"Glucose: {record.glucose_level if record.glucose_level is not None else 'Not recorded'} mg/dL")
                 with col3:
-                    st.write(f"Temperature: {record['temperature'] if not pd.isna(record['temperature']) else 'Not recorded'} °C")
+                    st.write(f"Temperature: {record.temperature if record.temperature is not None else 'Not recorded'} °C")
                 
-                st.write(f"Notes: {record['notes'] if record['notes'] else 'No notes'}")
+                st.write(f"Notes: {record.notes if record.notes else 'No notes'}")
                 st.divider()
         else:
             st.info("No medical records found for this patient.")
@@ -328,6 +451,38 @@ def display_patient_files_improved(patient_id):
                         st.error(f"File not found at: {file_path}")
         else:
             st.info("No files found for this patient.")
+        
+        # البحث داخل محتوى الملفات
+        document_query = st.text_input("Search inside documents", key=f"document_search_{patient_id}")
+        if document_query:
+            hits = search_documents(document_query, patient_id=patient_id)
+            if hits:
+                for hit in hits:
+                    st.markdown(f"**{hit.file_name}** (ID: {hit.file_id}) — {hit.snippet}")
+            else:
+                st.info("No documents match this search.")
+        
+        # الملفات المخزنة داخل قاعدة البيانات (BLOB)
+        blob_files = get_blob_files_rows(patient_id, full_history=True)
+        if blob_files:
+            st.write(f"**Files stored in the database:** {len(blob_files)}")
+            st.dataframe([blob._asdict() for blob in blob_files])
+            
+            blob_options = {f"{blob.file_name} (ID: {blob.id})": blob.id for blob in blob_files}
+            selected_blob = st.selectbox("Select a stored file to download", options=list(blob_options), key=f"blob_select_{patient_id}")
+            
+            if selected_blob:
+                blob_result = get_blob_content(blob_options[selected_blob])
+                if blob_result["success"]:
+                    st.download_button(
+                        label=f"Download {blob_result['file_name']}",
+                        data=bytes(blob_result["file_content"]),
+                        file_name=blob_result["file_name"],
+                        mime="application/octet-stream",
+                        key=f"blob_download_{patient_id}"
+                    )
+                else:
+                    st.error(blob_result["error"])
     except Exception as e:
         st.error(f"Error displaying patient files: {str(e)}")
         st.error(traceback.format_exc())
@@ -375,59 +530,72 @@ def add_patient_data_improved(patient_id):
         
         
         # تعامل خاص مع أداة رفع الملفات خارج النموذج
-        uploaded_file = st.file_uploader("Choose a file to upload", 
+        uploaded_files = st.file_uploader("Choose files to upload", 
                                         type=["jpg", "jpeg", "png", "pdf", "doc", "docx", "txt"], 
+                                        accept_multiple_files=True,
                                         key=f"file_upload_{patient_id}")
         
-        # عرض معاينة الملف إذا تم تحديده
-        if uploaded_file is not None:
+        # عرض معاينة الملفات إذا تم تحديدها
+        if uploaded_files:
             st.write("File details:")
-            st.json({
-                "Name": uploaded_file.name,
-                "Type": uploaded_file.type,
-                "Size": uploaded_file.size
-            })
+            st.json([
+                {"Name": uploaded_file.name, "Type": uploaded_file.type, "Size": uploaded_file.size}
+                for uploaded_file in uploaded_files
+            ])
             
             # عرض معاينة للصور
-            if uploaded_file.type.startswith('image'):
-                st.image(uploaded_file, width=200, caption="Preview")
+            for uploaded_file in uploaded_files:
+                if uploaded_file.type.startswith('image'):
+                    st.image(uploaded_file, width=200, caption=uploaded_file.name)
             
-            # زر منفصل خارج النموذج لرفع الملف
-            if st.button("Save Selected File", key=f"upload_button_{patient_id}"):
+            # زر منفصل خارج النموذج لرفع الملفات
+            if st.button("Save Selected Files", key=f"upload_button_{patient_id}"):
                 try:
-                    # استخدام وظيفة التصحيح لحفظ الملف
-                    result = save_patient_file_debug(patient_id, uploaded_file)
+                    # حفظ كل الملفات دفعة واحدة (كلها أو لا شيء)
+                    result = save_patient_files_batch(patient_id, uploaded_files)
                     
                     if result["success"]:
-                        st.success(f"File uploaded successfully! ID: {result.get('file_id', 'N/A')}")
-                        st.write(f"File path: {result.get('file_path', 'N/A')}")
-                        
-                        # عرض الصورة إذا كانت ملف صورة
-                        if uploaded_file.type.startswith('image'):
-                            st.image(result.get('file_path'), caption="Uploaded image")
+                        st.success(f"{result['files']} file(s) uploaded successfully! File IDs: {result['file_ids']}, stored file IDs: {result['blob_file_ids']}")
+                        st.write(f"{result['bytes'] / (1024 * 1024):.2f} MB in {result['seconds']} s ({result['mb_per_sec']} MB/s)")
+                        # استخراج نص الملفات الجديدة للبحث في الخلفية
+                        start_background_indexing(keys=upload_keys(result))
                     else:
-                        st.error(f"Failed to save file: {result.get('error', 'Unknown error')}")
+                        st.error(f"Failed to save files: {result.get('error', 'Unknown error')}")
                 except Exception as e:
-                    st.error(f"Error while saving file: {str(e)}")
+                    st.error(f"Error while saving files: {str(e)}")
                     st.error(traceback.format_exc())
 
 def view_all_patients_page():
     st.header("All Patients")
     
     try:
-        patients_df = get_all_patients()
+        total = count_patients()
         
-        if not patients_df.empty:
-            st.dataframe(patients_df)
+        if total:
+            # Only the rows of the current page are read and rendered
+            col1, col2 = st.columns(2)
+            with col1:
+                page_size = st.selectbox("Patients per page", [25, 50, 100, 200], index=1)
+            page_count = (total + page_size - 1) // page_size
+            with col2:
+                page = st.number_input(f"Page (of {page_count})", min_value=1, max_value=page_count, value=1)
+            rows = get_patients_page_rows((int(page) - 1) * page_size, page_size)
+            st.dataframe([row._asdict() for row in rows])
+            st.caption(f"{total} patients")
             
-            # Allow searching for a specific patient from the list
+            # Autocomplete from the in-memory patient directory
+            query = st.text_input("Find patient (name or national ID)", key="patient_directory_query")
+            matches = search_patients(query, limit=20, db_files=DB_FILES)
+            entries = {entry.national_id: entry for entry in matches}
+            if query and not entries:
+                st.info("No patient matches this search.")
             selected_patient = st.selectbox(
                 "Select patient to view details",
-                options=patients_df["national_id"].tolist(),
-                format_func=lambda x: f"{patients_df[patients_df['national_id'] == x]['name'].values[0]} ({x})"
+                options=list(entries),
+                format_func=lambda x: f"{entries[x].name} ({x})"
             )
             
-            if st.button("View Selected Patient"):
+            if selected_patient and st.button("View Selected Patient"):
                 result = get_patient_by_national_id(selected_patient)
                 if result["success"]:
                     st.session_state.current_patient_id = result["patient"]["id"]
@@ -440,6 +608,22 @@ def view_all_patients_page():
         st.error(traceback.format_exc())
 
 def debug_app_page():
+    # Maintenance tools are only needed here, so they are not imported on every page
+    from integrity import verify_file_store
+    from profiling import get_timings, reset_timings, import_time_profile, PROCESS_START
+    from archive import archive_old_records, list_archives, DEFAULT_MAX_AGE_DAYS
+    from storage import SizePolicy, apply_policy, DEFAULT_BLOB_MAX_BYTES
+    from vitals_screening import run_screening, get_flagged_patients
+    from backup import run_backup, get_last_backup, DEFAULT_BACKUP_DIR
+    from duplicate_patients import find_duplicates, get_duplicate_candidates, dismiss_candidate
+    from maintenance import (
+        run_maintenance, convert_database, database_stats, get_maintenance_history, DEFAULT_BUDGET_SECONDS
+    )
+    if sharding_enabled():
+        from sharding import index_documents, get_index_status
+    else:
+        from document_index import index_documents, get_index_status
+    
     st.title("Debug Page")
     
     st.write("Use this page to debug application and database status")
@@ -455,6 +639,317 @@ def debug_app_page():
             st.error(f"Error checking database: {str(e)}")
             st.code(traceback.format_exc())
     
+    # File store integrity
+    st.subheader("File Store Integrity")
+    col1, col2 = st.columns(2)
+    with col1:
+        verify_workers = st.number_input("Checker threads", min_value=1, max_value=64, value=8)
+    with col2:
+        verify_full = st.checkbox("Full re-hash (ignore checkpoint)")
+    
+    if st.button("Verify File Store"):
+        try:
+            with st.spinner("Verifying files..."):
+                report = verify_file_store(max_workers=int(verify_workers), full=verify_full, db_files=DB_FILES)
+            st.success(f"Checked {report['files_checked']} file(s) in {report['duration_seconds']} s")
+            st.json(report["counts"])
+            if report["missing"]:
+                st.error("Rows whose file is missing:")
+                st.dataframe(report["missing"])
+            if report["changed"]:
+                st.warning("Files whose content changed since the last pass:")
+                st.dataframe(report["changed"])
+            if report["orphaned"]:
+                st.warning("Files on disk with no database row:")
+                st.dataframe({"file_path": report["orphaned"]})
+            if report["errors"]:
+                st.error("Files that could not be read:")
+                st.dataframe(report["errors"])
+        except Exception as e:
+            st.error(f"Error verifying file store: {str(e)}")
+            st.code(traceback.format_exc())
+    
+    # Storage backends
+    st.subheader("Storage Backends")
+    st.write("Files up to the threshold are kept as BLOBs in the database, larger files on disk.")
+    col1, col2 = st.columns(2)
+    with col1:
+        blob_max_kb = st.number_input("BLOB size threshold (KB)", min_value=0, value=DEFAULT_BLOB_MAX_BYTES // 1024)
+    with col2:
+        max_mb_per_sec = st.number_input("Throttle (MB/s, 0 = unlimited)", min_value=0.0, value=0.0)
+    
+    if st.button("Migrate Files to Policy", disabled=read_only_mode()):
+        try:
+            rate = int(max_mb_per_sec * 1024 * 1024) if max_mb_per_sec > 0 else None
+            reports = []
+            for db_file in DB_FILES:
+                with use_database(db_file), st.spinner(f"Migrating files in {db_file}..."):
+                    reports.extend((db_file, report) for report in apply_policy(SizePolicy(int(blob_max_kb) * 1024), max_bytes_per_sec=rate))
+            for db_file, report in reports:
+                if report["success"]:
+                    st.success(
+                        f"{db_file}, {report['migration']}: moved {report['files_moved']} file(s), "
+                        f"{report['bytes_moved'] / (1024 * 1024):.2f} MB at "
+                        f"{report['bytes_per_sec'] / (1024 * 1024):.2f} MB/s"
+                    )
+                    if report["errors"]:
+                        st.dataframe(report["errors"])
+                else:
+                    st.error(f"{db_file}: migration failed: {report['error']}")
+        except Exception as e:
+            st.error(f"Error migrating files: {str(e)}")
+            st.code(traceback.format_exc())
+    
+    # Document text index
+    st.subheader("Document Search Index")
+    index_status = get_index_status()
+    st.write(f"Indexed files: {index_status['files']} ({index_status['failed']} failed, {index_status['chars']} characters)")
+    col1, col2 = st.columns(2)
+    with col1:
+        index_workers = st.number_input("Extraction processes", min_value=1, max_value=32, value=4)
+    with col2:
+        index_full = st.checkbox("Re-extract all files")
+    
+    if st.button("Index Documents", disabled=read_only_mode()):
+        try:
+            with st.spinner("Extracting text..."):
+                result = index_documents(max_workers=int(index_workers), full=index_full)
+            if result["success"]:
+                st.success(f"Processed {result['files_processed']} file(s), indexed {result['files_indexed']}")
+                if result["errors"]:
+                    st.warning("Files whose text could not be extracted:")
+                    st.dataframe(result["errors"])
+            else:
+                st.error(f"Indexing failed: {result['error']}")
+        except Exception as e:
+            st.error(f"Error indexing documents: {str(e)}")
+            st.code(traceback.format_exc())
+    
+    # Hot/cold archiving
+    st.subheader("Archive Old Records")
+    for db_file in DB_FILES:
+        archives = list_archives(db_file)
+        st.write(f"Archive files of {db_file}: {', '.join(str(year) for year, _ in archives) if archives else 'none'}")
+    max_age_days = st.number_input("Archive records older than (days)", min_value=1, value=DEFAULT_MAX_AGE_DAYS)
+    
+    if st.button("Archive Old Records", disabled=read_only_mode()):
+        for db_file in DB_FILES:
+            try:
+                with use_database(db_file), st.spinner(f"Archiving {db_file}..."):
+                    result = archive_old_records(int(max_age_days))
+                if result["success"]:
+                    st.success(
+                        f"{db_file}: moved {result['records_moved']} record(s) and {result['blobs_moved']} stored file(s) "
+                        f"older than {result['cutoff']} in {result['seconds']} s"
+                    )
+                    st.json(result)
+                else:
+                    st.error(f"{db_file}: archiving failed: {result['error']}")
+            except Exception as e:
+                st.error(f"Error archiving records: {str(e)}")
+                st.code(traceback.format_exc())
+    
+    # Database maintenance
+    st.subheader("Database Maintenance")
+    st.write("Refreshes query statistics, returns free pages to the file system and checkpoints the WAL. "
+             "It also runs automatically in the background.")
+    maintenance_budget = st.number_input("Time budget per database (seconds)", min_value=1, value=DEFAULT_BUDGET_SECONDS)
+    
+    col1, col2 = st.columns(2)
+    with col1:
+        run_clicked = st.button("Run Maintenance", disabled=read_only_mode())
+    with col2:
+        convert_clicked = st.button("Convert to Incremental Vacuum + WAL", disabled=read_only_mode())
+    
+    for db_file in DB_FILES:
+        with use_database(db_file):
+            try:
+                if convert_clicked:
+                    with st.spinner(f"Rewriting {db_file}..."):
+                        result = convert_database()
+                    if result["success"]:
+                        st.success(f"{db_file}: converted in {result['seconds']} s")
+                    else:
+                        st.error(f"{db_file}: conversion failed: {result['error']}")
+                if run_clicked:
+                    with st.spinner(f"Maintaining {db_file}..."):
+                        result = run_maintenance(int(maintenance_budget))
+                    if not result["success"]:
+                        st.error(f"{db_file}: maintenance failed: {result['error']}")
+                
+                history = get_maintenance_history(limit=1)
+                if history and history[0]["success"]:
+                    last_run = history[0]
+                    st.write(f"**{db_file}** — last run {last_run['started_at']} ({last_run['seconds']} s)")
+                    st.dataframe([
+                        dict({"when": "before"}, **last_run["before"]),
+                        dict({"when": "after"}, **last_run["after"]),
+                    ])
+                    st.dataframe(last_run["steps"])
+                else:
+                    st.write(f"**{db_file}** — no maintenance run yet")
+                    st.dataframe([database_stats()])
+            except Exception as e:
+                st.error(f"Error in database maintenance: {str(e)}")
+                st.code(traceback.format_exc())
+    
+    # Change data capture
+    st.subheader("Change Log")
+    for db_file in DB_FILES:
+        with use_database(db_file):
+            try:
+                bounds = change_log_bounds()
+                st.write(
+                    f"**{db_file}** — {bounds['entries']} change(s), seq {bounds['first_seq']}..{bounds['last_seq']}"
+                    f" (compacted through {bounds['truncated_through']})"
+                )
+                recent = changes_since(max(bounds["last_seq"] - 20, 0), 20)
+                if recent:
+                    st.dataframe([change._asdict() for change in reversed(recent)])
+            except Exception as e:
+                st.error(f"Error reading change log: {str(e)}")
+    
+    # Vitals screening
+    st.subheader("Vitals Screening")
+    st.write("Flags glucose, temperature and blood pressure values outside clinical limits "
+             "or far from the patient's own baseline.")
+    col1, col2 = st.columns(2)
+    with col1:
+        screen_clicked = st.button("Screen New Records", disabled=read_only_mode())
+    with col2:
+        screen_full_clicked = st.button("Rescreen All Records", disabled=read_only_mode())
+    
+    for db_file in DB_FILES:
+        with use_database(db_file):
+            try:
+                if screen_clicked or screen_full_clicked:
+                    with st.spinner("Screening vitals..."):
+                        result = run_screening(full=screen_full_clicked)
+                    if result["success"]:
+                        st.success(
+                            f"{db_file}: screened {result['records_screened']} record(s) in {result['seconds']} s, "
+                            f"{result['alerts']} alert(s) for {result['patients_flagged']} patient(s)"
+                        )
+                    else:
+                        st.error(f"{db_file}: screening failed: {result['error']}")
+                flagged = get_flagged_patients(limit=50)
+                if flagged:
+                    st.write(f"**Flagged patients ({db_file})**")
+                    st.dataframe(flagged)
+            except Exception as e:
+                st.error(f"Error in vitals screening: {str(e)}")
+                st.code(traceback.format_exc())
+    
+    # Duplicate patients
+    st.subheader("Duplicate Patients")
+    st.write("Finds patients that are probably registered twice (for example under a mistyped national ID) "
+             "by comparing patients that share a phonetic name, date of birth or phone number.")
+    if st.button("Find Duplicates", disabled=read_only_mode()):
+        with st.spinner("Comparing patients..."):
+            duplicates_result = find_duplicates(DB_FILES)
+        if duplicates_result["success"]:
+            st.success(
+                f"Compared {duplicates_result['pairs_compared']} pair(s) of {duplicates_result['patients']} patient(s) "
+                f"in {duplicates_result['seconds']} s: {duplicates_result['candidates']} candidate(s)"
+            )
+        else:
+            st.error(f"Duplicate search failed: {duplicates_result['error']}")
+    candidates = get_duplicate_candidates(50, DB_FILES)
+    if candidates:
+        st.dataframe(candidates)
+        labels = [f"{candidate['patient_a']} / {candidate['patient_b']} ({candidate['score']})" for candidate in candidates]
+        dismiss_label = st.selectbox("Not a duplicate", labels)
+        if st.button("Dismiss Pair", disabled=read_only_mode()):
+            candidate = candidates[labels.index(dismiss_label)]
+            dismiss_candidate(candidate["patient_a"], candidate["patient_b"], candidate["db_file"])
+            st.rerun()
+    
+    # Online backup
+    st.subheader("Backup")
+    st.write("Copies the databases with the SQLite backup API in small steps (the app keeps working) "
+             "and the file store incrementally (only changed files).")
+    backup_dest = st.text_input("Backup directory", DEFAULT_BACKUP_DIR)
+    if st.button("Run Backup", disabled=read_only_mode()):
+        with st.spinner("Backing up..."):
+            backup_report = run_backup(backup_dest)
+        if backup_report["success"]:
+            st.success(f"Backup completed in {backup_report['seconds']} s")
+        else:
+            st.error(f"Backup finished with errors: {backup_report.get('error', '')}")
+    last_backup = get_last_backup(backup_dest)
+    if last_backup:
+        file_store = last_backup["file_store"]
+        st.write(
+            f"Last backup: {last_backup['finished_at']} ({last_backup['seconds']} s), "
+            f"{len(last_backup['databases'])} database(s), {file_store['files']} file(s), "
+            f"{file_store['counts']['copied']} copied ({file_store['bytes_copied'] / (1024 * 1024):.2f} MB)"
+        )
+        st.dataframe(last_backup["databases"])
+        if file_store["errors"]:
+            st.warning(f"{len(file_store['errors'])} file(s) were not backed up")
+            st.dataframe(file_store["errors"])
+    
+    # SQL statement tracing
+    st.subheader("Query Performance")
+    st.write("Times every SQL statement and its row count, grouped by statement. "
+             "Statements over the threshold are logged with their query plan.")
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        trace_on = st.checkbox("Trace SQL statements", value=query_log.enabled())
+    with col2:
+        slow_ms = st.number_input("Slow query threshold (ms)", min_value=0.0, value=query_log.slow_threshold_ms())
+    with col3:
+        query_top = st.number_input("Statements to show", min_value=1, max_value=200, value=20)
+    if trace_on:
+        query_log.enable_tracing(slow_ms)
+    else:
+        query_log.disable_tracing()
+    
+    query_order = st.selectbox("Sort by", ["total_ms", "max_ms", "avg_ms", "count", "rows", "slow_count"])
+    query_stats = query_log.get_query_stats(int(query_top), query_order)
+    if query_stats:
+        st.dataframe([{key: value for key, value in row.items() if key != "plan"} for row in query_stats])
+        for row in query_stats:
+            if row["plan"]:
+                with st.expander(f"Plan: {row['sql'][:80]}"):
+                    st.code(row["plan"])
+        slow_queries = query_log.get_recent_slow_queries()
+        if slow_queries:
+            st.write("**Recent slow statements**")
+            st.dataframe(slow_queries)
+    elif trace_on:
+        st.info("No statements traced yet.")
+    
+    if st.button("Reset Query Stats"):
+        query_log.reset_query_stats()
+        st.rerun()
+    
+    # Startup and rerun profile
+    st.subheader("Performance Profile")
+    if "first_render_ms" not in st.session_state:
+        st.session_state.first_render_ms = (time.perf_counter() - PROCESS_START) * 1000.0
+    st.write(f"App start to first Debug render in this session: {st.session_state.first_render_ms:.1f} ms")
+    
+    timings = get_timings()
+    if timings:
+        st.dataframe(timings)
+    else:
+        st.info("No timings recorded yet.")
+    
+    if st.button("Reset Timings"):
+        reset_timings()
+        st.rerun()
+    
+    import_module = st.text_input("Module to profile with -X importtime", "database")
+    if st.button("Profile Import Time"):
+        with st.spinner("Importing in a fresh interpreter..."):
+            profile = import_time_profile(import_module)
+        if profile["success"]:
+            st.write(f"Total import time for `{import_module}`: {profile['total_ms']} ms")
+            st.dataframe(profile["imports"])
+        else:
+            st.error(f"Import profile failed: {profile['error']}")
+    
     # Add test patient
     st.subheader("Add Test Patient")
     test_id = st.text_input("Test National ID", "TEST123")
@@ -551,10 +1046,11 @@ def debug_app_page():
 # Run the app
 if __name__ == "__main__":
     try:
-        if st.session_state.authenticated:
-            main_app()
-        else:
-            login()
+        with timed("rerun"):
+            if st.session_state.authenticated:
+                main_app()
+            else:
+                login()
     except Exception as e:
         st.error(f"Application error: {str(e)}")
         st.error(traceback.format_exc())
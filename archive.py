@@ -0,0 +1,375 @@
+import calendar
+import glob
+import os
+import re
+import sqlite3
+import stat
+import time
+import traceback
+import zlib
+from collections import namedtuple
+from datetime import datetime
+
+import database
+
+# Cold storage: one SQLite file per year and database, read-only once written
+ARCHIVE_DIR = "archive"
+ARCHIVE_FILE_PATTERN = "medical_archive_{year}.db"
+
+# Records and blobs older than this are moved out of the hot database
+DEFAULT_MAX_AGE_DAYS = 2 * 365
+
+# SQLite allows 10 attached databases by default; keep one slot spare
+MAX_ATTACHED = 9
+
+# An archive is only rebuilt when at least this share of its pages is free
+VACUUM_FREE_RATIO = 0.25
+
+# Record row plus its epoch, for merging hot and archived rows in time order
+_RecordWithTs = namedtuple("_RecordWithTs", list(database.MedicalRecordRow._fields) + ["record_ts"])
+
+ARCHIVE_BLOB_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS {name} (
+    id INTEGER PRIMARY KEY,
+    patient_id INTEGER NOT NULL,
+    file_name TEXT NOT NULL,
+    file_type TEXT,
+    file_content BLOB,
+    upload_date TEXT GENERATED ALWAYS AS (datetime(upload_ts, 'unixepoch')) VIRTUAL,
+    description TEXT,
+    file_size INTEGER,
+    upload_ts INTEGER NOT NULL,
+    compression TEXT
+)
+'''
+
+# Columns of the archive tables, in the order used to copy rows between archives
+ARCHIVE_COLUMNS = {
+    "medical_records": ["id", "patient_id", "blood_pressure", "glucose_level", "temperature", "notes", "record_ts"],
+    "patient_files_blob": ["id", "patient_id", "file_name", "file_type", "file_content", "description",
+                           "file_size", "upload_ts", "compression"],
+}
+
+def archive_dir(db_file=None):
+    """
+    Directory of the archives of one database (the current one by default):
+    archive/<database name>/ next to the database file, so every shard has its own archives
+    and a backup copy finds its archives next to it.
+    """
+    db_file = db_file or database.current_db_file()
+    name = os.path.splitext(os.path.basename(db_file))[0]
+    return os.path.join(os.path.dirname(db_file), ARCHIVE_DIR, name)
+
+def archive_path(year, db_file=None):
+    return os.path.join(archive_dir(db_file), ARCHIVE_FILE_PATTERN.format(year=year))
+
+def list_archives(db_file=None):
+    """Return [(year, path)] of the existing archive files of a database, oldest first"""
+    db_file = db_file or database.current_db_file()
+    patterns = [os.path.join(archive_dir(db_file), ARCHIVE_FILE_PATTERN.format(year="*"))]
+    if os.path.abspath(db_file) == os.path.abspath(database.DB_FILE):
+        # Archives written before they were kept per database belong to the main database
+        patterns.append(os.path.join(os.path.dirname(db_file), ARCHIVE_DIR, ARCHIVE_FILE_PATTERN.format(year="*")))
+    archives = []
+    for pattern in patterns:
+        for path in glob.glob(pattern):
+            match = re.search(r"_(\d{4})\.db$", path)
+            if match:
+                archives.append((int(match.group(1)), path))
+    return sorted(archives)
+
+def _set_read_only(path, read_only):
+    mode = os.stat(path).st_mode
+    if read_only:
+        os.chmod(path, mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+    else:
+        os.chmod(path, mode | stat.S_IWUSR)
+
+def _prepare_archive(conn, year):
+    """Attach the archive for a year as `arch` (writable), creating it if needed"""
+    path = archive_path(year)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if os.path.exists(path):
+        _set_read_only(path, False)
+    conn.execute("ATTACH DATABASE ? AS arch", (path,))
+    # Archive ids come from the hot tables, so no AUTOINCREMENT here
+    records_schema = database.TABLE_SCHEMAS["medical_records"].replace("AUTOINCREMENT", "")
+    conn.execute(records_schema.format(name="arch.medical_records"))
+    conn.execute(ARCHIVE_BLOB_SCHEMA.format(name="arch.patient_files_blob"))
+    conn.execute("CREATE INDEX IF NOT EXISTS arch.idx_archive_records_patient_ts ON medical_records (patient_id, record_ts)")
+    conn.execute("CREATE INDEX IF NOT EXISTS arch.idx_archive_blob_patient_ts ON patient_files_blob (patient_id, upload_ts)")
+    # Archives stay single self-contained files, whatever the journal mode of the hot database
+    conn.execute("PRAGMA arch.journal_mode = DELETE")
+    conn.commit()
+    return path
+
+def _finish_archive(conn, path, rows_moved):
+    """
+    Detach the archive and make it read-only. Archives only grow (rows are replaced only when
+    a run re-copies an interrupted batch), so the file is rebuilt with VACUUM only when this
+    run moved rows into it and left a large share of its pages free.
+    """
+    vacuum = False
+    if rows_moved:
+        page_count = conn.execute("PRAGMA arch.page_count").fetchone()[0]
+        free_pages = conn.execute("PRAGMA arch.freelist_count").fetchone()[0]
+        vacuum = page_count > 0 and free_pages >= page_count * VACUUM_FREE_RATIO
+    conn.execute("DETACH DATABASE arch")
+    if vacuum:
+        archive_conn = sqlite3.connect(path)
+        try:
+            archive_conn.execute("VACUUM")
+        finally:
+            archive_conn.close()
+    _set_read_only(path, True)
+    return vacuum
+
+def import_archived_rows(db_file, year, table_name, rows):
+    """
+    Add rows taken from another database's archive (columns as in ARCHIVE_COLUMNS, with
+    their new ids and patient ids) to the archive of db_file for a year. Used by the shard
+    rebalancing, which moves patients between databases.
+    """
+    conn = sqlite3.connect(db_file)
+    try:
+        with database.use_database(db_file):
+            path = _prepare_archive(conn, year)
+        try:
+            columns = ARCHIVE_COLUMNS[table_name]
+            conn.executemany(
+                f"INSERT INTO arch.{table_name} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+                rows
+            )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            # Only inserts, so the file needs no VACUUM
+            conn.execute("DETACH DATABASE arch")
+            _set_read_only(path, True)
+    finally:
+        conn.close()
+
+def _year_start_ts(year):
+    """Epoch of January 1st of `year`, UTC"""
+    return calendar.timegm((year, 1, 1, 0, 0, 0))
+
+def _years_to_archive(conn, cutoff_ts):
+    years = set()
+    for table_name, ts_column in (("medical_records", "record_ts"), ("patient_files_blob", "upload_ts")):
+        for row in conn.execute(
+            f"SELECT DISTINCT CAST(strftime('%Y', {ts_column}, 'unixepoch') AS INTEGER) FROM {table_name} WHERE {ts_column} < ?",
+            (cutoff_ts,)
+        ):
+            years.add(row[0])
+    return sorted(years)
+
+def _delete_moved(conn, table_name, ids):
+    """
+    Delete rows of a batch that are safely in the archive, and log them in the change log as
+    ARCHIVE rather than DELETE (same transaction), so consumers do not drop them
+    """
+    placeholders = ",".join("?" * len(ids))
+    last_seq = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM main.change_log").fetchone()[0]
+    conn.execute(
+        f"DELETE FROM main.{table_name} WHERE id IN ({placeholders}) AND id IN (SELECT id FROM arch.{table_name})",
+        ids
+    )
+    conn.execute(
+        f"UPDATE main.change_log SET operation = 'ARCHIVE' "
+        f"WHERE seq > ? AND table_name = ? AND operation = 'DELETE' AND row_id IN ({placeholders})",
+        [last_seq, table_name] + ids
+    )
+    conn.commit()
+
+def archive_old_records(max_age_days=DEFAULT_MAX_AGE_DAYS, batch_size=1000):
+    """
+    Move medical_records and patient_files_blob rows older than max_age_days into per-year
+    archive databases (archive/<database name>/medical_archive_<year>.db).
+
+    Each batch is first copied into the archive and committed, then deleted from the hot
+    database in a second transaction, only for the ids found in the archive. SQLite does not
+    commit attached WAL databases atomically, so a crash may leave a batch in both places
+    (readers skip the archived copy of a row that is still hot, and a re-run finishes the move)
+    but never in neither. The change log records the moves as ARCHIVE entries. BLOB content
+    is zlib-compressed in the archive; records are copied as they are, as their notes are still
+    queried with SQL. Each archive is made read-only when done (and vacuumed only when it has
+    many free pages). Row ids are kept, so a record or file id stays valid after archiving.
+    """
+    if database.read_only_mode():
+        return {"success": False, "error": "The app is running on a read-only snapshot"}
+    started = time.perf_counter()
+    cutoff_ts = database.now_ts() - max_age_days * 86400
+    moved = {"medical_records": 0, "patient_files_blob": 0}
+    bytes_before = 0
+    bytes_after = 0
+    years_done = []
+    years_vacuumed = []
+
+    conn = database.connect()
+    try:
+        for year in _years_to_archive(conn, cutoff_ts):
+            year_start = _year_start_ts(year)
+            year_end = min(_year_start_ts(year + 1), cutoff_ts)
+            moved_before = sum(moved.values())
+            path = _prepare_archive(conn, year)
+            try:
+                # Medical records: plain copy, batch by batch
+                while True:
+                    ids = [row[0] for row in conn.execute(
+                        "SELECT id FROM medical_records WHERE record_ts >= ? AND record_ts < ? ORDER BY id LIMIT ?",
+                        (year_start, year_end, batch_size)
+                    )]
+                    if not ids:
+                        break
+                    placeholders = ",".join("?" * len(ids))
+                    conn.execute(
+                        f"INSERT OR REPLACE INTO arch.medical_records (id, patient_id, blood_pressure, glucose_level, temperature, notes, record_ts) "
+                        f"SELECT id, patient_id, blood_pressure, glucose_level, temperature, notes, record_ts FROM main.medical_records WHERE id IN ({placeholders})",
+                        ids
+                    )
+                    conn.commit()
+                    _delete_moved(conn, "medical_records", ids)
+                    moved["medical_records"] += len(ids)
+
+                # BLOBs: compressed in Python, so the batch is bounded by count
+                blob_batch = max(1, batch_size // 20)
+                while True:
+                    rows = conn.execute(
+                        "SELECT id, patient_id, file_name, file_type, file_content, description, file_size, upload_ts "
+                        "FROM main.patient_files_blob WHERE upload_ts >= ? AND upload_ts < ? ORDER BY id LIMIT ?",
+                        (year_start, year_end, blob_batch)
+                    ).fetchall()
+                    if not rows:
+                        break
+                    archived = []
+                    for file_id, patient_id, file_name, file_type, content, description, file_size, upload_ts in rows:
+                        content = bytes(content) if content is not None else b""
+                        compressed = zlib.compress(content, 6)
+                        bytes_before += len(content)
+                        bytes_after += len(compressed)
+                        archived.append((file_id, patient_id, file_name, file_type, compressed, description,
+                                         file_size, upload_ts, "zlib"))
+                    conn.executemany(
+                        "INSERT OR REPLACE INTO arch.patient_files_blob (id, patient_id, file_name, file_type, file_content, description, file_size, upload_ts, compression) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        archived
+                    )
+                    conn.commit()
+                    _delete_moved(conn, "patient_files_blob", [row[0] for row in rows])
+                    moved["patient_files_blob"] += len(rows)
+            except Exception:
+                conn.rollback()
+                conn.execute("DETACH DATABASE arch")
+                _set_read_only(path, True)
+                raise
+            if _finish_archive(conn, path, sum(moved.values()) - moved_before):
+                years_vacuumed.append(year)
+            years_done.append(year)
+
+        return {
+            "success": True,
+            "cutoff": datetime.fromtimestamp(cutoff_ts).strftime("%Y-%m-%d %H:%M:%S"),
+            "years": years_done,
+            "years_vacuumed": years_vacuumed,
+            "records_moved": moved["medical_records"],
+            "blobs_moved": moved["patient_files_blob"],
+            "blob_bytes_before": bytes_before,
+            "blob_bytes_after": bytes_after,
+            "seconds": round(time.perf_counter() - started, 3),
+        }
+    except Exception as e:
+        print(f"Error archiving old records: {str(e)}")
+        print(traceback.format_exc())
+        return {"success": False, "error": str(e), "records_moved": moved["medical_records"], "blobs_moved": moved["patient_files_blob"]}
+    finally:
+        conn.close()
+
+def _query_with_archives(hot_sql, archive_sql, params, row_type):
+    """
+    Run hot_sql on the hot database and archive_sql (with a {schema} placeholder) on every
+    archive, attaching them read-only in groups of MAX_ATTACHED. Returns the combined rows.
+    """
+    conn = sqlite3.connect(f"file:{os.path.abspath(database.current_db_file())}", uri=True)
+    try:
+        rows = conn.execute(hot_sql, params).fetchall()
+        archives = list_archives()
+        for start in range(0, len(archives), MAX_ATTACHED):
+            group = archives[start:start + MAX_ATTACHED]
+            aliases = []
+            for year, path in group:
+                alias = f"archive_{year}"
+                conn.execute("ATTACH DATABASE ? AS " + alias, (f"file:{os.path.abspath(path)}?mode=ro",))
+                aliases.append(alias)
+            try:
+                union = " UNION ALL ".join(archive_sql.format(schema=alias) for alias in aliases)
+                rows.extend(conn.execute(union, params * len(aliases)).fetchall())
+            finally:
+                for alias in aliases:
+                    conn.execute("DETACH DATABASE " + alias)
+        return [row_type._make(row) for row in rows]
+    finally:
+        conn.close()
+
+def get_full_history_records(patient_id):
+    """All medical records for a patient, hot and archived, newest first"""
+    columns = "id, record_date, blood_pressure, glucose_level, temperature, notes, record_ts"
+    rows = _query_with_archives(
+        f"SELECT {columns} FROM medical_records WHERE patient_id = ?",
+        f"SELECT {columns} FROM {{schema}}.medical_records WHERE patient_id = ?",
+        (patient_id,),
+        _RecordWithTs
+    )
+    # A row can be in both places after an interrupted archive run; the hot copy comes first
+    seen = set()
+    unique = []
+    for row in rows:
+        if row.id not in seen:
+            seen.add(row.id)
+            unique.append(row)
+    unique.sort(key=lambda row: row.record_ts, reverse=True)
+    return [database.MedicalRecordRow._make(row[:-1]) for row in unique]
+
+def get_archived_blob_files(patient_id):
+    """BLOB files for a patient in the archives of the current database (without content), newest first"""
+    rows = []
+    for year, path in reversed(list_archives()):
+        conn = sqlite3.connect(f"file:{os.path.abspath(path)}?mode=ro", uri=True)
+        try:
+            rows.extend(conn.execute(
+                "SELECT id, file_name, file_type, upload_date, description, file_size FROM patient_files_blob WHERE patient_id = ? ORDER BY upload_ts DESC",
+                (patient_id,)
+            ).fetchall())
+        finally:
+            conn.close()
+    return [database.BlobFileRow._make(row) for row in rows]
+
+def get_archived_blob_content(file_id):
+    """Look up a BLOB file by id in the archives and return it decompressed, or None"""
+    for year, path in reversed(list_archives()):
+        conn = sqlite3.connect(f"file:{os.path.abspath(path)}?mode=ro", uri=True)
+        try:
+            row = conn.execute(
+                "SELECT file_name, file_type, file_content, compression FROM patient_files_blob WHERE id = ?",
+                (file_id,)
+            ).fetchone()
+        finally:
+            conn.close()
+        if row:
+            content = zlib.decompress(row[2]) if row[3] == "zlib" else row[2]
+            return {"success": True, "file_name": row[0], "file_type": row[1], "file_content": content}
+    return None
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Move old medical records and BLOB files into per-year archive databases")
+    parser.add_argument("--max-age-days", type=int, default=DEFAULT_MAX_AGE_DAYS)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+
+    import sharding
+    for db_file in sharding.shard_paths() if sharding.sharding_enabled() else [database.DB_FILE]:
+        with database.use_database(db_file):
+            print(db_file, archive_old_records(args.max_age_days, args.batch_size))
@@ -0,0 +1,334 @@
+"""
+Online backup of the databases and the file store, safe to run while the app is in use.
+
+Run from the project root:
+    python backup.py [--dest backups/latest] [--pages-per-step 1024] [--step-sleep 0.01]
+
+Databases (the main file or every shard, plus the yearly archives) are copied with the
+SQLite backup API in steps of a few pages, sleeping between steps. In WAL mode the copy reads
+from one snapshot held open for the whole backup, so writers are never blocked and nothing is
+copied twice. In rollback-journal mode a write by another connection makes SQLite restart the
+copy; after MAX_RESTARTS restarts the rest is copied in a single step, which holds off writers
+until it finishes (switch to WAL with `python maintenance.py --convert` to avoid that). Each
+copy is checked with PRAGMA quick_check, switched to journal_mode=DELETE (a single
+self-contained file) and moved into place only when complete.
+
+The file store (patient_files/) is copied incrementally: a manifest in the destination keeps
+size, mtime and SHA-256 of every copied file, so later runs only hash files whose size or
+mtime changed and only copy files whose content changed. Files deleted from the store stay in
+the backup unless --prune is given.
+
+A backup can be opened read-only by the app for reporting users:
+    MEDICAL_DB_SNAPSHOT=backups/latest/medical_records.db streamlit run app.py
+(in sharded mode also set MEDICAL_DB_SHARD_DIR=backups/latest/shards).
+"""
+import json
+import os
+import shutil
+import sqlite3
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import archive
+import database
+import sharding
+from integrity import FILES_ROOT, file_sha256
+
+DEFAULT_BACKUP_DIR = os.path.join("backups", "latest")
+# Pages copied per backup step, and the pause between steps that lets writers in
+PAGES_PER_STEP = 1024
+STEP_SLEEP_SECONDS = 0.01
+# Restarts caused by concurrent writes (rollback-journal mode only) before copying in one step
+MAX_RESTARTS = 3
+MANIFEST_FILE = "backup_manifest.db"
+REPORT_FILE = "backup_report.json"
+
+class _TooManyRestarts(Exception):
+    pass
+
+def _relative(path):
+    """Path of a source file inside the backup: the same relative path as in the project"""
+    rel = os.path.relpath(path)
+    return os.path.basename(path) if rel.startswith("..") else rel
+
+def backup_database(source_path, dest_path, pages_per_step=PAGES_PER_STEP, sleep_seconds=STEP_SLEEP_SECONDS):
+    """
+    Copy one SQLite database to dest_path with Connection.backup in paced steps.
+    The copy is written next to dest_path and replaces it only once it is complete and checked.
+    """
+    started = time.perf_counter()
+    if not os.path.exists(source_path):
+        return {"success": False, "source": source_path, "error": "Database file not found"}
+    os.makedirs(os.path.dirname(dest_path) or ".", exist_ok=True)
+    partial_path = dest_path + ".partial"
+    if os.path.exists(partial_path):
+        os.remove(partial_path)
+
+    steps = 0
+    restarts = 0
+    last_remaining = None
+
+    def progress(status, remaining, total):
+        nonlocal steps, restarts, last_remaining
+        steps += 1
+        if last_remaining is not None and remaining > last_remaining:
+            restarts += 1
+            if restarts > MAX_RESTARTS:
+                raise _TooManyRestarts()
+        last_remaining = remaining
+
+    source = sqlite3.connect(source_path)
+    target = sqlite3.connect(partial_path)
+    try:
+        wal = source.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+        if wal:
+            # Keep one read snapshot open across the steps; in WAL mode it does not block writers
+            source.execute("BEGIN")
+            source.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+        try:
+            source.backup(target, pages=pages_per_step, progress=progress, sleep=sleep_seconds)
+        except _TooManyRestarts:
+            source.backup(target)
+            steps += 1
+        if wal:
+            source.rollback()
+        # A backup of a WAL database is a WAL database too; the copy should be one file
+        target.execute("PRAGMA journal_mode = DELETE")
+        check = target.execute("PRAGMA quick_check").fetchone()[0]
+        page_count = target.execute("PRAGMA page_count").fetchone()[0]
+        target.close()
+        if check != "ok":
+            os.remove(partial_path)
+            return {"success": False, "source": source_path, "error": f"quick_check failed: {check}"}
+        os.replace(partial_path, dest_path)
+        return {
+            "success": True,
+            "source": source_path,
+            "dest": dest_path,
+            "pages": page_count,
+            "bytes": os.path.getsize(dest_path),
+            "steps": steps,
+            "restarts": restarts,
+            "seconds": round(time.perf_counter() - started, 3),
+        }
+    except Exception as e:
+        print(f"Error backing up {source_path}: {str(e)}")
+        print(traceback.format_exc())
+        target.close()
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        return {"success": False, "source": source_path, "error": str(e)}
+    finally:
+        source.close()
+
+def _open_manifest(dest_root):
+    conn = sqlite3.connect(os.path.join(dest_root, MANIFEST_FILE))
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS file_state (
+        rel_path TEXT PRIMARY KEY,
+        file_size INTEGER,
+        mtime_ns INTEGER,
+        sha256 TEXT,
+        backed_up_at TEXT
+    )
+    ''')
+    conn.commit()
+    return conn
+
+def _backup_file(source_path, dest_path, previous, full):
+    """
+    Bring one file of the backup up to date.
+    `previous` is (file_size, mtime_ns, sha256) from the manifest or None.
+    Status: unchanged (skipped by size/mtime), touched (same content), copied, busy
+    (changed while being copied; retried next run) or error.
+    """
+    result = {"source": source_path}
+    try:
+        st = os.stat(source_path)
+        result["file_size"] = st.st_size
+        result["mtime_ns"] = st.st_mtime_ns
+        dest_exists = os.path.exists(dest_path)
+        if previous is not None and dest_exists and not full and previous[:2] == (st.st_size, st.st_mtime_ns):
+            result["sha256"] = previous[2]
+            result["status"] = "unchanged"
+            return result
+
+        sha256 = file_sha256(source_path)
+        result["sha256"] = sha256
+        if previous is not None and dest_exists and previous[2] == sha256:
+            result["status"] = "touched"
+            return result
+
+        os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+        partial_path = dest_path + ".partial"
+        shutil.copy2(source_path, partial_path)
+        if file_sha256(partial_path) != sha256:
+            os.remove(partial_path)
+            result["status"] = "busy"
+            return result
+        os.replace(partial_path, dest_path)
+        result["status"] = "copied"
+        return result
+    except OSError as e:
+        result["status"] = "error"
+        result["error"] = str(e)
+        return result
+
+def backup_file_store(dest_root=DEFAULT_BACKUP_DIR, files_root=FILES_ROOT, max_workers=4, full=False, prune=False):
+    """
+    Incrementally copy the file store into dest_root, tracking what was copied in the
+    backup manifest. Returns counts per status, bytes copied and the files that failed.
+    """
+    started = time.perf_counter()
+    os.makedirs(dest_root, exist_ok=True)
+    counts = {"unchanged": 0, "touched": 0, "copied": 0, "busy": 0, "error": 0, "pruned": 0}
+    errors = []
+    bytes_copied = 0
+
+    sources = []
+    for directory, _, file_names in os.walk(files_root):
+        for file_name in file_names:
+            path = os.path.join(directory, file_name)
+            sources.append((os.path.relpath(path), path))
+
+    manifest = _open_manifest(dest_root)
+    try:
+        previous = {row[0]: row[1:] for row in manifest.execute("SELECT rel_path, file_size, mtime_ns, sha256 FROM file_state")}
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            results = pool.map(
+                lambda item: (item[0], _backup_file(item[1], os.path.join(dest_root, item[0]), previous.get(item[0]), full)),
+                sources
+            )
+            backed_up_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            updates = []
+            for rel_path, result in results:
+                counts[result["status"]] += 1
+                if result["status"] == "error":
+                    errors.append({"file": rel_path, "error": result["error"]})
+                elif result["status"] == "busy":
+                    errors.append({"file": rel_path, "error": "changed while being copied"})
+                else:
+                    if result["status"] == "copied":
+                        bytes_copied += result["file_size"]
+                    updates.append((rel_path, result["file_size"], result["mtime_ns"], result["sha256"], backed_up_at))
+                if len(updates) >= 1000:
+                    manifest.executemany("INSERT OR REPLACE INTO file_state VALUES (?, ?, ?, ?, ?)", updates)
+                    manifest.commit()
+                    updates = []
+            manifest.executemany("INSERT OR REPLACE INTO file_state VALUES (?, ?, ?, ?, ?)", updates)
+            manifest.commit()
+
+        if prune:
+            current = {rel_path for rel_path, _ in sources}
+            store_prefix = os.path.relpath(files_root) + os.sep
+            for rel_path in set(previous) - current:
+                if not rel_path.startswith(store_prefix):
+                    # Archive databases share the manifest
+                    continue
+                try:
+                    os.remove(os.path.join(dest_root, rel_path))
+                except FileNotFoundError:
+                    pass
+                manifest.execute("DELETE FROM file_state WHERE rel_path = ?", (rel_path,))
+                counts["pruned"] += 1
+            manifest.commit()
+    finally:
+        manifest.close()
+
+    seconds = time.perf_counter() - started
+    return {
+        "success": not errors,
+        "files": len(sources),
+        "counts": counts,
+        "bytes_copied": bytes_copied,
+        "seconds": round(seconds, 3),
+        "errors": errors,
+    }
+
+def _database_files():
+    """Databases to back up: (the main file or every shard, the yearly archives of each)"""
+    if sharding.sharding_enabled():
+        paths = sharding.shard_paths()
+    else:
+        paths = [database.DB_FILE]
+    return paths, [path for db_file in paths for _, path in archive.list_archives(db_file)]
+
+def run_backup(dest_root=DEFAULT_BACKUP_DIR, pages_per_step=PAGES_PER_STEP, sleep_seconds=STEP_SLEEP_SECONDS,
+               max_workers=4, full=False, prune=False):
+    """
+    Back up every database and the file store into dest_root. Archives whose size and
+    mtime did not change since the last backup are skipped. Writes backup_report.json.
+    """
+    if database.read_only_mode():
+        return {"success": False, "error": "The app is running on a read-only snapshot"}
+    started = time.perf_counter()
+    os.makedirs(dest_root, exist_ok=True)
+    databases = []
+    db_paths, archive_list = _database_files()
+    archive_paths = set(archive_list)
+    manifest = _open_manifest(dest_root)
+    try:
+        for path in db_paths + archive_list:
+            rel_path = _relative(path)
+            dest_path = os.path.join(dest_root, rel_path)
+            st = os.stat(path) if os.path.exists(path) else None
+            if path in archive_paths and st is not None and os.path.exists(dest_path) and not full:
+                previous = manifest.execute(
+                    "SELECT file_size, mtime_ns FROM file_state WHERE rel_path = ?", (rel_path,)
+                ).fetchone()
+                if previous == (st.st_size, st.st_mtime_ns):
+                    databases.append({"success": True, "source": path, "skipped": "unchanged"})
+                    continue
+            result = backup_database(path, dest_path, pages_per_step, sleep_seconds)
+            databases.append(result)
+            if result["success"] and path in archive_paths:
+                manifest.execute(
+                    "INSERT OR REPLACE INTO file_state VALUES (?, ?, ?, NULL, ?)",
+                    (rel_path, st.st_size, st.st_mtime_ns, datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+                )
+                manifest.commit()
+    finally:
+        manifest.close()
+
+    if sharding.sharding_enabled():
+        config_path = os.path.join(sharding.SHARD_DIR, sharding.SHARD_CONFIG_FILE)
+        os.makedirs(os.path.join(dest_root, _relative(sharding.SHARD_DIR)), exist_ok=True)
+        shutil.copy2(config_path, os.path.join(dest_root, _relative(config_path)))
+
+    file_store = backup_file_store(dest_root, max_workers=max_workers, full=full, prune=prune)
+    report = {
+        "success": all(result["success"] for result in databases) and file_store["success"],
+        "finished_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "dest": dest_root,
+        "seconds": round(time.perf_counter() - started, 3),
+        "databases": databases,
+        "file_store": file_store,
+    }
+    with open(os.path.join(dest_root, REPORT_FILE), "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    return report
+
+def get_last_backup(dest_root=DEFAULT_BACKUP_DIR):
+    """The report of the last backup into dest_root, or None"""
+    try:
+        with open(os.path.join(dest_root, REPORT_FILE), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Back up the databases and the file store while the app is running")
+    parser.add_argument("--dest", default=DEFAULT_BACKUP_DIR, help="backup directory (updated incrementally)")
+    parser.add_argument("--pages-per-step", type=int, default=PAGES_PER_STEP)
+    parser.add_argument("--step-sleep", type=float, default=STEP_SLEEP_SECONDS, help="seconds to pause between steps")
+    parser.add_argument("--workers", type=int, default=4, help="threads for hashing and copying files")
+    parser.add_argument("--full", action="store_true", help="re-hash every file and copy every archive")
+    parser.add_argument("--prune", action="store_true", help="remove files deleted from the store from the backup")
+    args = parser.parse_args()
+
+    report = run_backup(args.dest, args.pages_per_step, args.step_sleep, args.workers, args.full, args.prune)
+    print(json.dumps(report, indent=2))
@@ -0,0 +1,135 @@
+"""
+Load test: requests per second of the JSON API (api_server.py).
+
+Run from the project root:
+    python benchmarks/bench_api.py [--clients N] [--requests N] [--pipeline N] [--workers N]
+
+Starts the API on a local port (--port) over a throwaway database in a temporary directory
+(the real medical_records.db is never touched) and drives it with keep-alive asyncio
+clients. Each client sends its requests in batches of --pipeline without waiting for the
+responses in between, then reads the batch back.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import api_server
+import database
+
+
+def populate(patients, records_per_patient):
+    database.init_db()
+    conn = database.connect()
+    conn.executemany(
+        "INSERT INTO patients (national_id, name, registration_ts) VALUES (?, ?, ?)",
+        [(f"BENCH-{i}", f"Bench Patient {i}", database.now_ts()) for i in range(patients)]
+    )
+    patient_ids = [row[0] for row in conn.execute("SELECT id FROM patients ORDER BY id")]
+    conn.executemany(
+        "INSERT INTO medical_records (patient_id, record_ts, blood_pressure, glucose_level, temperature, notes) VALUES (?, ?, ?, ?, ?, ?)",
+        [(patient_id, 1704067200 + i, "120/80", 95.0, 36.8, "bench") for patient_id in patient_ids for i in range(records_per_patient)]
+    )
+    conn.commit()
+    conn.close()
+    return patient_ids
+
+
+async def read_response(reader):
+    head = await reader.readuntil(b"\r\n\r\n")
+    status = int(head.split(b" ", 2)[1])
+    length = 0
+    for line in head.split(b"\r\n")[1:]:
+        name, _, value = line.partition(b":")
+        if name.strip().lower() == b"content-length":
+            length = int(value)
+    return status, await reader.readexactly(length)
+
+
+def build_request(method, path, payload=None):
+    body = json.dumps(payload).encode("utf-8") if payload is not None else b""
+    head = f"{method} {path} HTTP/1.1\r\nHost: localhost\r\nContent-Length: {len(body)}\r\n"
+    if payload is not None:
+        head += "Content-Type: application/json\r\n"
+    return head.encode("latin-1") + b"\r\n" + body
+
+
+async def client(port, requests, pipeline, make_request, latencies):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    errors = 0
+    sent = 0
+    while sent < requests:
+        batch = min(pipeline, requests - sent)
+        started = time.perf_counter()
+        writer.write(b"".join(make_request(sent + i) for i in range(batch)))
+        await writer.drain()
+        for _ in range(batch):
+            status, _ = await read_response(reader)
+            if status >= 400:
+                errors += 1
+        latencies.append((time.perf_counter() - started) / batch)
+        sent += batch
+    writer.close()
+    await writer.wait_closed()
+    return errors
+
+
+async def run_scenario(label, port, clients, requests, pipeline, make_request):
+    latencies = []
+    started = time.perf_counter()
+    errors = await asyncio.gather(*(
+        client(port, requests, pipeline, make_request, latencies) for _ in range(clients)
+    ))
+    seconds = time.perf_counter() - started
+    total = clients * requests
+    latencies.sort()
+    p50 = latencies[len(latencies) // 2] * 1000
+    print(f"{label:<38} {total / seconds:9.0f} req/s   p50 {p50:6.2f} ms/req   errors {sum(errors)}")
+
+
+async def main_async(args, patient_ids):
+    ready = asyncio.Event()
+    server = asyncio.create_task(api_server.serve("127.0.0.1", args.port, args.workers, ready=ready))
+    await ready.wait()
+
+    print(f"{args.clients} client(s) x {args.requests} request(s), pipeline depth {args.pipeline}, {args.workers} worker thread(s)")
+    await run_scenario("GET /health", args.port, args.clients, args.requests, args.pipeline,
+                       lambda i: build_request("GET", "/health"))
+    await run_scenario("GET /patients/by-national-id/{id}", args.port, args.clients, args.requests, args.pipeline,
+                       lambda i: build_request("GET", f"/patients/by-national-id/BENCH-{i % len(patient_ids)}"))
+    await run_scenario("GET /patients/{id}/records", args.port, args.clients, args.requests, args.pipeline,
+                       lambda i: build_request("GET", f"/patients/{patient_ids[i % len(patient_ids)]}/records"))
+    await run_scenario("POST /patients/{id}/records", args.port, args.clients, args.requests, args.pipeline,
+                       lambda i: build_request("POST", f"/patients/{patient_ids[i % len(patient_ids)]}/records",
+                                               {"blood_pressure": "120/80", "glucose_level": 95, "temperature": 36.6}))
+
+    server.cancel()
+    try:
+        await server
+    except asyncio.CancelledError:
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=32, help="concurrent keep-alive connections")
+    parser.add_argument("--requests", type=int, default=200, help="requests per client and scenario")
+    parser.add_argument("--pipeline", type=int, default=8, help="requests sent before reading the responses")
+    parser.add_argument("--workers", type=int, default=api_server.DEFAULT_WORKERS, help="server threads for database calls")
+    parser.add_argument("--patients", type=int, default=1000)
+    parser.add_argument("--port", type=int, default=18080)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        patient_ids = populate(args.patients, 5)
+        asyncio.run(main_async(args, patient_ids))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""
+Micro-benchmark: per-call overhead of the DataFrame API vs the lightweight row API.
+
+Run from the project root:
+    python benchmarks/bench_row_api.py [--records N] [--calls N]
+
+Builds a throwaway database in a temporary directory, so the real
+medical_records.db is never touched.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database
+
+
+def populate(records_per_patient):
+    database.init_db()
+    conn = database.connect()
+    conn.execute(
+        "INSERT INTO patients (national_id, name, registration_ts) VALUES (?, ?, ?)",
+        ("BENCH-1", "Bench Patient", database.now_ts())
+    )
+    patient_id = conn.execute("SELECT id FROM patients WHERE national_id = 'BENCH-1'").fetchone()[0]
+    conn.executemany(
+        "INSERT INTO medical_records (patient_id, record_ts, blood_pressure, glucose_level, temperature, notes) VALUES (?, ?, ?, ?, ?, ?)",
+        [(patient_id, 1704067200 + i, "120/80", 95.0, 36.8, "bench") for i in range(records_per_patient)]
+    )
+    conn.commit()
+    conn.close()
+    return patient_id
+
+
+def bench(label, func, calls):
+    func()  # warm-up
+    total = timeit.timeit(func, number=calls)
+    print(f"{label:<45} {total / calls * 1e6:10.1f} us/call")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--records", type=int, default=5, help="medical records for the benchmark patient")
+    parser.add_argument("--calls", type=int, default=2000, help="calls per measurement")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        patient_id = populate(args.records)
+
+        print(f"{args.records} record(s), {args.calls} calls each")
+        bench("get_patient_medical_records (DataFrame)",
+              lambda: database.get_patient_medical_records(patient_id), args.calls)
+        bench("get_patient_medical_records_rows (rows)",
+              lambda: database.get_patient_medical_records_rows(patient_id), args.calls)
+        bench("get_all_patients (DataFrame)", database.get_all_patients, args.calls)
+        bench("get_all_patients_rows (rows)", database.get_all_patients_rows, args.calls)
+
+        df = database.get_patient_medical_records(patient_id)
+        rows = database.get_patient_medical_records_rows(patient_id)
+
+        def iterate_df():
+            for _, record in df.iterrows():
+                record["record_date"]
+
+        def iterate_rows():
+            for record in rows:
+                record.record_date
+
+        bench("iterate records with iterrows()", iterate_df, args.calls)
+        bench("iterate records as rows", iterate_rows, args.calls)
+
+
+if __name__ == "__main__":
+    main()
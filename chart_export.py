@@ -0,0 +1,263 @@
+import csv
+import io
+import json
+import os
+import re
+import sqlite3
+import time
+import traceback
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import archive
+import database
+import storage
+
+# Size of the pieces read from files/BLOBs and yielded to the caller
+CHUNK_SIZE = 1024 * 1024
+
+# Entries above this size need ZIP64 headers
+ZIP64_THRESHOLD = 2 ** 31 - 1
+
+RECORD_COLUMNS = ["id", "record_date", "blood_pressure", "glucose_level", "temperature", "notes", "record_ts"]
+
+class _ChunkSink:
+    """Write-only, unseekable stream collecting what ZipFile writes until the generator drains it"""
+
+    def __init__(self):
+        self._parts = []
+
+    def write(self, data):
+        self._parts.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        if not self._parts:
+            return b""
+        data = b"".join(self._parts)
+        self._parts = []
+        return data
+
+def _safe_name(name):
+    return re.sub(r'[\\/:*?"<>|]+', "_", name or "file")
+
+def _iter_records(conn, db_file, patient_id):
+    """Yield the patient's medical records one row at a time, oldest first (archives, then the hot table)"""
+    columns = ", ".join(RECORD_COLUMNS)
+    # Rows still in the hot table are taken from there (an archive run may have been interrupted)
+    hot_ids = {row[0] for row in conn.execute("SELECT id FROM medical_records WHERE patient_id = ?", (patient_id,))}
+    for year, path in archive.list_archives(db_file):
+        archive_conn = sqlite3.connect(f"file:{os.path.abspath(path)}?mode=ro", uri=True)
+        try:
+            for row in archive_conn.execute(
+                f"SELECT {columns} FROM medical_records WHERE patient_id = ? ORDER BY record_ts", (patient_id,)
+            ):
+                if row[0] not in hot_ids:
+                    yield row
+        finally:
+            archive_conn.close()
+    yield from conn.execute(
+        f"SELECT {columns} FROM medical_records WHERE patient_id = ? ORDER BY record_ts", (patient_id,)
+    )
+
+def _write_entry(zf, sink, name, chunks, size=None, compress=False):
+    """Write one ZIP entry from an iterable of byte chunks, yielding output as it is produced"""
+    info = zipfile.ZipInfo(name, date_time=time.localtime()[:6])
+    info.compress_type = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+    if size is not None:
+        info.file_size = size
+    with zf.open(info, "w", force_zip64=size is None or size > ZIP64_THRESHOLD) as entry:
+        for chunk in chunks:
+            entry.write(chunk)
+            data = sink.drain()
+            if data:
+                yield data
+    data = sink.drain()
+    if data:
+        yield data
+
+def _read_file_chunks(path):
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+def _read_blob_chunks(conn, table, file_id, compression=None):
+    with storage.open_blob_reader(conn, table, "file_content", file_id) as blob:
+        decompressor = zlib.decompressobj() if compression == "zlib" else None
+        while True:
+            chunk = blob.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            yield decompressor.decompress(chunk) if decompressor else chunk
+        if decompressor:
+            yield decompressor.flush()
+
+def _csv_chunks(rows):
+    """Encode rows as CSV, a few hundred rows per chunk"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(RECORD_COLUMNS)
+    for count, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if count % 500 == 0:
+            yield buffer.getvalue().encode("utf-8")
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode("utf-8")
+
+def _json_lines_chunks(rows):
+    lines = []
+    for row in rows:
+        lines.append(json.dumps(dict(zip(RECORD_COLUMNS, row)), ensure_ascii=False))
+        if len(lines) >= 500:
+            yield ("\n".join(lines) + "\n").encode("utf-8")
+            lines = []
+    if lines:
+        yield ("\n".join(lines) + "\n").encode("utf-8")
+
+def stream_patient_chart_zip(patient_id, db_file=None):
+    """
+    Return a generator producing a ZIP of the full chart of a patient, piece by piece:
+    patient.json, medical_records.csv, medical_records.jsonl, every file from patient_files
+    (files/) and patient_files_blob (stored_files/, including archived ones) and a
+    manifest.json. File content is streamed from disk or through BLOB handles, so memory
+    use does not grow with the size of the chart.
+    """
+    # Resolve the database now, so the generator keeps using it wherever it is consumed
+    return _generate_chart_zip(patient_id, db_file or database.current_db_file())
+
+def _generate_chart_zip(patient_id, db_file):
+    sink = _ChunkSink()
+    conn = sqlite3.connect(db_file)
+    manifest = {"patient_id": patient_id, "entries": [], "missing_files": []}
+    try:
+        cursor = conn.execute("SELECT * FROM patients WHERE id = ?", (patient_id,))
+        patient = cursor.fetchone()
+        if patient is None:
+            raise KeyError(f"Patient {patient_id} not found")
+        patient_dict = dict(zip([desc[0] for desc in cursor.description], patient))
+
+        with zipfile.ZipFile(sink, "w", allowZip64=True) as zf:
+            patient_json = json.dumps(patient_dict, ensure_ascii=False, indent=2).encode("utf-8")
+            yield from _write_entry(zf, sink, "patient.json", [patient_json], len(patient_json), compress=True)
+
+            yield from _write_entry(zf, sink, "medical_records.csv", _csv_chunks(_iter_records(conn, db_file, patient_id)), compress=True)
+            yield from _write_entry(zf, sink, "medical_records.jsonl", _json_lines_chunks(_iter_records(conn, db_file, patient_id)), compress=True)
+
+            for file_id, file_name, file_path in conn.execute(
+                "SELECT id, file_name, file_path FROM patient_files WHERE patient_id = ? ORDER BY id", (patient_id,)
+            ).fetchall():
+                try:
+                    size = os.path.getsize(file_path)
+                except OSError:
+                    manifest["missing_files"].append({"file_id": file_id, "file_path": file_path})
+                    continue
+                name = f"files/{file_id}_{_safe_name(file_name)}"
+                yield from _write_entry(zf, sink, name, _read_file_chunks(file_path), size)
+                manifest["entries"].append({"name": name, "source": "patient_files", "file_id": file_id, "size": size})
+
+            stored_ids = set()
+            for file_id, file_name, size in conn.execute(
+                "SELECT id, file_name, length(file_content) FROM patient_files_blob WHERE patient_id = ? AND file_content IS NOT NULL ORDER BY id",
+                (patient_id,)
+            ).fetchall():
+                name = f"stored_files/{file_id}_{_safe_name(file_name)}"
+                yield from _write_entry(zf, sink, name, _read_blob_chunks(conn, "patient_files_blob", file_id), size)
+                manifest["entries"].append({"name": name, "source": "patient_files_blob", "file_id": file_id, "size": size})
+                stored_ids.add(file_id)
+
+            for year, path in archive.list_archives(db_file):
+                archive_conn = sqlite3.connect(f"file:{os.path.abspath(path)}?mode=ro", uri=True)
+                try:
+                    for file_id, file_name, size, compression in archive_conn.execute(
+                        "SELECT id, file_name, file_size, compression FROM patient_files_blob WHERE patient_id = ? ORDER BY id",
+                        (patient_id,)
+                    ).fetchall():
+                        if file_id in stored_ids:
+                            continue
+                        name = f"stored_files/{file_id}_{_safe_name(file_name)}"
+                        yield from _write_entry(zf, sink, name,
+                                                _read_blob_chunks(archive_conn, "patient_files_blob", file_id, compression), size)
+                        manifest["entries"].append({"name": name, "source": f"archive_{year}", "file_id": file_id, "size": size})
+                finally:
+                    archive_conn.close()
+
+            manifest_json = json.dumps(manifest, ensure_ascii=False, indent=2).encode("utf-8")
+            yield from _write_entry(zf, sink, "manifest.json", [manifest_json], len(manifest_json), compress=True)
+
+        # Central directory, written when the ZipFile closes
+        data = sink.drain()
+        if data:
+            yield data
+    finally:
+        conn.close()
+
+def export_patient_chart(patient_id, output_path, db_file=None):
+    """Write the chart ZIP of a patient to output_path; returns a result dict with the byte count"""
+    tmp_path = output_path + ".part"
+    try:
+        written = 0
+        with open(tmp_path, "wb") as f:
+            for chunk in stream_patient_chart_zip(patient_id, db_file):
+                f.write(chunk)
+                written += len(chunk)
+        os.replace(tmp_path, output_path)
+        return {"success": True, "patient_id": patient_id, "path": output_path, "bytes": written}
+    except Exception as e:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        print(f"Error exporting chart for patient {patient_id}: {str(e)}")
+        print(traceback.format_exc())
+        return {"success": False, "patient_id": patient_id, "error": str(e)}
+
+def export_patients_batch(patient_ids, output_dir, max_workers=4, db_file=None):
+    """Export the charts of many patients in parallel as output_dir/patient_<id>.zip"""
+    os.makedirs(output_dir, exist_ok=True)
+    db_file = db_file or database.current_db_file()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        results = list(pool.map(
+            lambda patient_id: export_patient_chart(
+                patient_id, os.path.join(output_dir, f"patient_{patient_id}.zip"), db_file
+            ),
+            patient_ids
+        ))
+    elapsed = time.perf_counter() - started
+    total_bytes = sum(result.get("bytes", 0) for result in results)
+    return {
+        "success": all(result["success"] for result in results),
+        "exported": sum(1 for result in results if result["success"]),
+        "failed": [result for result in results if not result["success"]],
+        "bytes": total_bytes,
+        "seconds": round(elapsed, 3),
+        "bytes_per_sec": round(total_bytes / elapsed, 1) if elapsed > 0 else 0.0,
+    }
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Export full patient charts as ZIP files")
+    parser.add_argument("patient_ids", nargs="*", type=int, help="patients to export (default: all)")
+    parser.add_argument("--output-dir", default="chart_exports")
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+
+    import sharding
+    if sharding.sharding_enabled():
+        # Each patient is exported from the shard that owns its id
+        ids = args.patient_ids or [row.id for row in sharding.get_all_patients_rows()]
+        per_shard = {}
+        for patient_id in ids:
+            per_shard.setdefault(sharding.shard_for_id(patient_id), []).append(patient_id)
+        for index, shard_ids in sorted(per_shard.items()):
+            print(json.dumps(export_patients_batch(shard_ids, args.output_dir, args.workers, sharding.shard_path(index)), indent=2))
+    else:
+        ids = args.patient_ids or [row.id for row in database.get_all_patients_rows()]
+        print(json.dumps(export_patients_batch(ids, args.output_dir, args.workers), indent=2))
@@ -1,23 +1,97 @@
 import sqlite3
 import os
-import pandas as pd
-from datetime import datetime
+from datetime import datetime, timedelta
 import traceback
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import query_log
 
 # Database file path
 DB_FILE = "medical_records.db"
 
-def init_db():
-    """Initialize the database and create tables if they don't exist"""
-    # Create the database directory if it doesn't exist
-    os.makedirs(os.path.dirname(DB_FILE) if os.path.dirname(DB_FILE) else '.', exist_ok=True)
-    
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    
-    # Create patients table
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS patients (
+# Point MEDICAL_DB_SNAPSHOT at a backup copy (see backup.py) to serve it read-only, e.g. for reporting users
+SNAPSHOT_FILE = os.environ.get("MEDICAL_DB_SNAPSHOT")
+if SNAPSHOT_FILE:
+    DB_FILE = SNAPSHOT_FILE
+
+# Lightweight row types for point lookups (namedtuples carry no per-instance __dict__)
+PatientRow = namedtuple("PatientRow", ["id", "national_id", "name", "date_of_birth", "gender", "phone"])
+MedicalRecordRow = namedtuple("MedicalRecordRow", ["id", "record_date", "blood_pressure", "glucose_level", "temperature", "notes"])
+PatientFileRow = namedtuple("PatientFileRow", ["id", "file_name", "file_path", "upload_date", "file_type", "description"])
+BlobFileRow = namedtuple("BlobFileRow", ["id", "file_name", "file_type", "upload_date", "description", "file_size"])
+
+# Filled by init_db_once() so Streamlit reruns skip schema creation
+_initialized_db_files = set()
+_init_lock = threading.Lock()
+
+# Per-thread database override set by use_database()
+_db_override = threading.local()
+
+def _pd():
+    """Import pandas on first use, so callers that never build a DataFrame don't pay for it"""
+    import pandas
+    return pandas
+
+def current_db_file():
+    """The database file used by this thread: DB_FILE unless overridden with use_database()"""
+    return getattr(_db_override, "path", None) or DB_FILE
+
+@contextmanager
+def use_database(path):
+    """Run the functions of this module against another database file (e.g. a shard) in this thread"""
+    previous = getattr(_db_override, "path", None)
+    _db_override.path = path
+    try:
+        yield
+    finally:
+        _db_override.path = previous
+
+def read_only_mode():
+    """True when running on a snapshot: every connection is read-only and nothing is initialized"""
+    return bool(SNAPSHOT_FILE)
+
+def connect(row_type=None):
+    """Open a connection to the database, optionally returning rows as the given namedtuple type"""
+    if read_only_mode():
+        conn = connect_readonly()
+        conn.execute("PRAGMA query_only = ON")
+    else:
+        conn = sqlite3.connect(current_db_file(), factory=query_log.connection_factory())
+    if row_type is not None:
+        make_row = row_type._make
+        conn.row_factory = lambda cursor, row: make_row(row)
+    return conn
+
+def table_exists(conn, table_name):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (table_name,)).fetchone() is not None
+
+def connect_readonly():
+    """Open the database read-only (no writes, no journal creation), for exports and reporting"""
+    return sqlite3.connect(
+        f"file:{os.path.abspath(current_db_file())}?mode=ro", uri=True, factory=query_log.connection_factory()
+    )
+
+def _fetch_rows(row_type, query, params=()):
+    """Run a query and return its rows as a list of row_type tuples"""
+    conn = connect(row_type)
+    try:
+        return conn.execute(query, params).fetchall()
+    finally:
+        conn.close()
+
+def rows_to_dataframe(rows, row_type):
+    """Build a DataFrame from row tuples, for callers that need tabular output"""
+    return _pd().DataFrame.from_records(rows, columns=row_type._fields)
+
+# Timestamps are stored as integer Unix epochs (UTC). The old "%Y-%m-%d %H:%M:%S" TEXT
+# columns are kept as VIRTUAL generated columns (in UTC) so existing queries still work.
+TABLE_SCHEMAS = {
+    "patients": '''
+    CREATE TABLE IF NOT EXISTS {name} (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         national_id TEXT UNIQUE NOT NULL,
         name TEXT NOT NULL,
@@ -25,52 +99,220 @@ def init_db():
         gender TEXT,
         phone TEXT,
         address TEXT,
-        registration_date TEXT
+        registration_date TEXT GENERATED ALWAYS AS (datetime(registration_ts, 'unixepoch')) VIRTUAL,
+        registration_ts INTEGER
     )
-    ''')
-    
-    # Create medical records table
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS medical_records (
+    ''',
+    "medical_records": '''
+    CREATE TABLE IF NOT EXISTS {name} (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         patient_id INTEGER NOT NULL,
-        record_date TEXT NOT NULL,
+        record_date TEXT GENERATED ALWAYS AS (datetime(record_ts, 'unixepoch')) VIRTUAL,
         blood_pressure TEXT,
         glucose_level REAL,
         temperature REAL,
         notes TEXT,
+        record_ts INTEGER NOT NULL,
         FOREIGN KEY (patient_id) REFERENCES patients (id)
     )
-    ''')
-    
-    # Create files table to store file paths
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS patient_files (
+    ''',
+    # Files table to store file paths
+    "patient_files": '''
+    CREATE TABLE IF NOT EXISTS {name} (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         patient_id INTEGER NOT NULL,
         file_name TEXT NOT NULL,
         file_path TEXT NOT NULL,
-        upload_date TEXT NOT NULL,
+        upload_date TEXT GENERATED ALWAYS AS (datetime(upload_ts, 'unixepoch')) VIRTUAL,
         file_type TEXT,
         description TEXT,
+        upload_ts INTEGER NOT NULL,
         FOREIGN KEY (patient_id) REFERENCES patients (id)
     )
-    ''')
-    
-    # Create files_blob table to store file content in DB (alternative method)
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS patient_files_blob (
+    ''',
+    # Files_blob table to store file content in DB (alternative method)
+    "patient_files_blob": '''
+    CREATE TABLE IF NOT EXISTS {name} (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         patient_id INTEGER NOT NULL,
         file_name TEXT NOT NULL,
         file_type TEXT,
         file_content BLOB,
-        upload_date TEXT NOT NULL,
+        upload_date TEXT GENERATED ALWAYS AS (datetime(upload_ts, 'unixepoch')) VIRTUAL,
         description TEXT,
         file_size INTEGER,
+        upload_ts INTEGER NOT NULL,
         FOREIGN KEY (patient_id) REFERENCES patients (id)
     )
-    ''')
+    ''',
+}
+
+# Table -> (old TEXT date column, new epoch column)
+EPOCH_COLUMNS = {
+    "patients": ("registration_date", "registration_ts"),
+    "medical_records": ("record_date", "record_ts"),
+    "patient_files": ("upload_date", "upload_ts"),
+    "patient_files_blob": ("upload_date", "upload_ts"),
+}
+
+TIME_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS idx_patients_registration_ts ON patients (registration_ts)",
+    "CREATE INDEX IF NOT EXISTS idx_medical_records_patient_ts ON medical_records (patient_id, record_ts)",
+    "CREATE INDEX IF NOT EXISTS idx_patient_files_patient_ts ON patient_files (patient_id, upload_ts)",
+    "CREATE INDEX IF NOT EXISTS idx_patient_files_blob_patient_ts ON patient_files_blob (patient_id, upload_ts)",
+]
+
+# Change data capture: triggers append one row per insert/update/delete to change_log.
+# Rows moved to the yearly archives are logged with operation ARCHIVE instead of DELETE (see archive.py).
+# seq never repeats (AUTOINCREMENT), so it works as a cursor for incremental consumers.
+CHANGE_LOG_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS change_log (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    table_name TEXT NOT NULL,
+    row_id INTEGER NOT NULL,
+    operation TEXT NOT NULL,
+    patient_id INTEGER,
+    change_ts INTEGER NOT NULL
+)
+'''
+
+# Tracked table -> column holding the patient id
+CHANGE_TRACKED_TABLES = {
+    "patients": "id",
+    "medical_records": "patient_id",
+    "patient_files": "patient_id",
+    "patient_files_blob": "patient_id",
+}
+
+def _change_triggers():
+    triggers = []
+    for table_name, patient_column in CHANGE_TRACKED_TABLES.items():
+        for operation, row in (("INSERT", "NEW"), ("UPDATE", "NEW"), ("DELETE", "OLD")):
+            triggers.append(
+                f"CREATE TRIGGER IF NOT EXISTS trg_{table_name}_{operation.lower()}_log AFTER {operation} ON {table_name} "
+                f"BEGIN INSERT INTO change_log (table_name, row_id, operation, patient_id, change_ts) "
+                f"VALUES ('{table_name}', {row}.id, '{operation}', {row}.{patient_column}, CAST(strftime('%s', 'now') AS INTEGER)); END"
+            )
+    return triggers
+
+ChangeRow = namedtuple("ChangeRow", ["seq", "table_name", "row_id", "operation", "patient_id", "change_ts"])
+
+def now_ts():
+    """Current time as an integer Unix epoch"""
+    return int(time.time())
+
+def to_epoch(value):
+    """
+    Convert a datetime, timedelta (meaning "that long ago") or number to an integer epoch.
+    Naive datetimes are taken as local time.
+    """
+    if isinstance(value, timedelta):
+        return int(time.time() - value.total_seconds())
+    if isinstance(value, datetime):
+        return int(value.timestamp())
+    return int(value)
+
+def _table_columns(conn, table_name):
+    return [row[1] for row in conn.execute(f"PRAGMA table_xinfo({table_name})")]
+
+def migrate_timestamps_to_epoch(conn=None, batch_size=5000):
+    """
+    Rebuild tables that still store TEXT dates into the epoch layout of TABLE_SCHEMAS.
+
+    Rows are copied into <table>__epoch in batches of batch_size, each in its own short
+    transaction, so the app keeps reading and writing the old table meanwhile. The final
+    swap copies the remaining tail and renames the table in one transaction. An interrupted
+    migration resumes from the rows already copied. Old TEXT values are local time and are
+    converted to UTC epochs. Returns {table: rows_copied} for the tables that were migrated.
+    """
+    own_conn = conn is None
+    if own_conn:
+        conn = connect()
+    migrated = {}
+    try:
+        for table_name, (date_column, ts_column) in EPOCH_COLUMNS.items():
+            columns = _table_columns(conn, table_name)
+            if not columns or ts_column in columns:
+                continue
+
+            new_table = f"{table_name}__epoch"
+            conn.execute(TABLE_SCHEMAS[table_name].format(name=new_table))
+            conn.commit()
+
+            copy_columns = ", ".join(c for c in columns if c != date_column)
+            # 'utc' treats the stored text as local time and converts it to UTC
+            copy_sql = (
+                f"INSERT INTO {new_table} ({copy_columns}, {ts_column}) "
+                f"SELECT {copy_columns}, COALESCE(CAST(strftime('%s', {date_column}, 'utc') AS INTEGER), 0) "
+                f"FROM {table_name} WHERE id > (SELECT COALESCE(MAX(id), 0) FROM {new_table}) ORDER BY id"
+            )
+
+            copied = 0
+            while True:
+                cursor = conn.execute(copy_sql + " LIMIT ?", (batch_size,))
+                conn.commit()
+                if cursor.rowcount <= 0:
+                    break
+                copied += cursor.rowcount
+
+            # Swap: copy rows written since the last batch, then replace the old table
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                copied += max(conn.execute(copy_sql).rowcount, 0)
+                old_seq = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = ?", (table_name,)).fetchone()
+                conn.execute(f"DROP TABLE {table_name}")
+                conn.execute(f"ALTER TABLE {new_table} RENAME TO {table_name}")
+                if old_seq:
+                    # Keep AUTOINCREMENT from reusing ids of rows deleted before the migration
+                    conn.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = ?", (old_seq[0], table_name))
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+
+            migrated[table_name] = copied
+            print(f"Migrated {table_name} to epoch timestamps ({copied} rows)")
+        return migrated
+    finally:
+        if own_conn:
+            conn.close()
+
+def init_db():
+    """Initialize the database and create tables if they don't exist"""
+    # Create the database directory if it doesn't exist
+    db_file = current_db_file()
+    os.makedirs(os.path.dirname(db_file) if os.path.dirname(db_file) else '.', exist_ok=True)
+    
+    conn = connect()
+    cursor = conn.cursor()
+    
+    # New files get incremental auto-vacuum (no effect once tables exist; see maintenance.py)
+    cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    
+    # Create tables (existing tables in the old TEXT-date layout are migrated below)
+    for table_name in TABLE_SCHEMAS:
+        cursor.execute(TABLE_SCHEMAS[table_name].format(name=table_name))
+    
+    # Move tables still storing TEXT dates to integer epoch columns
+    migrate_timestamps_to_epoch(conn)
+    
+    # Indexes for per-patient time-range scans
+    for index_sql in TIME_INDEXES:
+        cursor.execute(index_sql)
+    
+    # Pages of the patient list (ORDER BY name, id LIMIT/OFFSET) without sorting the table
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_patients_name ON patients (name)")
+    
+    # Change log and its triggers (after the migration, which recreates the tables)
+    cursor.execute(CHANGE_LOG_SCHEMA)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_change_log_row ON change_log (table_name, row_id, seq)")
+    cursor.execute("CREATE TABLE IF NOT EXISTS change_log_state (key TEXT PRIMARY KEY, value INTEGER)")
+    for trigger_sql in _change_triggers():
+        cursor.execute(trigger_sql)
+    
+    # Full-text index of uploaded documents, created here so searches never write
+    import document_index
+    document_index.create_index_tables(conn)
     
     conn.commit()
     conn.close()
@@ -78,6 +320,22 @@ def init_db():
     # Create directory for patient files
     os.makedirs("patient_files", exist_ok=True)
 
+def init_db_once(start_maintenance=False):
+    """
+    Run init_db() once per process (per database file); later calls are a no-op.
+    With start_maintenance=True the first call also starts the background maintenance scheduler.
+    """
+    db_file = current_db_file()
+    if db_file in _initialized_db_files or read_only_mode():
+        return
+    with _init_lock:
+        if db_file not in _initialized_db_files:
+            init_db()
+            _initialized_db_files.add(db_file)
+            if start_maintenance:
+                import maintenance
+                maintenance.start_scheduler([db_file])
+
 def ensure_patient_directory(patient_id):
     """
     Ensure patient directory exists, create it if it doesn't
@@ -89,13 +347,13 @@ def ensure_patient_directory(patient_id):
         # Create main patient_files directory if it doesn't exist
         patient_files_dir = os.path.join(current_dir, "patient_files")
         if not os.path.exists(patient_files_dir):
-            os.makedirs(patient_files_dir)
+            os.makedirs(patient_files_dir, exist_ok=True)
             print(f"Created main directory: {patient_files_dir}")
         
         # Create specific patient directory
         patient_dir = os.path.join(patient_files_dir, f"patient_{patient_id}")
         if not os.path.exists(patient_dir):
-            os.makedirs(patient_dir)
+            os.makedirs(patient_dir, exist_ok=True)
             print(f"Created patient directory: {patient_dir}")
         
         return patient_dir
@@ -105,14 +363,14 @@ def ensure_patient_directory(patient_id):
 
 def add_patient(national_id, name, date_of_birth=None, gender=None, phone=None, address=None):
     """Add a new patient to the database"""
-    conn = sqlite3.connect(DB_FILE)
+    conn = connect()
     cursor = conn.cursor()
     
     try:
-        registration_date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        registration_ts = now_ts()
         cursor.execute(
-            "INSERT INTO patients (national_id, name, date_of_birth, gender, phone, address, registration_date) VALUES (?, ?, ?, ?, ?, ?, ?)",
-            (national_id, name, date_of_birth, gender, phone, address, registration_date)
+            "INSERT INTO patients (national_id, name, date_of_birth, gender, phone, address, registration_ts) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (national_id, name, date_of_birth, gender, phone, address, registration_ts)
         )
         conn.commit()
         patient_id = cursor.lastrowid
@@ -121,7 +379,13 @@ def add_patient(national_id, name, date_of_birth=None, gender=None, phone=None,
         # Create directory for the new patient
         ensure_patient_directory(patient_id)
         
-        return {"success": True, "patient_id": patient_id}
+        # Look for charts of the same person under another national ID (bounded to a few ms)
+        import duplicate_patients
+        possible_duplicates = duplicate_patients.check_new_patient(
+            patient_id, national_id, name, date_of_birth, gender, phone
+        )
+        
+        return {"success": True, "patient_id": patient_id, "possible_duplicates": possible_duplicates}
     except sqlite3.IntegrityError:
         conn.close()
         return {"success": False, "error": "Patient with this national ID already exists"}
@@ -131,7 +395,7 @@ def add_patient(national_id, name, date_of_birth=None, gender=None, phone=None,
 
 def get_patient_by_national_id(national_id):
     """Get patient details by national ID"""
-    conn = sqlite3.connect(DB_FILE)
+    conn = connect()
     cursor = conn.cursor()
     
     cursor.execute("SELECT * FROM patients WHERE national_id = ?", (national_id,))
@@ -150,20 +414,46 @@ def get_patient_by_national_id(national_id):
         conn.close()
         return {"success": False, "error": "Patient not found"}
 
+def get_patient_by_id(patient_id):
+    """Get patient details by patient id"""
+    conn = connect()
+    try:
+        cursor = conn.execute("SELECT * FROM patients WHERE id = ?", (patient_id,))
+        patient = cursor.fetchone()
+        if patient:
+            columns = [desc[0] for desc in cursor.description]
+            return {"success": True, "patient": dict(zip(columns, patient))}
+        return {"success": False, "error": "Patient not found"}
+    finally:
+        conn.close()
+
 def get_all_patients():
     """Get all patients"""
-    conn = sqlite3.connect(DB_FILE)
-    df = pd.read_sql_query("SELECT id, national_id, name, date_of_birth, gender, phone FROM patients ORDER BY name", conn)
+    conn = connect()
+    df = _pd().read_sql_query("SELECT id, national_id, name, date_of_birth, gender, phone FROM patients ORDER BY name", conn)
     conn.close()
     return df
 
+def get_statistics():
+    """Row counts of the main tables"""
+    conn = connect()
+    try:
+        return {
+            "patients": conn.execute("SELECT COUNT(*) FROM patients").fetchone()[0],
+            "medical_records": conn.execute("SELECT COUNT(*) FROM medical_records").fetchone()[0],
+            "patient_files": conn.execute("SELECT COUNT(*) FROM patient_files").fetchone()[0],
+            "blob_files": conn.execute("SELECT COUNT(*) FROM patient_files_blob").fetchone()[0],
+        }
+    finally:
+        conn.close()
+
 def add_medical_record(patient_id, blood_pressure=None, glucose_level=None, temperature=None, notes=None):
     """Add a new medical record for a patient"""
-    conn = sqlite3.connect(DB_FILE)
+    conn = connect()
     cursor = conn.cursor()
     
     try:
-        record_date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        record_ts = now_ts()
         
         # Handle empty values properly
         if glucose_level == 0:
@@ -172,8 +462,8 @@ def add_medical_record(patient_id, blood_pressure=None, glucose_level=None, temp
             temperature = None
             
         cursor.execute(
-            "INSERT INTO medical_records (patient_id, record_date, blood_pressure, glucose_level, temperature, notes) VALUES (?, ?, ?, ?, ?, ?)",
-            (patient_id, record_date, blood_pressure, glucose_level, temperature, notes)
+            "INSERT INTO medical_records (patient_id, record_ts, blood_pressure, glucose_level, temperature, notes) VALUES (?, ?, ?, ?, ?, ?)",
+            (patient_id, record_ts, blood_pressure, glucose_level, temperature, notes)
         )
         conn.commit()
         record_id = cursor.lastrowid
@@ -183,12 +473,14 @@ def add_medical_record(patient_id, blood_pressure=None, glucose_level=None, temp
         conn.close()
         return {"success": False, "error": str(e)}
 
-def get_patient_medical_records(patient_id):
-    """Get all medical records for a patient"""
-    conn = sqlite3.connect(DB_FILE)
+def get_patient_medical_records(patient_id, full_history=False):
+    """Get all medical records for a patient (including archived ones with full_history=True)"""
+    if full_history:
+        return rows_to_dataframe(get_patient_medical_records_rows(patient_id, full_history=True), MedicalRecordRow)
+    conn = connect()
     try:
-        df = pd.read_sql_query(
-            "SELECT id, record_date, blood_pressure, glucose_level, temperature, notes FROM medical_records WHERE patient_id = ? ORDER BY record_date DESC",
+        df = _pd().read_sql_query(
+            "SELECT id, record_date, blood_pressure, glucose_level, temperature, notes FROM medical_records WHERE patient_id = ? ORDER BY record_ts DESC",
             conn, params=(patient_id,)
         )
         conn.close()
@@ -196,61 +488,26 @@ def get_patient_medical_records(patient_id):
     except Exception as e:
         conn.close()
         print(f"Error fetching medical records: {e}")
-        return pd.DataFrame()  # Return empty DataFrame on error
+        return _pd().DataFrame()  # Return empty DataFrame on error
 
 def save_patient_file(patient_id, uploaded_file, description=None):
-    """Save uploaded file information to database and file to disk"""
-    try:
-        # 1. Ensure patient directory exists
-        current_dir = os.getcwd()
-        patient_dir = os.path.join(current_dir, "patient_files", f"patient_{patient_id}")
-        os.makedirs(patient_dir, exist_ok=True)
-        
-        # 2. Generate unique filename with timestamp
-        timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-        file_name = uploaded_file.name
-        file_type = file_name.split(".")[-1] if "." in file_name else ""
-        safe_filename = f"{timestamp}_{file_name}"
-        file_path = os.path.join(patient_dir, safe_filename)
-        
-        # 3. Write file to disk
-        with open(file_path, "wb") as f:
-            f.write(uploaded_file.getbuffer())
-        
-        # 4. Verify file was created
-        if os.path.exists(file_path):
-            # 5. Save file information to database
-            upload_date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            
-            conn = sqlite3.connect(DB_FILE)
-            cursor = conn.cursor()
-            cursor.execute(
-                "INSERT INTO patient_files (patient_id, file_name, file_path, upload_date, file_type, description) VALUES (?, ?, ?, ?, ?, ?)",
-                (patient_id, file_name, file_path, upload_date, file_type, description)
-            )
-            conn.commit()
-            file_id = cursor.lastrowid
-            conn.close()
-            
-            return {"success": True, "file_id": file_id, "file_path": file_path}
-        else:
-            return {"success": False, "error": "File was not saved to disk properly"}
-    
-    except Exception as e:
-        print(f"Exception in save_patient_file: {str(e)}")
-        print(traceback.format_exc())
-        return {"success": False, "error": str(e)}
+    """
+    Save an uploaded file: small files as a BLOB in patient_files_blob, larger ones on disk
+    with a patient_files row (see storage.SizePolicy for the threshold)
+    """
+    import storage
+    return storage.save_file(patient_id, uploaded_file, description)
 
 def get_patient_files(patient_id):
     """Get all files for a patient"""
     # Ensure patient directory exists
     patient_dir = ensure_patient_directory(patient_id)
     
-    conn = sqlite3.connect(DB_FILE)
+    conn = connect()
     try:
         # Get files from database
-        df = pd.read_sql_query(
-            "SELECT id, file_name, file_path, upload_date, file_type, description FROM patient_files WHERE patient_id = ? ORDER BY upload_date DESC",
+        df = _pd().read_sql_query(
+            "SELECT id, file_name, file_path, upload_date, file_type, description FROM patient_files WHERE patient_id = ? ORDER BY upload_ts DESC",
             conn, params=(patient_id,)
         )
         conn.close()
@@ -259,13 +516,119 @@ def get_patient_files(patient_id):
         conn.close()
         print(f"Error fetching patient files: {e}")
         print(traceback.format_exc())
-        return pd.DataFrame()  # Return empty DataFrame on error
+        return _pd().DataFrame()  # Return empty DataFrame on error
+
+def _write_upload(file_path, uploaded_file):
+    with open(file_path, "wb") as f:
+        f.write(uploaded_file.getbuffer())
+    return os.path.getsize(file_path)
+
+def save_patient_files_batch(patient_id, uploaded_files, description=None, max_workers=4):
+    """
+    Save several uploaded files for a patient at once.
+    Each file goes to the backend the storage size policy picks: large files are written to
+    disk concurrently, then all patient_files rows and the small files (as patient_files_blob
+    rows) are inserted in one transaction. All or nothing: on any failure the written files
+    are removed and no row is kept.
+    """
+    import storage
+    started = time.perf_counter()
+    written_paths = []
+    try:
+        blob_uploads = []
+        disk_uploads = []
+        for uploaded_file in uploaded_files:
+            if storage.DEFAULT_POLICY.backend_for(len(uploaded_file.getbuffer())) is storage.BLOB:
+                blob_uploads.append(uploaded_file)
+            else:
+                disk_uploads.append(uploaded_file)
+        
+        current_dir = os.getcwd()
+        patient_dir = os.path.join(current_dir, "patient_files", f"patient_{patient_id}")
+        os.makedirs(patient_dir, exist_ok=True)
+        
+        # Unique target path per file (several files may share a name within the same second)
+        timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
+        targets = []
+        used_names = set()
+        for uploaded_file in disk_uploads:
+            file_name = uploaded_file.name
+            safe_filename = f"{timestamp}_{file_name}"
+            counter = 1
+            while safe_filename in used_names or os.path.exists(os.path.join(patient_dir, safe_filename)):
+                safe_filename = f"{timestamp}_{counter}_{file_name}"
+                counter += 1
+            used_names.add(safe_filename)
+            targets.append((uploaded_file, os.path.join(patient_dir, safe_filename)))
+        
+        # Write all files in parallel
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = [(file_path, pool.submit(_write_upload, file_path, uploaded_file)) for uploaded_file, file_path in targets]
+            sizes = []
+            errors = []
+            for file_path, future in futures:
+                try:
+                    sizes.append(future.result())
+                    written_paths.append(file_path)
+                except Exception as e:
+                    errors.append(f"{os.path.basename(file_path)}: {str(e)}")
+                    if os.path.exists(file_path):
+                        written_paths.append(file_path)
+        if errors:
+            raise IOError("Failed to write " + "; ".join(errors))
+        sizes.extend(len(uploaded_file.getbuffer()) for uploaded_file in blob_uploads)
+        
+        # Insert every row in a single transaction
+        upload_ts = now_ts()
+        conn = connect()
+        try:
+            file_ids = []
+            for uploaded_file, file_path in targets:
+                file_name = uploaded_file.name
+                file_type = file_name.split(".")[-1] if "." in file_name else ""
+                cursor = conn.execute(
+                    "INSERT INTO patient_files (patient_id, file_name, file_path, upload_ts, file_type, description) VALUES (?, ?, ?, ?, ?, ?)",
+                    (patient_id, file_name, file_path, upload_ts, file_type, description)
+                )
+                file_ids.append(cursor.lastrowid)
+            blob_file_ids = [
+                storage.write_upload(conn, storage.BLOB, patient_id, uploaded_file, description, upload_ts)[0]
+                for uploaded_file in blob_uploads
+            ]
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        
+        elapsed = time.perf_counter() - started
+        total_bytes = sum(sizes)
+        return {
+            "success": True,
+            "file_ids": file_ids,
+            "file_paths": [file_path for _, file_path in targets],
+            "blob_file_ids": blob_file_ids,
+            "files": len(file_ids) + len(blob_file_ids),
+            "bytes": total_bytes,
+            "seconds": round(elapsed, 3),
+            "mb_per_sec": round(total_bytes / (1024 * 1024) / elapsed, 2) if elapsed > 0 else 0.0,
+        }
+    except Exception as e:
+        for file_path in written_paths:
+            try:
+                os.remove(file_path)
+            except OSError:
+                pass
+        print(f"Exception in save_patient_files_batch: {str(e)}")
+        print(traceback.format_exc())
+        return {"success": False, "error": str(e)}
 
 # وظائف التصحيح
 
 def debug_database():
     """وظيفة للتحقق من حالة قاعدة البيانات وعرض جميع البيانات الموجودة"""
-    conn = sqlite3.connect(DB_FILE)
+    conn = connect()
     cursor = conn.cursor()
     
     # التحقق من وجود الجداول
@@ -385,14 +748,14 @@ def save_patient_file_debug(patient_id, uploaded_file, description=None):
             return {"success": False, "error": "لم يتم حفظ الملف على القرص بشكل صحيح"}
         
         # 7. حفظ معلومات الملف في قاعدة البيانات
-        conn = sqlite3.connect(DB_FILE)
+        conn = connect()
         cursor = conn.cursor()
         
-        upload_date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        upload_ts = now_ts()
         
         cursor.execute(
-            "INSERT INTO patient_files (patient_id, file_name, file_path, upload_date, file_type, description) VALUES (?, ?, ?, ?, ?, ?)",
-            (patient_id, file_name, file_path, upload_date, file_type, description)
+            "INSERT INTO patient_files (patient_id, file_name, file_path, upload_ts, file_type, description) VALUES (?, ?, ?, ?, ?, ?)",
+            (patient_id, file_name, file_path, upload_ts, file_type, description)
         )
         conn.commit()
         file_id = cursor.lastrowid
@@ -428,7 +791,7 @@ def get_patient_files_debug(patient_id):
     if os.path.exists(patient_dir):
         print(f"محتويات دليل المريض: {os.listdir(patient_dir)}")
     
-    conn = sqlite3.connect(DB_FILE)
+    conn = connect()
     try:
         # الحصول على الملفات من قاعدة البيانات
         cursor = conn.cursor()
@@ -443,8 +806,8 @@ def get_patient_files_debug(patient_id):
                 print(f"  ID: {record[0]}, الاسم: {record[2]}, المسار: {record[3]}")
                 print(f"  الملف موجود: {os.path.exists(record[3])}")
         
-        df = pd.read_sql_query(
-            "SELECT id, file_name, file_path, upload_date, file_type, description FROM patient_files WHERE patient_id = ? ORDER BY upload_date DESC",
+        df = _pd().read_sql_query(
+            "SELECT id, file_name, file_path, upload_date, file_type, description FROM patient_files WHERE patient_id = ? ORDER BY upload_ts DESC",
             conn, params=(patient_id,)
         )
         conn.close()
@@ -461,7 +824,7 @@ def get_patient_files_debug(patient_id):
         conn.close()
         print(f"خطأ في استرجاع ملفات المريض: {e}")
         print(traceback.format_exc())
-        return pd.DataFrame()  # إرجاع DataFrame فارغ عند وجود خطأ
+        return _pd().DataFrame()  # إرجاع DataFrame فارغ عند وجود خطأ
 
 # وظيفة لتخزين الملفات في قاعدة البيانات كـ BLOB
 def save_file_to_blob(patient_id, uploaded_file, description=None):
@@ -471,19 +834,19 @@ def save_file_to_blob(patient_id, uploaded_file, description=None):
         file_content = uploaded_file.getbuffer()
         file_name = uploaded_file.name
         file_type = file_name.split(".")[-1] if "." in file_name else ""
-        upload_date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        upload_ts = now_ts()
         file_size = len(file_content)
         
         print(f"حفظ الملف في قاعدة البيانات: {file_name}، الحجم: {file_size} بايت")
         
         # إنشاء اتصال بقاعدة البيانات
-        conn = sqlite3.connect(DB_FILE)
+        conn = connect()
         cursor = conn.cursor()
         
         # إدخال الملف في قاعدة البيانات
         cursor.execute(
-            "INSERT INTO patient_files_blob (patient_id, file_name, file_type, file_content, upload_date, description, file_size) VALUES (?, ?, ?, ?, ?, ?, ?)",
-            (patient_id, file_name, file_type, file_content, upload_date, description, file_size)
+            "INSERT INTO patient_files_blob (patient_id, file_name, file_type, file_content, upload_ts, description, file_size) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (patient_id, file_name, file_type, file_content, upload_ts, description, file_size)
         )
         
         conn.commit()
@@ -500,11 +863,11 @@ def save_file_to_blob(patient_id, uploaded_file, description=None):
 
 def get_blob_files(patient_id):
     """استرجاع قائمة ملفات المريض من قاعدة البيانات BLOB"""
-    conn = sqlite3.connect(DB_FILE)
+    conn = connect()
     try:
         # استرجاع معلومات الملفات (بدون محتوى الملفات)
-        df = pd.read_sql_query(
-            "SELECT id, file_name, file_type, upload_date, description, file_size FROM patient_files_blob WHERE patient_id = ? ORDER BY upload_date DESC",
+        df = _pd().read_sql_query(
+            "SELECT id, file_name, file_type, upload_date, description, file_size FROM patient_files_blob WHERE patient_id = ? ORDER BY upload_ts DESC",
             conn, params=(patient_id,)
         )
         conn.close()
@@ -515,12 +878,12 @@ def get_blob_files(patient_id):
         conn.close()
         print(f"خطأ في استرجاع ملفات المريض من قاعدة البيانات BLOB: {e}")
         print(traceback.format_exc())
-        return pd.DataFrame()  # إرجاع DataFrame فارغ عند وجود خطأ
+        return _pd().DataFrame()  # إرجاع DataFrame فارغ عند وجود خطأ
 
 def get_blob_content(file_id):
     """استرجاع محتوى ملف محدد من قاعدة البيانات BLOB"""
     try:
-        conn = sqlite3.connect(DB_FILE)
+        conn = connect()
         cursor = conn.cursor()
         
         # استرجاع محتوى الملف ومعلوماته
@@ -539,9 +902,227 @@ def get_blob_content(file_id):
                 "file_type": file_data[1],
                 "file_content": file_data[2]
             }
-        else:
-            return {"success": False, "error": "الملف غير موجود"}
+        
+        # الملف ربما نُقل إلى الأرشيف السنوي
+        import archive
+        archived = archive.get_archived_blob_content(file_id)
+        if archived:
+            return archived
+        return {"success": False, "error": "الملف غير موجود"}
     except Exception as e:
         print(f"خطأ في استرجاع محتوى الملف: {str(e)}")
         print(traceback.format_exc())
-        return {"success": False, "error": str(e)}
\ No newline at end of file
+        return {"success": False, "error": str(e)}
+
+# واجهة الصفوف الخفيفة: نفس الاستعلامات أعلاه ولكن بدون بناء DataFrame
+
+def get_all_patients_rows():
+    """Get all patients as a list of PatientRow"""
+    return _fetch_rows(
+        PatientRow,
+        "SELECT id, national_id, name, date_of_birth, gender, phone FROM patients ORDER BY name"
+    )
+
+def get_patients_page_rows(offset=0, limit=50):
+    """One page of the patient list (ordered by name, then id) as a list of PatientRow"""
+    return _fetch_rows(
+        PatientRow,
+        "SELECT id, national_id, name, date_of_birth, gender, phone FROM patients ORDER BY name, id LIMIT ? OFFSET ?",
+        (limit, offset)
+    )
+
+def count_patients():
+    """Number of registered patients"""
+    conn = connect()
+    try:
+        return conn.execute("SELECT COUNT(*) FROM patients").fetchone()[0]
+    finally:
+        conn.close()
+
+def get_patient_medical_records_rows(patient_id, full_history=False):
+    """
+    Get all medical records for a patient as a list of MedicalRecordRow.
+    With full_history=True, records moved to the yearly archives are included too.
+    """
+    try:
+        if full_history:
+            import archive
+            return archive.get_full_history_records(patient_id)
+        return _fetch_rows(
+            MedicalRecordRow,
+            "SELECT id, record_date, blood_pressure, glucose_level, temperature, notes FROM medical_records WHERE patient_id = ? ORDER BY record_ts DESC",
+            (patient_id,)
+        )
+    except Exception as e:
+        print(f"Error fetching medical records: {e}")
+        return []
+
+def get_patient_file(file_id):
+    """Get one patient_files row by file id"""
+    conn = connect()
+    try:
+        cursor = conn.execute(
+            "SELECT id, patient_id, file_name, file_path, upload_date, file_type, description FROM patient_files WHERE id = ?",
+            (file_id,)
+        )
+        row = cursor.fetchone()
+        if row:
+            return {"success": True, "file": dict(zip([desc[0] for desc in cursor.description], row))}
+        return {"success": False, "error": "File not found"}
+    finally:
+        conn.close()
+
+def get_patient_files_rows(patient_id):
+    """Get all files for a patient as a list of PatientFileRow"""
+    try:
+        return _fetch_rows(
+            PatientFileRow,
+            "SELECT id, file_name, file_path, upload_date, file_type, description FROM patient_files WHERE patient_id = ? ORDER BY upload_ts DESC",
+            (patient_id,)
+        )
+    except Exception as e:
+        print(f"Error fetching patient files: {e}")
+        return []
+
+def get_blob_files_rows(patient_id, full_history=False):
+    """
+    Get the BLOB file list for a patient (without content) as a list of BlobFileRow.
+    With full_history=True, files moved to the yearly archives are listed after the hot ones.
+    """
+    try:
+        rows = _fetch_rows(
+            BlobFileRow,
+            "SELECT id, file_name, file_type, upload_date, description, file_size FROM patient_files_blob WHERE patient_id = ? ORDER BY upload_ts DESC",
+            (patient_id,)
+        )
+        if full_history:
+            import archive
+            # Skip archived copies of files that are still hot (interrupted archive run)
+            hot_ids = {row.id for row in rows}
+            rows.extend(row for row in archive.get_archived_blob_files(patient_id) if row.id not in hot_ids)
+        return rows
+    except Exception as e:
+        print(f"Error fetching BLOB files: {e}")
+        return []
+
+def get_records_between(patient_id, start, end):
+    """
+    Get a patient's medical records with start <= record time < end, newest first.
+    start/end may be datetimes, timedeltas (that long ago) or epoch seconds.
+    Served by a range scan on idx_medical_records_patient_ts.
+    """
+    return _fetch_rows(
+        MedicalRecordRow,
+        "SELECT id, record_date, blood_pressure, glucose_level, temperature, notes FROM medical_records WHERE patient_id = ? AND record_ts >= ? AND record_ts < ? ORDER BY record_ts DESC",
+        (patient_id, to_epoch(start), to_epoch(end))
+    )
+
+def get_records_since(patient_id, since):
+    """Get a patient's medical records from `since` until now, e.g. get_records_since(pid, timedelta(hours=24))"""
+    return _fetch_rows(
+        MedicalRecordRow,
+        "SELECT id, record_date, blood_pressure, glucose_level, temperature, notes FROM medical_records WHERE patient_id = ? AND record_ts >= ? ORDER BY record_ts DESC",
+        (patient_id, to_epoch(since))
+    )
+
+# Change data capture
+
+def changes_since(seq=0, limit=1000):
+    """
+    Return up to `limit` ChangeRow entries with a seq greater than `seq`, oldest first.
+    Consumers keep the seq of the last entry they handled and pass it to the next call;
+    an empty list means they are up to date. Entries carry keys only, so the current state
+    of a row is read from its table (a DELETE means the row is gone, an ARCHIVE that it was
+    moved unchanged to the yearly archives).
+    """
+    return _fetch_rows(
+        ChangeRow,
+        "SELECT seq, table_name, row_id, operation, patient_id, change_ts FROM change_log WHERE seq > ? ORDER BY seq LIMIT ?",
+        (seq, limit)
+    )
+
+def iter_changes(seq=0, batch_size=1000):
+    """Yield batches of changes after `seq` until the end of the log"""
+    while True:
+        batch = changes_since(seq, batch_size)
+        if not batch:
+            return
+        yield batch
+        seq = batch[-1].seq
+
+def change_log_bounds():
+    """
+    first_seq/last_seq of the entries in the log and truncated_through, the highest seq
+    dropped by compaction. A consumer whose cursor is below truncated_through has missed
+    changes and must re-read the tables in full.
+    """
+    conn = connect()
+    try:
+        first_seq, last_seq, entries = conn.execute("SELECT MIN(seq), MAX(seq), COUNT(*) FROM change_log").fetchone()
+        row = conn.execute("SELECT value FROM change_log_state WHERE key = 'truncated_through'").fetchone()
+        return {
+            "first_seq": first_seq or 0,
+            "last_seq": last_seq or 0,
+            "entries": entries,
+            "truncated_through": row[0] if row else 0,
+        }
+    finally:
+        conn.close()
+
+def compact_change_log(collapse_after_days=1, drop_after_days=90, batch_size=5000, deadline=None):
+    """
+    Compact old segments of the change log, a batch of seqs per transaction:
+    - entries older than collapse_after_days are removed when a later entry exists for the
+      same row, so a lagging consumer still sees the last change of every row;
+    - entries older than drop_after_days are removed entirely (truncated_through is raised).
+    With a deadline (a time.perf_counter() value) it stops between batches once it has
+    passed; "complete" is False then and the next run carries on.
+    """
+    conn = connect()
+    collapsed = 0
+    dropped = 0
+    complete = True
+    try:
+        collapse_before = now_ts() - collapse_after_days * 86400
+        drop_before = now_ts() - drop_after_days * 86400
+        end_seq = conn.execute("SELECT MAX(seq) FROM change_log WHERE change_ts < ?", (collapse_before,)).fetchone()[0]
+        start_seq = conn.execute("SELECT MIN(seq) FROM change_log").fetchone()[0]
+        if end_seq is not None:
+            for low in range(start_seq, end_seq + 1, batch_size):
+                if deadline is not None and time.perf_counter() > deadline:
+                    complete = False
+                    break
+                high = min(low + batch_size, end_seq + 1)
+                collapsed += conn.execute(
+                    """
+                    DELETE FROM change_log WHERE seq >= ? AND seq < ? AND EXISTS (
+                        SELECT 1 FROM change_log later
+                        WHERE later.table_name = change_log.table_name AND later.row_id = change_log.row_id AND later.seq > change_log.seq
+                    )
+                    """,
+                    (low, high)
+                ).rowcount
+                conn.commit()
+
+        drop_through = conn.execute("SELECT MAX(seq) FROM change_log WHERE change_ts < ?", (drop_before,)).fetchone()[0]
+        if complete and drop_through is not None:
+            for low in range(start_seq, drop_through + 1, batch_size):
+                if deadline is not None and time.perf_counter() > deadline:
+                    complete = False
+                    break
+                high = min(low + batch_size, drop_through + 1)
+                dropped += conn.execute("DELETE FROM change_log WHERE seq >= ? AND seq < ?", (low, high)).rowcount
+                conn.execute(
+                    "INSERT INTO change_log_state (key, value) VALUES ('truncated_through', ?) "
+                    "ON CONFLICT(key) DO UPDATE SET value = MAX(value, excluded.value)",
+                    (high - 1,)
+                )
+                conn.commit()
+        return {"success": True, "collapsed": collapsed, "dropped": dropped, "complete": complete}
+    except Exception as e:
+        conn.rollback()
+        print(f"Error compacting change log: {str(e)}")
+        print(traceback.format_exc())
+        return {"success": False, "error": str(e), "collapsed": collapsed, "dropped": dropped}
+    finally:
+        conn.close()
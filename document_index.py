@@ -0,0 +1,400 @@
+"""
+Full-text search over the content of uploaded files (TXT, DOCX and PDF).
+
+Text is extracted in a process pool and stored in an FTS5 table (document_text) inside the
+main database, with one row per file in document_index (both created by database.init_db).
+Each entry keeps a signature of the file (size and mtime on disk, size and upload time for
+BLOBs), so a re-run only extracts new or changed files and drops entries whose file row is
+gone. After an upload only the new files are extracted. Searching only reads the index,
+never the files themselves.
+
+Run from the project root:
+    python document_index.py [--workers 4] [--full]
+    python document_index.py --search "hba1c" [--patient-id 12]
+
+PDF text is read with pypdf when it is installed, otherwise with a small built-in reader
+that handles plain (uncompressed or Flate) text streams. Files moved to the yearly archives
+are not indexed.
+"""
+import html
+import io
+import json
+import multiprocessing
+import os
+import re
+import threading
+import time
+import traceback
+import zipfile
+import zlib
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import database
+
+# File types (extensions, as stored in file_type) whose text can be extracted
+INDEXED_TYPES = ("txt", "docx", "pdf")
+
+# Cap on the text kept per file, so one huge upload does not bloat the index
+MAX_TEXT_CHARS = 2 * 1024 * 1024
+
+DocumentHit = namedtuple("DocumentHit", ["source", "file_id", "patient_id", "file_name", "snippet", "score"])
+
+_background_thread = None
+_background_lock = threading.Lock()
+# Database file -> set of (source, file_id) keys waiting for the background thread, or None for a full scan
+_background_queue = {}
+
+def create_index_tables(conn):
+    """Create the index tables if needed (called from database.init_db; not committed here)"""
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS document_index (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        source TEXT NOT NULL,
+        file_id INTEGER NOT NULL,
+        patient_id INTEGER NOT NULL,
+        file_name TEXT,
+        signature TEXT NOT NULL,
+        chars INTEGER NOT NULL DEFAULT 0,
+        error TEXT,
+        indexed_ts INTEGER NOT NULL,
+        UNIQUE (source, file_id)
+    )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_document_index_patient ON document_index (patient_id)")
+    # rowid of document_text = document_index.id
+    conn.execute(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS document_text USING fts5(file_name, content, tokenize = 'unicode61 remove_diacritics 2')"
+    )
+
+# Text extraction (runs in worker processes)
+
+def _text_from_txt(data):
+    try:
+        return data.decode("utf-8")
+    except UnicodeDecodeError:
+        return data.decode("cp1256", errors="replace")
+
+def _text_from_docx(path_or_file):
+    with zipfile.ZipFile(path_or_file) as docx:
+        xml = docx.read("word/document.xml").decode("utf-8", errors="replace")
+    xml = re.sub(r"</w:p>|<w:br/>|<w:tab/>", "\n", xml)
+    return html.unescape(re.sub(r"<[^>]+>", "", xml))
+
+_PDF_STREAM = re.compile(rb"<<(.*?)>>\s*stream\r?\n(.*?)\r?\nendstream", re.S)
+_PDF_TEXT_BLOCK = re.compile(rb"BT(.*?)ET", re.S)
+_PDF_STRING = re.compile(rb"\((?:\\.|[^\\)])*\)")
+
+def _pdf_unescape(literal):
+    body = literal[1:-1]
+    body = re.sub(rb"\\([nrtbf()\\])", lambda m: {b"n": b"\n", b"r": b"\r", b"t": b"\t", b"b": b"", b"f": b""}.get(m.group(1), m.group(1)), body)
+    body = re.sub(rb"\\([0-7]{1,3})", lambda m: bytes([int(m.group(1), 8) & 0xFF]), body)
+    return body.decode("latin-1")
+
+def _text_from_pdf_fallback(data):
+    """Pull the strings shown by Tj/TJ operators out of the page content streams"""
+    parts = []
+    for header, stream in _PDF_STREAM.findall(data):
+        if b"/FlateDecode" in header:
+            try:
+                stream = zlib.decompress(stream)
+            except zlib.error:
+                continue
+        elif b"/Filter" in header:
+            continue
+        for block in _PDF_TEXT_BLOCK.findall(stream):
+            line = "".join(_pdf_unescape(literal) for literal in _PDF_STRING.findall(block))
+            if line.strip():
+                parts.append(line)
+    return "\n".join(parts)
+
+def _text_from_pdf(data):
+    try:
+        import pypdf
+    except ImportError:
+        return _text_from_pdf_fallback(data)
+    reader = pypdf.PdfReader(io.BytesIO(data))
+    return "\n".join(page.extract_text() or "" for page in reader.pages)
+
+def extract_text(file_type, path=None, content=None):
+    """Return the text of a file given its path on disk or its bytes"""
+    if content is None:
+        with open(path, "rb") as f:
+            content = f.read()
+    file_type = (file_type or "").lower()
+    if file_type == "txt":
+        text = _text_from_txt(content)
+    elif file_type == "docx":
+        text = _text_from_docx(io.BytesIO(content))
+    elif file_type == "pdf":
+        text = _text_from_pdf(content)
+    else:
+        raise ValueError(f"Unsupported file type: {file_type}")
+    return re.sub(r"[ \t\r\f\v]+", " ", text).strip()[:MAX_TEXT_CHARS]
+
+def _extract_task(task):
+    """Worker entry point: (key, file_type, path, content) -> (key, text, error)"""
+    key, file_type, path, content = task
+    try:
+        return key, extract_text(file_type, path, content), None
+    except Exception as e:
+        return key, "", f"{type(e).__name__}: {str(e)}"
+
+# Indexing
+
+def _id_filter(keys, source):
+    """SQL condition (and its parameters) limiting a scan of source to the given keys"""
+    if keys is None:
+        return "", []
+    file_ids = sorted(file_id for key_source, file_id in keys if key_source == source)
+    return f" AND id IN ({','.join('?' * len(file_ids))})", file_ids
+
+def _pending_files(conn, indexed, full, keys=None):
+    """
+    Yield (key, patient_id, file_name, file_type, signature, path, needs_blob) for files that
+    are new or changed since they were indexed, only among keys when given
+    """
+    placeholders = ",".join("?" * len(INDEXED_TYPES))
+    id_condition, id_params = _id_filter(keys, "patient_files")
+    for file_id, patient_id, file_name, file_type, file_path in conn.execute(
+        f"SELECT id, patient_id, file_name, file_type, file_path FROM patient_files WHERE lower(file_type) IN ({placeholders}){id_condition} ORDER BY id",
+        list(INDEXED_TYPES) + id_params
+    ).fetchall():
+        try:
+            stat = os.stat(file_path)
+            signature = f"{stat.st_size}:{stat.st_mtime_ns}"
+        except OSError:
+            signature = "missing"
+        key = ("patient_files", file_id)
+        if full or indexed.get(key) != signature:
+            yield key, patient_id, file_name, file_type, signature, file_path, False
+
+    id_condition, id_params = _id_filter(keys, "patient_files_blob")
+    for file_id, patient_id, file_name, file_type, size, upload_ts in conn.execute(
+        f"SELECT id, patient_id, file_name, file_type, length(file_content), upload_ts FROM patient_files_blob WHERE lower(file_type) IN ({placeholders}){id_condition} ORDER BY id",
+        list(INDEXED_TYPES) + id_params
+    ).fetchall():
+        signature = f"{size}:{upload_ts}"
+        key = ("patient_files_blob", file_id)
+        if full or indexed.get(key) != signature:
+            yield key, patient_id, file_name, file_type, signature, None, True
+
+def _purge_deleted(conn):
+    """Drop index entries whose file row no longer exists"""
+    stale = [row[0] for row in conn.execute('''
+        SELECT id FROM document_index d
+        WHERE (d.source = 'patient_files' AND NOT EXISTS (SELECT 1 FROM patient_files f WHERE f.id = d.file_id))
+           OR (d.source = 'patient_files_blob' AND NOT EXISTS (SELECT 1 FROM patient_files_blob b WHERE b.id = d.file_id))
+    ''')]
+    if stale:
+        conn.executemany("DELETE FROM document_text WHERE rowid = ?", [(doc_id,) for doc_id in stale])
+        conn.executemany("DELETE FROM document_index WHERE id = ?", [(doc_id,) for doc_id in stale])
+        conn.commit()
+    return len(stale)
+
+def _store_results(conn, batch, results):
+    indexed_ts = database.now_ts()
+    stored = 0
+    failed = []
+    for key, text, error in results:
+        patient_id, file_name, signature = batch[key]
+        source, file_id = key
+        row = conn.execute("SELECT id FROM document_index WHERE source = ? AND file_id = ?", key).fetchone()
+        if row:
+            doc_id = row[0]
+            conn.execute("DELETE FROM document_text WHERE rowid = ?", (doc_id,))
+            conn.execute(
+                "UPDATE document_index SET patient_id = ?, file_name = ?, signature = ?, chars = ?, error = ?, indexed_ts = ? WHERE id = ?",
+                (patient_id, file_name, signature, len(text), error, indexed_ts, doc_id)
+            )
+        else:
+            doc_id = conn.execute(
+                "INSERT INTO document_index (source, file_id, patient_id, file_name, signature, chars, error, indexed_ts) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (source, file_id, patient_id, file_name, signature, len(text), error, indexed_ts)
+            ).lastrowid
+        if text:
+            conn.execute("INSERT INTO document_text (rowid, file_name, content) VALUES (?, ?, ?)", (doc_id, file_name, text))
+            stored += 1
+        if error:
+            failed.append({"source": source, "file_id": file_id, "file_name": file_name, "error": error})
+    conn.commit()
+    return stored, failed
+
+def index_documents(max_workers=4, full=False, batch_size=32, keys=None):
+    """
+    Extract and index the text of new or changed uploads in the current database.
+    With full=True every supported file is extracted again; with keys (a list of
+    (source, file_id), source being patient_files or patient_files_blob) only those files
+    are. Returns a result dict with counts and the files that could not be read.
+    """
+    started = time.perf_counter()
+    files_indexed = 0
+    files_seen = 0
+    errors = []
+    conn = database.connect()
+    try:
+        create_index_tables(conn)
+        conn.commit()
+        if keys is None:
+            removed = _purge_deleted(conn)
+            indexed = {
+                (source, file_id): signature
+                for source, file_id, signature in conn.execute("SELECT source, file_id, signature FROM document_index")
+            }
+        else:
+            # Files just uploaded: extract them without reading the rest of the index
+            removed = 0
+            indexed = {}
+
+        # Spawned workers: forking from the app's threads (Streamlit, the background indexer)
+        # could copy a lock held by another thread into the child
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+            pending = _pending_files(conn, indexed, full, keys)
+            while True:
+                batch = {}
+                tasks = []
+                for key, patient_id, file_name, file_type, signature, path, needs_blob in pending:
+                    content = None
+                    if needs_blob:
+                        content = conn.execute("SELECT file_content FROM patient_files_blob WHERE id = ?", (key[1],)).fetchone()[0]
+                        content = bytes(content) if content is not None else b""
+                    batch[key] = (patient_id, file_name, signature)
+                    tasks.append((key, file_type, path, content))
+                    if len(tasks) >= batch_size:
+                        break
+                if not tasks:
+                    break
+                files_seen += len(tasks)
+                stored, failed = _store_results(conn, batch, pool.map(_extract_task, tasks))
+                files_indexed += stored
+                errors.extend(failed)
+
+        elapsed = time.perf_counter() - started
+        return {
+            "success": True,
+            "files_processed": files_seen,
+            "files_indexed": files_indexed,
+            "entries_removed": removed,
+            "errors": errors,
+            "seconds": round(elapsed, 3),
+        }
+    except Exception as e:
+        print(f"Error indexing documents: {str(e)}")
+        print(traceback.format_exc())
+        return {"success": False, "error": str(e), "files_processed": files_seen, "files_indexed": files_indexed}
+    finally:
+        conn.close()
+
+def _run_background_queue(max_workers):
+    global _background_thread
+    while True:
+        with _background_lock:
+            if not _background_queue:
+                _background_thread = None
+                return
+            db_file, keys = _background_queue.popitem()
+        with database.use_database(db_file):
+            index_documents(max_workers=max_workers, keys=None if keys is None else sorted(keys))
+
+def start_background_indexing(db_files=None, max_workers=2, keys=None):
+    """
+    Index uploads of db_files (default: the current database) in a background thread.
+    keys lists the (source, file_id) of the new files; without keys every new or changed
+    file is looked for. Requests made during a run are queued for the same thread.
+    Returns False on a read-only snapshot.
+    """
+    global _background_thread
+    if database.read_only_mode():
+        return False
+    db_files = db_files or [database.current_db_file()]
+    with _background_lock:
+        for db_file in db_files:
+            if keys is None:
+                _background_queue[db_file] = None
+            elif db_file not in _background_queue:
+                _background_queue[db_file] = set(keys)
+            elif _background_queue[db_file] is not None:
+                _background_queue[db_file].update(keys)
+        if _background_thread is None:
+            _background_thread = threading.Thread(
+                target=_run_background_queue, args=(max_workers,), name="document-indexer", daemon=True
+            )
+            _background_thread.start()
+    return True
+
+def upload_keys(result):
+    """Index keys of the files saved by database.save_patient_files_batch"""
+    return ([("patient_files", file_id) for file_id in result.get("file_ids", [])]
+            + [("patient_files_blob", file_id) for file_id in result.get("blob_file_ids", [])])
+
+# Search
+
+def _match_expression(query):
+    """Turn free text into an FTS5 query: every word must match, the last one as a prefix"""
+    terms = [term.replace('"', '""') for term in re.findall(r"\w+", query or "")]
+    if not terms:
+        return None
+    return " ".join(f'"{term}"' for term in terms[:-1]) + (" " if len(terms) > 1 else "") + f'"{terms[-1]}"*'
+
+def search_documents(query, patient_id=None, limit=20):
+    """
+    Return DocumentHit rows for files whose name or text matches query, best match first,
+    optionally limited to one patient. Only the index is read.
+    """
+    match = _match_expression(query)
+    if match is None:
+        return []
+    conn = database.connect()
+    try:
+        if not database.table_exists(conn, "document_text"):
+            # Read-only snapshot of a database initialized before the index existed
+            return []
+        sql = '''
+            SELECT d.source, d.file_id, d.patient_id, d.file_name,
+                   snippet(document_text, 1, '**', '**', ' … ', 16), bm25(document_text, 5.0, 1.0) AS score
+            FROM document_text
+            JOIN document_index d ON d.id = document_text.rowid
+            WHERE document_text MATCH ?
+        '''
+        params = [match]
+        if patient_id is not None:
+            sql += " AND d.patient_id = ?"
+            params.append(patient_id)
+        sql += " ORDER BY score LIMIT ?"
+        params.append(limit)
+        return [DocumentHit._make(row) for row in conn.execute(sql, params)]
+    finally:
+        conn.close()
+
+def get_index_status():
+    """Counts of indexed files, failed extractions and indexed characters"""
+    conn = database.connect()
+    try:
+        if not database.table_exists(conn, "document_text"):
+            return {"files": 0, "failed": 0, "chars": 0}
+        files, failed, chars = conn.execute(
+            "SELECT COUNT(*), COUNT(error), COALESCE(SUM(chars), 0) FROM document_index"
+        ).fetchone()
+        return {"files": files, "failed": failed, "chars": chars}
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Index the text of uploaded files for full-text search")
+    parser.add_argument("--workers", type=int, default=4, help="extraction processes")
+    parser.add_argument("--full", action="store_true", help="extract every file again")
+    parser.add_argument("--search", help="search the index instead of updating it")
+    parser.add_argument("--patient-id", type=int)
+    args = parser.parse_args()
+
+    import sharding
+    if args.search:
+        search = sharding.search_documents if sharding.sharding_enabled() else search_documents
+        for hit in search(args.search, args.patient_id):
+            print(json.dumps(hit._asdict(), ensure_ascii=False))
+    else:
+        for db_file in sharding.shard_paths() if sharding.sharding_enabled() else [database.DB_FILE]:
+            with database.use_database(db_file):
+                print(db_file, json.dumps(index_documents(args.workers, args.full), indent=2, ensure_ascii=False))
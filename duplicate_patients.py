@@ -0,0 +1,475 @@
+"""
+Duplicate-patient detection: charts of the same person under different national IDs.
+
+Run from the project root:
+    python duplicate_patients.py [--workers 4] [--min-score 0.7] [--top 50]
+
+Comparing every pair of patients does not scale, so patients are grouped by blocking keys
+kept in the patient_blocking_keys table:
+    name:   phonetic key (Soundex) of the first and last word of the name
+    namey:  the same with the year of birth (still selective when a name is common)
+    dob:    date of birth
+    phone:  last 7 digits of the phone number
+Only patients sharing a key are compared, and blocks larger than MAX_BLOCK_SIZE (a very
+common name, a placeholder phone) are skipped. Pairs are scored in worker processes on name
+similarity (Jaro-Winkler), date of birth, phone, national IDs one typo apart and gender;
+pairs scoring at least MIN_SCORE are stored in duplicate_candidates, best first.
+
+add_patient() runs check_new_patient() on every new patient: it adds the patient's keys and
+compares them against the patients in the same blocks, within a budget of a few milliseconds.
+In sharded mode both the full run and the check in add_patient compare across all shards
+(the keys of each patient are kept in its own shard).
+"""
+import json
+import re
+import time
+import traceback
+import unicodedata
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+import database
+
+MIN_SCORE = 0.7
+MAX_BLOCK_SIZE = 200
+# Time add_patient may spend looking for duplicates of a new patient
+CHECK_BUDGET_MS = 5.0
+# Pairs per task sent to a worker process; smaller runs are scored in this process
+COMPARE_CHUNK_SIZE = 5000
+
+PATIENT_COLUMNS = "id, national_id, name, date_of_birth, gender, phone"
+
+_SOUNDEX_CODES = {}
+for _letters, _digit in (("bfpv", "1"), ("cgjkqsxz", "2"), ("dt", "3"), ("l", "4"), ("mn", "5"), ("r", "6")):
+    for _letter in _letters:
+        _SOUNDEX_CODES[_letter] = _digit
+
+def _ensure_tables(conn):
+    """Create the duplicate tables if needed; False on a read-only snapshot taken before any run"""
+    if database.read_only_mode():
+        return database.table_exists(conn, "duplicate_candidates")
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS patient_blocking_keys (
+        key TEXT NOT NULL,
+        patient_id INTEGER NOT NULL,
+        PRIMARY KEY (key, patient_id)
+    ) WITHOUT ROWID
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_patient_blocking_keys_patient ON patient_blocking_keys (patient_id)")
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS duplicate_candidates (
+        patient_a INTEGER NOT NULL,
+        patient_b INTEGER NOT NULL,
+        score REAL NOT NULL,
+        reasons TEXT,
+        found_ts INTEGER NOT NULL,
+        status TEXT NOT NULL DEFAULT 'open',
+        PRIMARY KEY (patient_a, patient_b)
+    )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_duplicate_candidates_score ON duplicate_candidates (status, score)")
+    conn.execute("CREATE TABLE IF NOT EXISTS duplicate_state (key TEXT PRIMARY KEY, value INTEGER)")
+    conn.commit()
+    return True
+
+# Normalization and blocking keys
+
+def _name_words(name):
+    """Lower-case words of a name without accents or punctuation"""
+    name = unicodedata.normalize("NFKD", name or "")
+    name = "".join(ch for ch in name if not unicodedata.combining(ch))
+    return re.findall(r"\w+", name.casefold())
+
+def soundex(word):
+    """Soundex code of a Latin word; other scripts keep their first four letters"""
+    if not word:
+        return ""
+    if not word.isascii():
+        return word[:4]
+    first = word[0]
+    codes = [first.upper()]
+    previous = _SOUNDEX_CODES.get(first)
+    for ch in word[1:]:
+        code = _SOUNDEX_CODES.get(ch)
+        if code and code != previous:
+            codes.append(code)
+            if len(codes) == 4:
+                break
+        if ch not in "hw":
+            previous = code
+    return "".join(codes).ljust(4, "0")
+
+def _digits(value):
+    return "".join(ch for ch in str(value or "") if ch.isdigit())
+
+def blocking_keys(name, date_of_birth, phone):
+    """The blocking keys of a patient"""
+    keys = []
+    words = _name_words(name)
+    if words:
+        name_key = soundex(words[0]) + (soundex(words[-1]) if len(words) > 1 else "")
+        keys.append(f"name:{name_key}")
+        if date_of_birth:
+            keys.append(f"namey:{name_key}:{str(date_of_birth)[:4]}")
+    if date_of_birth:
+        keys.append(f"dob:{date_of_birth}")
+    phone_digits = _digits(phone)
+    if len(phone_digits) >= 7:
+        keys.append(f"phone:{phone_digits[-7:]}")
+    return keys
+
+# Pair scoring (runs in worker processes)
+
+def _jaro_winkler(a, b):
+    if a == b:
+        return 1.0
+    if not a or not b:
+        return 0.0
+    window = max(max(len(a), len(b)) // 2 - 1, 0)
+    b_matched = [False] * len(b)
+    a_chars = []
+    for i, ch in enumerate(a):
+        end = i + window + 1
+        # str.find keeps the scan of the match window in C
+        j = b.find(ch, max(0, i - window), end)
+        while j != -1 and b_matched[j]:
+            j = b.find(ch, j + 1, end)
+        if j != -1:
+            b_matched[j] = True
+            a_chars.append(ch)
+    matches = len(a_chars)
+    if not matches:
+        return 0.0
+    b_chars = [ch for ch, matched in zip(b, b_matched) if matched]
+    transpositions = sum(ch_a != ch_b for ch_a, ch_b in zip(a_chars, b_chars)) / 2
+    jaro = (matches / len(a) + matches / len(b) + (matches - transpositions) / matches) / 3
+    prefix = 0
+    for ch_a, ch_b in zip(a[:4], b[:4]):
+        if ch_a != ch_b:
+            break
+        prefix += 1
+    return jaro + prefix * 0.1 * (1 - jaro)
+
+def _one_edit_apart(a, b):
+    """True if a and b differ by one substitution, insertion, deletion or swap of neighbours"""
+    if a == b or abs(len(a) - len(b)) > 1:
+        return False
+    if len(a) > len(b):
+        a, b = b, a
+    i = 0
+    while i < len(a) and a[i] == b[i]:
+        i += 1
+    if len(a) < len(b):
+        return a[i:] == b[i + 1:]
+    if a[i + 1:] == b[i + 1:]:
+        return True
+    return i + 1 < len(a) and a[i] == b[i + 1] and a[i + 1] == b[i] and a[i + 2:] == b[i + 2:]
+
+def _prepare(row):
+    """
+    A patient (tuple of PATIENT_COLUMNS) normalized once for scoring: (id, national_id,
+    date_of_birth, gender, phone suffix, name words, name words sorted)
+    """
+    patient_id, national_id, name, date_of_birth, gender, phone = row
+    words = _name_words(name)
+    phone_digits = _digits(phone)
+    return (
+        patient_id, str(national_id or ""), str(date_of_birth or ""), gender or "",
+        phone_digits[-7:] if len(phone_digits) >= 7 else "", " ".join(words), " ".join(sorted(words)),
+    )
+
+def _score_prepared(a, b, min_score=0.0):
+    """(score, reasons) of two prepared patients; (0.0, None) once min_score is out of reach"""
+    score = 0.0
+    reasons = []
+    if a[2] and b[2]:
+        if a[2] == b[2]:
+            score += 0.25
+            reasons.append("same date of birth")
+        elif _one_edit_apart(a[2], b[2]):
+            score += 0.1
+            reasons.append("date of birth one typo apart")
+        else:
+            score -= 0.15
+    if a[4] and a[4] == b[4]:
+        score += 0.15
+        reasons.append("same phone")
+    if _one_edit_apart(a[1], b[1]):
+        score += 0.2
+        reasons.append("national IDs one typo apart")
+    if a[3] and b[3] and a[3] != b[3]:
+        score -= 0.2
+        reasons.append("different gender")
+    # The name is worth at most 0.5: skip the costly comparison when that cannot be enough
+    if score + 0.5 < min_score:
+        return 0.0, None
+
+    # Jaro-Winkler of the names as written, or with the words sorted (swapped first/family name)
+    name_score = _jaro_winkler(a[5], b[5])
+    if name_score < 1.0 and (a[5] != a[6] or b[5] != b[6]):
+        name_score = max(name_score, _jaro_winkler(a[6], b[6]))
+    score += 0.5 * name_score
+    reasons.insert(0, f"name {name_score:.2f}")
+    return round(min(max(score, 0.0), 1.0), 4), reasons
+
+def score_pair(a, b):
+    """
+    Score two patients (tuples of PATIENT_COLUMNS) from 0 to 1 on name, date of birth,
+    phone, national ID and gender. Returns (score, reasons).
+    """
+    return _score_prepared(_prepare(a), _prepare(b))
+
+def _score_chunk(pairs, min_score):
+    """Score pairs of prepared patients; returns (id_a, id_b, score, reasons) of pairs above min_score"""
+    found = []
+    for a, b in pairs:
+        score, reasons = _score_prepared(a, b, min_score)
+        if score >= min_score:
+            found.append((a[0], b[0], score, reasons))
+    return found
+
+# Full run
+
+def _rebuild_keys(conn):
+    """Replace the blocking keys of every patient in one database; returns [(key, patient_id)] and the prepared patients"""
+    rows = conn.execute(f"SELECT {PATIENT_COLUMNS} FROM patients").fetchall()
+    keys = [(key, row[0]) for row in rows for key in blocking_keys(row[2], row[3], row[5])]
+    conn.execute("DELETE FROM patient_blocking_keys")
+    conn.executemany("INSERT OR IGNORE INTO patient_blocking_keys (key, patient_id) VALUES (?, ?)", keys)
+    conn.execute(
+        "INSERT OR REPLACE INTO duplicate_state (key, value) VALUES ('index_built_ts', ?)", (database.now_ts(),)
+    )
+    conn.commit()
+    return keys, {row[0]: _prepare(row) for row in rows}
+
+def find_duplicates(db_files=None, max_workers=4, min_score=MIN_SCORE):
+    """
+    Rebuild the blocking keys, compare the patients within each block and store the pairs
+    scoring at least min_score in duplicate_candidates (in the database holding the first
+    patient of the pair). Pairs dismissed earlier stay dismissed. db_files defaults to the
+    current database; pass every shard to compare across shards.
+    """
+    started = time.perf_counter()
+    db_files = db_files or [database.current_db_file()]
+    try:
+        blocks = defaultdict(list)
+        patients = {}
+        owner = {}
+        for db_file in db_files:
+            with database.use_database(db_file):
+                conn = database.connect()
+                try:
+                    _ensure_tables(conn)
+                    keys, db_patients = _rebuild_keys(conn)
+                finally:
+                    conn.close()
+            patients.update(db_patients)
+            owner.update((patient_id, db_file) for patient_id in db_patients)
+            for key, patient_id in keys:
+                blocks[key].append(patient_id)
+
+        pairs = set()
+        skipped_blocks = 0
+        for members in blocks.values():
+            if len(members) > MAX_BLOCK_SIZE:
+                skipped_blocks += 1
+                continue
+            members.sort()
+            for i, patient_a in enumerate(members):
+                for patient_b in members[i + 1:]:
+                    pairs.add((patient_a, patient_b))
+
+        pair_rows = [(patients[a], patients[b]) for a, b in pairs]
+        chunks = [pair_rows[i:i + COMPARE_CHUNK_SIZE] for i in range(0, len(pair_rows), COMPARE_CHUNK_SIZE)]
+        found = []
+        if max_workers > 1 and len(chunks) > 1:
+            with ProcessPoolExecutor(max_workers=max_workers) as pool:
+                for chunk_found in pool.map(_score_chunk, chunks, [min_score] * len(chunks)):
+                    found.extend(chunk_found)
+        else:
+            for chunk in chunks:
+                found.extend(_score_chunk(chunk, min_score))
+
+        found_ts = database.now_ts()
+        by_db = defaultdict(list)
+        for patient_a, patient_b, score, reasons in found:
+            by_db[owner[patient_a]].append((patient_a, patient_b, score, json.dumps(reasons), found_ts))
+        for db_file in db_files:
+            with database.use_database(db_file):
+                conn = database.connect()
+                try:
+                    conn.execute("DELETE FROM duplicate_candidates WHERE status = 'open'")
+                    conn.executemany(
+                        "INSERT OR IGNORE INTO duplicate_candidates (patient_a, patient_b, score, reasons, found_ts) VALUES (?, ?, ?, ?, ?)",
+                        by_db[db_file]
+                    )
+                    conn.commit()
+                finally:
+                    conn.close()
+
+        seconds = time.perf_counter() - started
+        return {
+            "success": True,
+            "patients": len(patients),
+            "blocks": len(blocks),
+            "skipped_blocks": skipped_blocks,
+            "pairs_compared": len(pairs),
+            "candidates": len(found),
+            "seconds": round(seconds, 3),
+        }
+    except Exception as e:
+        print(f"Error finding duplicate patients: {str(e)}")
+        print(traceback.format_exc())
+        return {"success": False, "error": str(e)}
+
+# Incremental check for add_patient
+
+def _check_db_files():
+    """Databases a new patient is compared against: every shard in sharded mode, as a typo in
+    the national ID usually puts the second chart in another shard"""
+    import sharding
+    if sharding.sharding_enabled():
+        return sharding.shard_paths()
+    return [database.current_db_file()]
+
+def check_new_patient(patient_id, national_id, name, date_of_birth=None, gender=None, phone=None,
+                      budget_ms=CHECK_BUDGET_MS, min_score=MIN_SCORE):
+    """
+    Add a new patient's blocking keys and return likely duplicates among the patients sharing
+    a block (in any shard), best first: [{"patient_id", "national_id", "name", "score", "reasons"}].
+    Stops comparing when budget_ms is used up. Does nothing until find_duplicates() has built
+    the index once.
+    """
+    deadline = time.perf_counter() + budget_ms / 1000.0
+    current_db = database.current_db_file()
+    conn = database.connect()
+    conns = {current_db: conn}
+    try:
+        index_built = database.table_exists(conn, "duplicate_state") and conn.execute(
+            "SELECT 1 FROM duplicate_state WHERE key = 'index_built_ts'"
+        ).fetchone() is not None
+        if not index_built or database.read_only_mode():
+            return []
+        keys = blocking_keys(name, date_of_birth, phone)
+        conn.executemany(
+            "INSERT OR IGNORE INTO patient_blocking_keys (key, patient_id) VALUES (?, ?)",
+            [(key, patient_id) for key in keys]
+        )
+        conn.commit()
+
+        # Members of each block, over all databases; blocks too large in total are skipped
+        blocks = defaultdict(list)
+        for db_file in _check_db_files():
+            if db_file not in conns:
+                with database.use_database(db_file):
+                    conns[db_file] = database.connect()
+            if not database.table_exists(conns[db_file], "patient_blocking_keys"):
+                continue
+            for key in keys:
+                blocks[key].extend((db_file, row[0]) for row in conns[db_file].execute(
+                    "SELECT patient_id FROM patient_blocking_keys WHERE key = ? LIMIT ?", (key, MAX_BLOCK_SIZE + 1)
+                ))
+        shared_blocks = defaultdict(int)
+        for members in blocks.values():
+            if len(members) <= MAX_BLOCK_SIZE:
+                for member in members:
+                    shared_blocks[member] += 1
+        shared_blocks.pop((current_db, patient_id), None)
+        # Patients sharing the most blocks first, so they are scored before the budget runs out
+        candidates = sorted(shared_blocks, key=lambda member: -shared_blocks[member])
+
+        new_patient = _prepare((patient_id, national_id, name, date_of_birth, gender, phone))
+        found = []
+        for start in range(0, len(candidates), 500):
+            if time.perf_counter() > deadline:
+                break
+            batch_ids = defaultdict(list)
+            for db_file, member_id in candidates[start:start + 500]:
+                batch_ids[db_file].append(member_id)
+            for db_file, ids in batch_ids.items():
+                rows = conns[db_file].execute(
+                    f"SELECT {PATIENT_COLUMNS} FROM patients WHERE id IN ({','.join('?' * len(ids))})", ids
+                ).fetchall()
+                for row in rows:
+                    if time.perf_counter() > deadline:
+                        break
+                    score, reasons = _score_prepared(_prepare(row), new_patient, min_score)
+                    if score >= min_score:
+                        found.append((row, score, reasons))
+
+        # Stored with the new patient, whichever shard the other chart is in
+        found_ts = database.now_ts()
+        conn.executemany(
+            "INSERT OR IGNORE INTO duplicate_candidates (patient_a, patient_b, score, reasons, found_ts) VALUES (?, ?, ?, ?, ?)",
+            [(min(row[0], patient_id), max(row[0], patient_id), score, json.dumps(reasons), found_ts)
+             for row, score, reasons in found]
+        )
+        conn.commit()
+        found.sort(key=lambda item: item[1], reverse=True)
+        return [
+            {"patient_id": row[0], "national_id": row[1], "name": row[2], "score": score, "reasons": reasons}
+            for row, score, reasons in found
+        ]
+    except Exception as e:
+        # Never let the check fail the registration itself
+        print(f"Error checking new patient for duplicates: {str(e)}")
+        return []
+    finally:
+        for db_conn in conns.values():
+            db_conn.close()
+
+# Results
+
+def get_duplicate_candidates(limit=50, db_files=None, status="open"):
+    """Stored candidate pairs with both patients' details, best score first"""
+    candidates = []
+    for db_file in db_files or [database.current_db_file()]:
+        with database.use_database(db_file):
+            conn = database.connect()
+            try:
+                if not _ensure_tables(conn):
+                    continue
+                rows = conn.execute(
+                    "SELECT patient_a, patient_b, score, reasons, datetime(found_ts, 'unixepoch') FROM duplicate_candidates "
+                    "WHERE status = ? ORDER BY score DESC LIMIT ?",
+                    (status, limit)
+                ).fetchall()
+            finally:
+                conn.close()
+        for patient_a, patient_b, score, reasons, found_date in rows:
+            candidates.append({
+                "patient_a": patient_a, "patient_b": patient_b, "score": score,
+                "reasons": ", ".join(json.loads(reasons or "[]")), "found_date": found_date, "db_file": db_file,
+            })
+    candidates.sort(key=lambda candidate: candidate["score"], reverse=True)
+    return candidates[:limit]
+
+def dismiss_candidate(patient_a, patient_b, db_file=None):
+    """Mark a pair as not a duplicate, so later runs do not report it again"""
+    with database.use_database(db_file or database.current_db_file()):
+        conn = database.connect()
+        try:
+            _ensure_tables(conn)
+            cursor = conn.execute(
+                "UPDATE duplicate_candidates SET status = 'dismissed' WHERE patient_a = ? AND patient_b = ?",
+                (min(patient_a, patient_b), max(patient_a, patient_b))
+            )
+            conn.commit()
+            return {"success": cursor.rowcount > 0}
+        finally:
+            conn.close()
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Find patients that are probably registered twice")
+    parser.add_argument("--workers", type=int, default=4, help="processes comparing pairs")
+    parser.add_argument("--min-score", type=float, default=MIN_SCORE)
+    parser.add_argument("--top", type=int, default=50, help="candidates to print")
+    args = parser.parse_args()
+
+    import sharding
+    db_files = sharding.shard_paths() if sharding.sharding_enabled() else None
+    print(json.dumps(find_duplicates(db_files, args.workers, args.min_score), indent=2))
+    for candidate in get_duplicate_candidates(args.top, db_files):
+        print(json.dumps(candidate, ensure_ascii=False))
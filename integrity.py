@@ -0,0 +1,260 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import database
+
+# Checkpoint database holding the last verified state of every file
+CHECKPOINT_FILE = "integrity_checkpoint.db"
+# Machine-readable report of the last run
+REPORT_FILE = "integrity_report.json"
+# Root directory of the file store on disk
+FILES_ROOT = "patient_files"
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    """Compute the SHA-256 of a file, reading it in chunks"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _normalize_path(path):
+    return os.path.normcase(os.path.abspath(path))
+
+def _open_checkpoint(checkpoint_path):
+    conn = sqlite3.connect(checkpoint_path)
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS file_state (
+        file_id INTEGER PRIMARY KEY,
+        file_path TEXT NOT NULL,
+        file_size INTEGER,
+        mtime_ns INTEGER,
+        sha256 TEXT,
+        verified_at TEXT
+    )
+    ''')
+    conn.execute("CREATE TEMP TABLE known_paths (file_id INTEGER PRIMARY KEY, norm_path TEXT)")
+    conn.execute("CREATE TEMP TABLE disk_paths (norm_path TEXT PRIMARY KEY, file_path TEXT)")
+    conn.commit()
+    return conn
+
+def _check_file(file_id, file_path, previous, full):
+    """
+    Check one file against its previous checkpoint state.
+    `previous` is (file_path, file_size, mtime_ns, sha256) or None.
+    Returns a dict with the new state and a status:
+    ok, new, changed, missing, unchanged (skipped) or error.
+    """
+    result = {"file_id": file_id, "file_path": file_path}
+    try:
+        st = os.stat(file_path)
+    except FileNotFoundError:
+        result["status"] = "missing"
+        return result
+    except OSError as e:
+        result["status"] = "error"
+        result["error"] = str(e)
+        return result
+
+    result["file_size"] = st.st_size
+    result["mtime_ns"] = st.st_mtime_ns
+
+    same_stat = (
+        previous is not None
+        and previous[0] == file_path
+        and previous[1] == st.st_size
+        and previous[2] == st.st_mtime_ns
+        and previous[3] is not None
+    )
+    if same_stat and not full:
+        result["sha256"] = previous[3]
+        result["status"] = "unchanged"
+        return result
+
+    try:
+        result["sha256"] = file_sha256(file_path)
+    except OSError as e:
+        result["status"] = "error"
+        result["error"] = str(e)
+        return result
+
+    if previous is None or previous[3] is None:
+        result["status"] = "new"
+    elif previous[3] != result["sha256"]:
+        result["status"] = "changed"
+        result["previous_sha256"] = previous[3]
+        result["previous_size"] = previous[1]
+    else:
+        result["status"] = "ok"
+    return result
+
+def _scan_disk(checkpoint, files_root, batch_size):
+    """Record every file under files_root in the disk_paths temp table"""
+    batch = []
+    stack = [files_root]
+    while stack:
+        directory = stack.pop()
+        try:
+            entries = list(os.scandir(directory))
+        except OSError:
+            continue
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                stack.append(entry.path)
+            elif entry.is_file(follow_symlinks=False):
+                batch.append((_normalize_path(entry.path), entry.path))
+                if len(batch) >= batch_size:
+                    checkpoint.executemany("INSERT OR IGNORE INTO disk_paths VALUES (?, ?)", batch)
+                    batch = []
+    if batch:
+        checkpoint.executemany("INSERT OR IGNORE INTO disk_paths VALUES (?, ?)", batch)
+
+def _iter_file_rows(db_files, batch_size):
+    """Yield batches of (id, file_path) rows of patient_files, database by database, in id order"""
+    for db_file in db_files:
+        with database.use_database(db_file):
+            conn = database.connect()
+        try:
+            last_id = 0
+            while True:
+                rows = conn.execute(
+                    "SELECT id, file_path FROM patient_files WHERE id > ? ORDER BY id LIMIT ?",
+                    (last_id, batch_size)
+                ).fetchall()
+                if not rows:
+                    break
+                last_id = rows[-1][0]
+                yield rows
+        finally:
+            conn.close()
+
+def verify_file_store(max_workers=8, full=False, batch_size=1000,
+                      checkpoint_path=CHECKPOINT_FILE, report_path=REPORT_FILE, files_root=FILES_ROOT, db_files=None):
+    """
+    Verify every patient_files row of db_files (default: the current database; every shard
+    in sharded mode, as they share the file store) against the file store.
+
+    Checks existence, size and SHA-256 of each file in a thread pool, detects rows whose
+    file is missing and files on disk that have no row. Progress is checkpointed per batch,
+    so later runs only re-hash files whose size or mtime changed (pass full=True to re-hash
+    everything). Returns the report dict and writes it to report_path as JSON.
+    """
+    started = time.perf_counter()
+    counts = {"ok": 0, "new": 0, "changed": 0, "missing": 0, "unchanged": 0, "error": 0}
+    issues = {"missing": [], "changed": [], "errors": []}
+    files_checked = 0
+    bytes_hashed = 0
+
+    checkpoint = _open_checkpoint(checkpoint_path)
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            for rows in _iter_file_rows(db_files or [database.current_db_file()], batch_size):
+                last_id = rows[-1][0]
+
+                previous = {
+                    row[0]: row[1:]
+                    for row in checkpoint.execute(
+                        "SELECT file_id, file_path, file_size, mtime_ns, sha256 FROM file_state WHERE file_id BETWEEN ? AND ?",
+                        (rows[0][0], last_id)
+                    )
+                }
+                checkpoint.executemany(
+                    "INSERT OR REPLACE INTO known_paths VALUES (?, ?)",
+                    [(file_id, _normalize_path(file_path)) for file_id, file_path in rows]
+                )
+
+                results = pool.map(
+                    lambda row: _check_file(row[0], row[1], previous.get(row[0]), full),
+                    rows
+                )
+
+                verified_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                updates = []
+                for result in results:
+                    files_checked += 1
+                    status = result["status"]
+                    counts[status] += 1
+                    if status == "missing":
+                        issues["missing"].append({"file_id": result["file_id"], "file_path": result["file_path"]})
+                    elif status == "error":
+                        issues["errors"].append({"file_id": result["file_id"], "file_path": result["file_path"], "error": result["error"]})
+                    else:
+                        if status == "changed":
+                            issues["changed"].append({
+                                "file_id": result["file_id"],
+                                "file_path": result["file_path"],
+                                "previous_size": result["previous_size"],
+                                "file_size": result["file_size"],
+                                "previous_sha256": result["previous_sha256"],
+                                "sha256": result["sha256"],
+                            })
+                        if status != "unchanged":
+                            bytes_hashed += result["file_size"]
+                        updates.append((result["file_id"], result["file_path"], result["file_size"],
+                                        result["mtime_ns"], result["sha256"], verified_at))
+
+                checkpoint.executemany("INSERT OR REPLACE INTO file_state VALUES (?, ?, ?, ?, ?, ?)", updates)
+                checkpoint.commit()
+
+        # Forget rows that no longer exist in the database
+        checkpoint.execute("DELETE FROM file_state WHERE file_id NOT IN (SELECT file_id FROM known_paths)")
+        checkpoint.commit()
+
+        # Files on disk that no row points to
+        _scan_disk(checkpoint, files_root, batch_size)
+        orphaned = [
+            row[0] for row in checkpoint.execute(
+                "SELECT file_path FROM disk_paths WHERE norm_path NOT IN (SELECT norm_path FROM known_paths) ORDER BY file_path"
+            )
+        ]
+    finally:
+        checkpoint.close()
+
+    elapsed = time.perf_counter() - started
+    report = {
+        "generated_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "duration_seconds": round(elapsed, 3),
+        "mode": "full" if full else "incremental",
+        "workers": max_workers,
+        "files_checked": files_checked,
+        "bytes_hashed": bytes_hashed,
+        "counts": dict(counts, orphaned=len(orphaned)),
+        "missing": issues["missing"],
+        "changed": issues["changed"],
+        "errors": issues["errors"],
+        "orphaned": orphaned,
+    }
+
+    if report_path:
+        try:
+            with open(report_path, "w", encoding="utf-8") as f:
+                json.dump(report, f, indent=2, ensure_ascii=False)
+        except OSError as e:
+            print(f"Error writing integrity report: {str(e)}")
+            print(traceback.format_exc())
+
+    return report
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Verify the patient file store against the database")
+    parser.add_argument("--workers", type=int, default=8, help="number of checker threads")
+    parser.add_argument("--full", action="store_true", help="re-hash every file, ignoring the checkpoint")
+    parser.add_argument("--report", default=REPORT_FILE, help="path of the JSON report")
+    args = parser.parse_args()
+
+    import sharding
+    db_files = sharding.shard_paths() if sharding.sharding_enabled() else None
+    result = verify_file_store(max_workers=args.workers, full=args.full, report_path=args.report, db_files=db_files)
+    print(json.dumps(result["counts"], indent=2))
+    print(f"Report written to {args.report}")
@@ -0,0 +1,279 @@
+"""
+Database maintenance: query planner statistics, incremental vacuum and WAL checkpoints.
+
+Run from the project root (for example nightly from cron):
+    python maintenance.py [--budget-seconds 30]
+    python maintenance.py --convert    # one-time switch to auto_vacuum=INCREMENTAL and WAL
+
+A run refreshes statistics with PRAGMA optimize (a bounded ANALYZE the first time),
+compacts old change_log segments, returns free pages to the file system with PRAGMA
+incremental_vacuum and checkpoints the WAL in PASSIVE mode, so it never waits on readers or
+writers. Every step stops when the time budget is used up. File size, freelist pages and
+fragmentation are recorded before and after each run in the maintenance_runs table.
+
+Converting an existing file rewrites it with a full VACUUM, so do it while the app is idle;
+new database files are created with auto_vacuum=INCREMENTAL already.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+import traceback
+from datetime import datetime
+
+import database
+
+DEFAULT_BUDGET_SECONDS = 30
+# Pages released per incremental_vacuum call; the budget is checked between calls
+VACUUM_STEP_PAGES = 256
+# Rows sampled per index by ANALYZE (PRAGMA analysis_limit)
+ANALYSIS_LIMIT = 1000
+DEFAULT_INTERVAL_SECONDS = 6 * 3600
+# Fragmentation needs a walk over every page (dbstat); skip it above this size
+FRAGMENTATION_SCAN_MAX_PAGES = 256 * 1024
+
+AUTO_VACUUM_MODES = {0: "none", 1: "full", 2: "incremental"}
+
+_scheduler_thread = None
+_scheduler_lock = threading.Lock()
+
+def _ensure_history_table(conn):
+    """Create maintenance_runs if needed; False on a read-only snapshot taken before any run"""
+    if database.read_only_mode():
+        return database.table_exists(conn, "maintenance_runs")
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS maintenance_runs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        run_ts INTEGER NOT NULL,
+        seconds REAL,
+        success INTEGER NOT NULL,
+        report TEXT
+    )
+    ''')
+    conn.commit()
+    return True
+
+def _fragmentation(conn, page_count):
+    """Share of b-tree pages that do not directly follow the previous page of the same tree"""
+    if page_count > FRAGMENTATION_SCAN_MAX_PAGES:
+        return None
+    try:
+        rows = conn.execute("SELECT name, pageno FROM dbstat ORDER BY name, path").fetchall()
+    except sqlite3.OperationalError:
+        # SQLite built without the dbstat virtual table
+        return None
+    out_of_order = 0
+    previous_name, previous_page = None, None
+    for name, pageno in rows:
+        if name == previous_name and pageno != previous_page + 1:
+            out_of_order += 1
+        previous_name, previous_page = name, pageno
+    return round(out_of_order / len(rows), 4) if rows else 0.0
+
+def database_stats(conn=None):
+    """File size, page counts, free space and fragmentation of the current database"""
+    own_conn = conn is None
+    conn = conn or database.connect()
+    try:
+        db_file = database.current_db_file()
+        page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+        page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+        freelist_pages = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        wal_file = db_file + "-wal"
+        return {
+            "file_bytes": os.path.getsize(db_file) if os.path.exists(db_file) else 0,
+            "wal_bytes": os.path.getsize(wal_file) if os.path.exists(wal_file) else 0,
+            "page_size": page_size,
+            "page_count": page_count,
+            "freelist_pages": freelist_pages,
+            "free_bytes": freelist_pages * page_size,
+            "free_ratio": round(freelist_pages / page_count, 4) if page_count else 0.0,
+            "fragmentation": _fragmentation(conn, page_count),
+            "auto_vacuum": AUTO_VACUUM_MODES.get(conn.execute("PRAGMA auto_vacuum").fetchone()[0], "unknown"),
+            "journal_mode": conn.execute("PRAGMA journal_mode").fetchone()[0],
+        }
+    finally:
+        if own_conn:
+            conn.close()
+
+def convert_database():
+    """
+    Switch the current database to auto_vacuum=INCREMENTAL (with a full VACUUM) and WAL
+    journaling. Does nothing for settings that are already in place.
+    """
+    started = time.perf_counter()
+    conn = database.connect()
+    try:
+        before = database_stats(conn)
+        if before["auto_vacuum"] != "incremental":
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            conn.execute("VACUUM")
+        if before["journal_mode"] != "wal":
+            conn.execute("PRAGMA journal_mode = WAL")
+        after = database_stats(conn)
+        return {"success": True, "before": before, "after": after, "seconds": round(time.perf_counter() - started, 3)}
+    except Exception as e:
+        print(f"Error converting database: {str(e)}")
+        print(traceback.format_exc())
+        return {"success": False, "error": str(e)}
+    finally:
+        conn.close()
+
+def _checkpoint(conn):
+    if conn.execute("PRAGMA journal_mode").fetchone()[0] != "wal":
+        return {"skipped": "not in WAL mode"}
+    busy, wal_frames, checkpointed = conn.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchone()
+    return {"busy": bool(busy), "wal_frames": wal_frames, "checkpointed_frames": checkpointed}
+
+def _optimize(conn, deadline):
+    """Refresh planner statistics, interrupted if it runs past the deadline"""
+    conn.set_progress_handler(lambda: int(time.perf_counter() > deadline), 10000)
+    try:
+        conn.execute(f"PRAGMA analysis_limit = {ANALYSIS_LIMIT}")
+        analyzed_before = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sqlite_stat1'"
+        ).fetchone()
+        if analyzed_before:
+            # 0x10002: look at every table, not just the ones queried on this connection
+            conn.execute("PRAGMA optimize = 0x10002")
+            return {"mode": "optimize"}
+        conn.execute("ANALYZE")
+        return {"mode": "analyze"}
+    except sqlite3.OperationalError as e:
+        if "interrupted" in str(e):
+            return {"skipped": "time budget used up"}
+        raise
+    finally:
+        conn.set_progress_handler(None, 0)
+
+def _incremental_vacuum(conn, deadline, step_pages):
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        return {"skipped": "auto_vacuum is not INCREMENTAL (run convert_database first)"}
+    free_before = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    free = free_before
+    while free > 0 and time.perf_counter() < deadline:
+        # The pragma frees one page per step and returns no rows, so Connection.execute
+        # would free a single page; executescript steps it to completion
+        conn.executescript(f"PRAGMA incremental_vacuum({step_pages});")
+        free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    return {"pages_released": free_before - free, "pages_left": free}
+
+def run_maintenance(budget_seconds=DEFAULT_BUDGET_SECONDS, vacuum_step_pages=VACUUM_STEP_PAGES):
+    """
+    One maintenance pass over the current database within budget_seconds: passive WAL
+    checkpoint, PRAGMA optimize, change log compaction, incremental vacuum and a final
+    checkpoint. Returns (and stores in maintenance_runs) the before/after statistics and
+    what each step did.
+    """
+    started = time.perf_counter()
+    deadline = started + budget_seconds
+    steps = []
+    conn = database.connect()
+    try:
+        _ensure_history_table(conn)
+        before = database_stats(conn)
+
+        for name, step in (
+            ("checkpoint", lambda: _checkpoint(conn)),
+            ("optimize", lambda: _optimize(conn, deadline)),
+            ("compact_change_log", lambda: database.compact_change_log(deadline=deadline)),
+            ("incremental_vacuum", lambda: _incremental_vacuum(conn, deadline, vacuum_step_pages)),
+            ("final_checkpoint", lambda: _checkpoint(conn)),
+        ):
+            step_started = time.perf_counter()
+            if step_started > deadline and name != "final_checkpoint":
+                steps.append({"step": name, "skipped": "time budget used up", "seconds": 0.0})
+                continue
+            result = step()
+            conn.commit()
+            steps.append(dict({"step": name, "seconds": round(time.perf_counter() - step_started, 3)}, **result))
+
+        report = {
+            "success": True,
+            "started_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "budget_seconds": budget_seconds,
+            "seconds": round(time.perf_counter() - started, 3),
+            "before": before,
+            "after": database_stats(conn),
+            "steps": steps,
+        }
+    except Exception as e:
+        print(f"Error running database maintenance: {str(e)}")
+        print(traceback.format_exc())
+        report = {"success": False, "error": str(e), "steps": steps, "seconds": round(time.perf_counter() - started, 3)}
+
+    try:
+        conn.execute(
+            "INSERT INTO maintenance_runs (run_ts, seconds, success, report) VALUES (?, ?, ?, ?)",
+            (database.now_ts(), report["seconds"], int(report["success"]), json.dumps(report))
+        )
+        conn.commit()
+    except sqlite3.Error as e:
+        print(f"Could not record maintenance run: {str(e)}")
+    finally:
+        conn.close()
+    return report
+
+def get_maintenance_history(limit=10):
+    """Reports of the latest maintenance runs, newest first"""
+    conn = database.connect()
+    try:
+        if not _ensure_history_table(conn):
+            return []
+        return [json.loads(row[0]) for row in conn.execute(
+            "SELECT report FROM maintenance_runs ORDER BY id DESC LIMIT ?", (limit,)
+        )]
+    finally:
+        conn.close()
+
+def _last_run_ts():
+    conn = database.connect()
+    try:
+        _ensure_history_table(conn)
+        return conn.execute("SELECT MAX(run_ts) FROM maintenance_runs").fetchone()[0] or 0
+    finally:
+        conn.close()
+
+def start_scheduler(db_files=None, interval_seconds=DEFAULT_INTERVAL_SECONDS, budget_seconds=DEFAULT_BUDGET_SECONDS):
+    """
+    Run maintenance in a background thread whenever the last run of a database is older
+    than interval_seconds (checked every minute). Only one scheduler runs per process.
+    """
+    global _scheduler_thread
+    if database.read_only_mode():
+        return False
+    db_files = db_files or [database.current_db_file()]
+    with _scheduler_lock:
+        if _scheduler_thread is not None and _scheduler_thread.is_alive():
+            return False
+
+        def run():
+            while True:
+                for db_file in db_files:
+                    try:
+                        with database.use_database(db_file):
+                            if database.now_ts() - _last_run_ts() >= interval_seconds:
+                                run_maintenance(budget_seconds)
+                    except Exception as e:
+                        print(f"Scheduled maintenance failed for {db_file}: {str(e)}")
+                time.sleep(60)
+
+        _scheduler_thread = threading.Thread(target=run, name="db-maintenance", daemon=True)
+        _scheduler_thread.start()
+        return True
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Run database maintenance (optimize, incremental vacuum, WAL checkpoint)")
+    parser.add_argument("--budget-seconds", type=float, default=DEFAULT_BUDGET_SECONDS)
+    parser.add_argument("--convert", action="store_true", help="switch to auto_vacuum=INCREMENTAL and WAL first (full VACUUM)")
+    args = parser.parse_args()
+
+    import sharding
+    for db_file in sharding.shard_paths() if sharding.sharding_enabled() else [database.DB_FILE]:
+        with database.use_database(db_file):
+            if args.convert:
+                print(db_file, json.dumps(convert_database(), indent=2))
+            print(db_file, json.dumps(run_maintenance(args.budget_seconds), indent=2))
@@ -0,0 +1,238 @@
+"""
+Compact in-memory directory of patients for instant lookups and autocomplete.
+
+One directory is kept per database file for the life of the process. It holds sorted
+arrays instead of a DataFrame: patient ids (array of int64) with their names and national
+IDs, plus sorted search keys (every word of the name, lower-cased, and the national ID)
+pointing back to the ids. Prefix lookups are a bisect into the keys.
+
+The directory loads all patients once, then follows the change_log feed: each refresh
+reads only the patients changed since the last one, which costs one indexed query when
+nothing changed.
+"""
+import threading
+from array import array
+from bisect import bisect_left
+from collections import namedtuple
+
+import database
+
+DirectoryEntry = namedtuple("DirectoryEntry", ["id", "national_id", "name"])
+
+_directories = {}
+_directories_lock = threading.Lock()
+
+def _name_keys(name):
+    return sorted(set((name or "").casefold().split()))
+
+def _prefix_end(prefix):
+    """Smallest string greater than every string starting with prefix"""
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+class _SortedKeys:
+    """Sorted search keys with the patient id of each key in a parallel array"""
+
+    def __init__(self):
+        self.keys = []
+        self.ids = array("q")
+
+    def load(self, pairs):
+        pairs.sort()
+        self.keys = [key for key, _ in pairs]
+        self.ids = array("q", (patient_id for _, patient_id in pairs))
+
+    def add(self, key, patient_id):
+        index = bisect_left(self.keys, key)
+        self.keys.insert(index, key)
+        self.ids.insert(index, patient_id)
+
+    def remove(self, key, patient_id):
+        index = bisect_left(self.keys, key)
+        while index < len(self.keys) and self.keys[index] == key:
+            if self.ids[index] == patient_id:
+                del self.keys[index]
+                del self.ids[index]
+                return
+            index += 1
+
+    def prefix_range(self, prefix):
+        start = bisect_left(self.keys, prefix)
+        return start, bisect_left(self.keys, _prefix_end(prefix), start)
+
+    def prefix_count(self, prefix):
+        start, end = self.prefix_range(prefix)
+        return end - start
+
+    def iter_prefix(self, prefix):
+        """Distinct ids of patients with a key starting with prefix, in key order"""
+        start, end = self.prefix_range(prefix)
+        seen = set()
+        for index in range(start, end):
+            patient_id = self.ids[index]
+            if patient_id not in seen:
+                seen.add(patient_id)
+                yield patient_id
+
+class PatientDirectory:
+    """Patients of one database file, kept in sorted arrays"""
+
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self._ids = array("q")
+        self._names = []
+        self._national_ids = []
+        self._name_index = _SortedKeys()
+        self._national_id_index = _SortedKeys()
+        self._seq = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._ids)
+
+    def _load(self, conn):
+        """Read every patient and the current end of the change log in one read transaction"""
+        conn.execute("BEGIN")
+        try:
+            seq = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM change_log").fetchone()[0]
+            rows = conn.execute("SELECT id, national_id, name FROM patients ORDER BY id").fetchall()
+        finally:
+            conn.rollback()
+        self._ids = array("q", (row[0] for row in rows))
+        self._national_ids = [row[1] for row in rows]
+        self._names = [row[2] for row in rows]
+        self._name_index.load([(key, row[0]) for row in rows for key in _name_keys(row[2])])
+        self._national_id_index.load([(row[1], row[0]) for row in rows])
+        self._seq = seq
+
+    def _position(self, patient_id):
+        index = bisect_left(self._ids, patient_id)
+        if index < len(self._ids) and self._ids[index] == patient_id:
+            return index
+        return None
+
+    def _remove(self, patient_id):
+        index = self._position(patient_id)
+        if index is None:
+            return
+        for key in _name_keys(self._names[index]):
+            self._name_index.remove(key, patient_id)
+        self._national_id_index.remove(self._national_ids[index], patient_id)
+        del self._ids[index]
+        del self._names[index]
+        del self._national_ids[index]
+
+    def _add(self, patient_id, national_id, name):
+        index = bisect_left(self._ids, patient_id)
+        self._ids.insert(index, patient_id)
+        self._national_ids.insert(index, national_id)
+        self._names.insert(index, name)
+        for key in _name_keys(name):
+            self._name_index.add(key, patient_id)
+        self._national_id_index.add(national_id, patient_id)
+
+    def refresh(self):
+        """Apply patient changes from the change log; returns the number of patients updated"""
+        with self._lock, database.use_database(self.db_file):
+            conn = database.connect()
+            try:
+                if self._seq is None:
+                    self._load(conn)
+                    return len(self._ids)
+                truncated = conn.execute(
+                    "SELECT value FROM change_log_state WHERE key = 'truncated_through'"
+                ).fetchone()
+                if truncated and truncated[0] > self._seq:
+                    # Changes we have not seen were compacted away
+                    self._load(conn)
+                    return len(self._ids)
+
+                last_seq = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM change_log").fetchone()[0]
+                updated = 0
+                while self._seq < last_seq:
+                    # "+table_name" keeps SQLite on the seq range instead of idx_change_log_row,
+                    # which would walk every patient entry ever logged
+                    changes = conn.execute(
+                        "SELECT seq, row_id FROM change_log WHERE seq > ? AND seq <= ? AND +table_name = 'patients' ORDER BY seq LIMIT 1000",
+                        (self._seq, last_seq)
+                    ).fetchall()
+                    if not changes:
+                        # Only other tables changed
+                        self._seq = last_seq
+                        break
+                    changed_ids = sorted({row_id for _, row_id in changes})
+                    placeholders = ",".join("?" * len(changed_ids))
+                    current = {
+                        row[0]: row for row in conn.execute(
+                            f"SELECT id, national_id, name FROM patients WHERE id IN ({placeholders})", changed_ids
+                        )
+                    }
+                    for patient_id in changed_ids:
+                        self._remove(patient_id)
+                        if patient_id in current:
+                            self._add(*current[patient_id])
+                    updated += len(changed_ids)
+                    self._seq = changes[-1][0]
+                return updated
+            finally:
+                conn.close()
+
+    def get(self, patient_id):
+        """DirectoryEntry for a patient id, or None"""
+        with self._lock:
+            index = self._position(patient_id)
+            if index is None:
+                return None
+            return DirectoryEntry(patient_id, self._national_ids[index], self._names[index])
+
+    def search(self, prefix, limit=20):
+        """
+        Patients whose national ID, or any word of whose name, starts with prefix
+        (case-insensitive for names), national ID matches first
+        """
+        prefix = (prefix or "").strip()
+        if not prefix:
+            return []
+        with self._lock:
+            ids = []
+            for patient_id in self._national_id_index.iter_prefix(prefix):
+                if len(ids) >= limit:
+                    break
+                ids.append(patient_id)
+            words = prefix.casefold().split()
+            if len(ids) < limit and words:
+                # Walk the word with the fewest keys; every other word must match a word of the name
+                # (the last one typed as a prefix, the others too since they may be cut short)
+                rarest = min(words, key=self._name_index.prefix_count)
+                others = [word for word in words if word != rarest]
+                for patient_id in self._name_index.iter_prefix(rarest):
+                    if patient_id in ids:
+                        continue
+                    if others:
+                        name_keys = _name_keys(self._names[self._position(patient_id)])
+                        if not all(any(key.startswith(word) for key in name_keys) for word in others):
+                            continue
+                    ids.append(patient_id)
+                    if len(ids) >= limit:
+                        break
+            entries = []
+            for patient_id in ids:
+                index = self._position(patient_id)
+                entries.append(DirectoryEntry(patient_id, self._national_ids[index], self._names[index]))
+            return entries
+
+def get_directory(db_file=None):
+    """The process-wide directory of a database file (the current one by default), refreshed"""
+    db_file = db_file or database.current_db_file()
+    directory = _directories.get(db_file)
+    if directory is None:
+        with _directories_lock:
+            directory = _directories.setdefault(db_file, PatientDirectory(db_file))
+    directory.refresh()
+    return directory
+
+def search_patients(prefix, limit=20, db_files=None):
+    """Prefix search over one or several database files (all shards in sharded mode)"""
+    entries = []
+    for db_file in db_files or [database.current_db_file()]:
+        entries.extend(get_directory(db_file).search(prefix, limit))
+    return entries[:limit]
@@ -0,0 +1,105 @@
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# Aggregated timings: name -> {"count", "total_ms", "max_ms", "last_ms"}
+_timings = {}
+_timings_lock = threading.Lock()
+
+# Process start reference, used to report time-to-first-render
+PROCESS_START = time.perf_counter()
+
+# A dotted module name, e.g. "database" or "pandas.core.frame"
+_MODULE_NAME = re.compile(r"^[A-Za-z_]\w*(?:\.[A-Za-z_]\w*)*$")
+
+def record_timing(name, elapsed_ms):
+    """Add one measurement (in milliseconds) to the aggregated timings"""
+    with _timings_lock:
+        stats = _timings.get(name)
+        if stats is None:
+            stats = _timings[name] = {"count": 0, "total_ms": 0.0, "max_ms": 0.0, "last_ms": 0.0}
+        stats["count"] += 1
+        stats["total_ms"] += elapsed_ms
+        stats["last_ms"] = elapsed_ms
+        if elapsed_ms > stats["max_ms"]:
+            stats["max_ms"] = elapsed_ms
+
+@contextmanager
+def timed(name):
+    """Context manager that records the wall time of its block under the given name"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_timing(name, (time.perf_counter() - start) * 1000.0)
+
+def get_timings():
+    """Return the aggregated timings as a list of dicts, slowest total first"""
+    with _timings_lock:
+        rows = [
+            {
+                "name": name,
+                "count": stats["count"],
+                "total_ms": round(stats["total_ms"], 3),
+                "avg_ms": round(stats["total_ms"] / stats["count"], 3),
+                "max_ms": round(stats["max_ms"], 3),
+                "last_ms": round(stats["last_ms"], 3),
+            }
+            for name, stats in _timings.items()
+        ]
+    return sorted(rows, key=lambda row: row["total_ms"], reverse=True)
+
+def reset_timings():
+    """Clear all recorded timings"""
+    with _timings_lock:
+        _timings.clear()
+
+def import_time_profile(module="database", top=25):
+    """
+    Profile the import of a module in a fresh interpreter using `python -X importtime`.
+    Returns {"success", "total_ms", "imports": [{"module", "self_ms", "cumulative_ms"}, ...]}
+    with the `top` most expensive imports by cumulative time.
+    The module name is checked before it is put into the `-c` statement, so only an import runs.
+    """
+    if not isinstance(module, str) or not _MODULE_NAME.fullmatch(module):
+        return {"success": False, "error": f"Invalid module name: {module!r}"}
+
+    try:
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+            capture_output=True, text=True, timeout=120,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        )
+    except Exception as e:
+        return {"success": False, "error": str(e)}
+
+    if result.returncode != 0:
+        return {"success": False, "error": result.stderr.strip().splitlines()[-1] if result.stderr.strip() else "import failed"}
+
+    imports = []
+    for line in result.stderr.splitlines():
+        # Format: "import time: self [us] | cumulative | imported package"
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        parts = line[len("import time:"):].split("|")
+        if len(parts) != 3:
+            continue
+        try:
+            self_us = int(parts[0].strip())
+            cumulative_us = int(parts[1].strip())
+        except ValueError:
+            continue
+        imports.append({
+            "module": parts[2].strip(),
+            "self_ms": self_us / 1000.0,
+            "cumulative_ms": cumulative_us / 1000.0,
+        })
+
+    # The requested module is reported last; its cumulative time is the total
+    total_ms = next((row["cumulative_ms"] for row in reversed(imports) if row["module"] == module), None)
+    imports.sort(key=lambda row: row["cumulative_ms"], reverse=True)
+    return {"success": True, "total_ms": total_ms, "imports": imports[:top]}
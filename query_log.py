@@ -0,0 +1,259 @@
+"""
+Opt-in SQL statement tracing: timings, row counts and query plans of slow statements.
+
+Turn it on with the environment variable MEDICAL_QUERY_TRACE=1 (threshold in
+MEDICAL_SLOW_QUERY_MS, default 50) or at run time with enable_tracing() (the Debug page
+has a switch). While it is on, database.connect() returns a TracedConnection whose cursors
+time every statement, from execute() until its rows are read, and count the rows.
+
+Statements are aggregated by their normalized text (literals and IN lists replaced by "?").
+A statement slower than the threshold is printed together with its EXPLAIN QUERY PLAN,
+with full table scans and temporary B-trees (sorting or grouping without an index) flagged.
+"""
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import deque
+
+DEFAULT_SLOW_MS = float(os.environ.get("MEDICAL_SLOW_QUERY_MS", 50))
+# Slow statements kept for the Debug page
+RECENT_SLOW_LIMIT = 100
+
+_enabled = os.environ.get("MEDICAL_QUERY_TRACE", "") not in ("", "0")
+_slow_ms = DEFAULT_SLOW_MS
+_stats = {}
+_recent_slow = deque(maxlen=RECENT_SLOW_LIMIT)
+_stats_lock = threading.Lock()
+
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r"\b\d+(?:\.\d+)?\b")
+_IN_LIST = re.compile(r"\bIN\s*\((?:\s*\?\s*,)+\s*\?\s*\)", re.IGNORECASE)
+_SPACES = re.compile(r"\s+")
+
+def enabled():
+    return _enabled
+
+def enable_tracing(slow_ms=None):
+    """Trace the statements of connections opened from now on"""
+    global _enabled, _slow_ms
+    if slow_ms is not None:
+        _slow_ms = float(slow_ms)
+    _enabled = True
+
+def disable_tracing():
+    global _enabled
+    _enabled = False
+
+def slow_threshold_ms():
+    return _slow_ms
+
+def normalize_sql(sql):
+    """Statement text with literals replaced by "?" and whitespace collapsed, for grouping"""
+    sql = _STRING_LITERAL.sub("?", sql)
+    sql = _NUMBER.sub("?", sql)
+    sql = _IN_LIST.sub("IN (?...)", sql)
+    return _SPACES.sub(" ", sql).strip()
+
+def plan_flags(plan):
+    """Warnings for a query plan: full table scans and temporary B-trees"""
+    flags = []
+    for detail in plan:
+        if detail.startswith("SCAN ") and "USING" not in detail and "VIRTUAL TABLE" not in detail:
+            flags.append(f"full scan: {detail[len('SCAN '):]}")
+        elif "USE TEMP B-TREE" in detail:
+            flags.append(f"temp b-tree: {detail.split('FOR ', 1)[-1]}")
+    return flags
+
+def _explain(conn, sql, parameters):
+    """EXPLAIN QUERY PLAN detail lines, or None if the statement cannot be explained"""
+    try:
+        # A plain cursor, so the EXPLAIN itself is not traced
+        cursor = sqlite3.Cursor(conn)
+        cursor.row_factory = None
+        return [row[3] for row in cursor.execute(f"EXPLAIN QUERY PLAN {sql}", parameters)]
+    except sqlite3.Error:
+        return None
+
+def _record(conn, sql, parameters, elapsed_ms, rows):
+    normalized = normalize_sql(sql)
+    slow = elapsed_ms >= _slow_ms
+    with _stats_lock:
+        stats = _stats.get(normalized)
+        if stats is None:
+            stats = _stats[normalized] = {
+                "count": 0, "total_ms": 0.0, "max_ms": 0.0, "rows": 0, "slow_count": 0, "plan": None, "flags": [],
+            }
+        stats["count"] += 1
+        stats["total_ms"] += elapsed_ms
+        stats["rows"] += rows
+        stats["max_ms"] = max(stats["max_ms"], elapsed_ms)
+        if slow:
+            stats["slow_count"] += 1
+        need_plan = slow and stats["plan"] is None
+    if not slow:
+        return
+
+    plan = _explain(conn, sql, parameters) if need_plan and parameters is not None else None
+    with _stats_lock:
+        if plan is not None:
+            stats["plan"] = plan
+            stats["flags"] = plan_flags(plan)
+        plan, flags = stats["plan"], stats["flags"]
+        _recent_slow.append({
+            "at": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "database": conn.db_file,
+            "ms": round(elapsed_ms, 3),
+            "rows": rows,
+            "sql": normalized,
+        })
+    print(f"Slow query ({elapsed_ms:.1f} ms, {rows} rows) on {conn.db_file}: {normalized}")
+    for detail in plan or []:
+        print(f"    {detail}")
+    for flag in flags:
+        print(f"    !! {flag}")
+
+class TracedCursor(sqlite3.Cursor):
+    """Cursor that times each statement from execute() until its rows have been read"""
+
+    _sql = None
+
+    def _start(self, sql, parameters):
+        self._finish()
+        self._sql = sql
+        self._parameters = parameters
+        self._elapsed = 0.0
+        self._rows = 0
+
+    def _finish(self):
+        if self._sql is None:
+            return
+        sql, self._sql = self._sql, None
+        if self.description is None:
+            # Not a query: rowcount is the number of rows changed
+            self._rows = max(self.rowcount, 0)
+        _record(self.connection, sql, self._parameters, self._elapsed * 1000.0, self._rows)
+
+    def _timed(self, func, *args):
+        started = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            self._elapsed += time.perf_counter() - started
+
+    def execute(self, sql, parameters=()):
+        self._start(sql, parameters)
+        self._timed(super().execute, sql, parameters)
+        if self.description is None:
+            self._finish()
+        return self
+
+    def executemany(self, sql, seq_of_parameters):
+        # The plan of one statement of the batch cannot be re-run without its parameters
+        self._start(sql, None)
+        self._timed(super().executemany, sql, seq_of_parameters)
+        self._finish()
+        return self
+
+    def executescript(self, sql_script):
+        self._start(sql_script, None)
+        self._timed(super().executescript, sql_script)
+        self._finish()
+        return self
+
+    def fetchone(self):
+        row = self._timed(super().fetchone)
+        if row is None:
+            self._finish()
+        elif self._sql is not None:
+            self._rows += 1
+        return row
+
+    def fetchmany(self, size=None):
+        rows = self._timed(super().fetchmany, self.arraysize if size is None else size)
+        if self._sql is not None:
+            self._rows += len(rows)
+            if not rows:
+                self._finish()
+        return rows
+
+    def fetchall(self):
+        rows = self._timed(super().fetchall)
+        if self._sql is not None:
+            self._rows += len(rows)
+            self._finish()
+        return rows
+
+    def __next__(self):
+        try:
+            row = self._timed(super().__next__)
+        except StopIteration:
+            self._finish()
+            raise
+        if self._sql is not None:
+            self._rows += 1
+        return row
+
+    def close(self):
+        self._finish()
+        super().close()
+
+    def __del__(self):
+        try:
+            self._finish()
+        except Exception:
+            pass
+
+class TracedConnection(sqlite3.Connection):
+    """Connection whose cursors (including the shortcut execute methods) are TracedCursors"""
+
+    def __init__(self, database, *args, **kwargs):
+        super().__init__(database, *args, **kwargs)
+        self.db_file = str(database)
+
+    def cursor(self, factory=TracedCursor):
+        return super().cursor(factory)
+
+    # sqlite3.Connection.execute() and friends do not go through cursor(), so route them
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        return self.cursor().executescript(sql_script)
+
+def connection_factory():
+    """The factory for sqlite3.connect(): TracedConnection while tracing is on"""
+    return TracedConnection if _enabled else sqlite3.Connection
+
+def get_query_stats(top=20, order_by="total_ms"):
+    """The top statements by order_by (total_ms, max_ms, avg_ms, count, rows or slow_count)"""
+    with _stats_lock:
+        rows = [
+            {
+                "sql": sql,
+                "count": stats["count"],
+                "total_ms": round(stats["total_ms"], 3),
+                "avg_ms": round(stats["total_ms"] / stats["count"], 3),
+                "max_ms": round(stats["max_ms"], 3),
+                "rows": stats["rows"],
+                "slow_count": stats["slow_count"],
+                "flags": "; ".join(stats["flags"]),
+                "plan": "\n".join(stats["plan"] or []),
+            }
+            for sql, stats in _stats.items()
+        ]
+    return sorted(rows, key=lambda row: row[order_by], reverse=True)[:top]
+
+def get_recent_slow_queries():
+    """The latest slow statements, newest first"""
+    with _stats_lock:
+        return list(reversed(_recent_slow))
+
+def reset_query_stats():
+    with _stats_lock:
+        _stats.clear()
+        _recent_slow.clear()
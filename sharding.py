@@ -0,0 +1,462 @@
+"""
+Optional sharded mode: patients are spread over N SQLite files by a hash of national_id.
+
+Sharding is enabled when shards/shard_config.json exists; it is created by the rebalancing
+tool, which is also how an existing single-file database is split:
+    python sharding.py --shards 4
+
+Every shard allocates ids (patients, records and files) from its own range of
+SHARD_ID_SPAN values, so any id tells which shard it lives in. The ranges start above the
+ids of the single-file database, so an id from before sharding never names a patient in a
+shard. The functions here mirror
+database.py and route each call to the right shard; listings and statistics fan out to all
+shards in parallel and merge the results.
+"""
+import csv
+import heapq
+import itertools
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import traceback
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import archive
+import chart_export
+import database
+import document_index
+import vitals_screening
+
+SHARD_DIR = os.environ.get("MEDICAL_DB_SHARD_DIR", "shards")
+SHARD_CONFIG_FILE = "shard_config.json"
+SHARD_FILE_PATTERN = "medical_records_shard_{index}.db"
+
+# Each shard hands out ids in [(index + offset) * SHARD_ID_SPAN + 1, (index + offset + 1) * SHARD_ID_SPAN],
+# where offset is the id_block_offset of the shard config: 1 for shard sets created now, so
+# [1, SHARD_ID_SPAN] stays with the single-file database (configs without it used 0)
+SHARD_ID_SPAN = 10 ** 12
+ID_BLOCK_OFFSET = 1
+
+AUTOINCREMENT_TABLES = ["patients", "medical_records", "patient_files", "patient_files_blob"]
+
+_config_cache = {}
+_config_lock = threading.Lock()
+_pool = None
+_pool_lock = threading.Lock()
+_initialized_shards = {}
+
+def _load_config(shard_dir=SHARD_DIR):
+    path = os.path.join(shard_dir, SHARD_CONFIG_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+class ShardLookupError(LookupError):
+    """An id that was not allocated by any shard of the current set"""
+
+def _config():
+    if "config" not in _config_cache:
+        with _config_lock:
+            if "config" not in _config_cache:
+                _config_cache["config"] = _load_config()
+    return _config_cache["config"]
+
+def shard_count():
+    """Number of shards, or 0 when sharding is not enabled"""
+    config = _config()
+    return config["shard_count"] if config else 0
+
+def _id_block_offset():
+    config = _config()
+    return config.get("id_block_offset", 0) if config else 0
+
+def sharding_enabled():
+    return shard_count() > 1
+
+def shard_path(index, shard_dir=SHARD_DIR):
+    return os.path.join(shard_dir, SHARD_FILE_PATTERN.format(index=index))
+
+def shard_paths():
+    """Paths of all shard files"""
+    return [shard_path(index) for index in range(shard_count())]
+
+def shard_for_national_id(national_id, count=None):
+    """Shard index for a national ID (crc32, so it is stable across processes)"""
+    return zlib.crc32(str(national_id).encode("utf-8")) % (count or shard_count())
+
+def shard_for_id(any_id):
+    """Shard index that allocated a patient, record or file id"""
+    index = (int(any_id) - 1) // SHARD_ID_SPAN - _id_block_offset()
+    if not 0 <= index < shard_count():
+        raise ShardLookupError(f"Id {any_id} does not belong to any shard")
+    return index
+
+def _executor():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ThreadPoolExecutor(max_workers=max(2, shard_count()), thread_name_prefix="shard")
+    return _pool
+
+def _init_shard(path, index, id_block_offset):
+    """Create the schema in a shard and start its id sequences at the shard's range"""
+    with database.use_database(path):
+        # Not init_db_once: a rebalance can create a new file at a path already seen by this process
+        database.init_db()
+        conn = database.connect()
+        try:
+            for table_name in AUTOINCREMENT_TABLES:
+                conn.execute(
+                    "INSERT INTO sqlite_sequence (name, seq) SELECT ?, ? WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = ?)",
+                    (table_name, (index + id_block_offset) * SHARD_ID_SPAN, table_name)
+                )
+            conn.commit()
+        finally:
+            conn.close()
+
+def init_shards_once(start_maintenance=False):
+    """Initialize every shard once per process (like database.init_db_once, including start_maintenance)"""
+    if _initialized_shards.get(SHARD_DIR) == shard_count() or database.read_only_mode():
+        return
+    with _pool_lock:
+        for index in range(shard_count()):
+            _init_shard(shard_path(index), index, _id_block_offset())
+        _initialized_shards[SHARD_DIR] = shard_count()
+    if start_maintenance:
+        import maintenance
+        maintenance.start_scheduler(shard_paths())
+
+def _on_shard(index, func, *args, **kwargs):
+    with database.use_database(shard_path(index)):
+        return func(*args, **kwargs)
+
+def _fan_out(func, *args, **kwargs):
+    """Run func on every shard in parallel; returns the results in shard order"""
+    futures = [_executor().submit(_on_shard, index, func, *args, **kwargs) for index in range(shard_count())]
+    return [future.result() for future in futures]
+
+# Routed per-patient functions
+
+def add_patient(national_id, name, date_of_birth=None, gender=None, phone=None, address=None):
+    """Add a new patient to the shard owning the national ID"""
+    return _on_shard(shard_for_national_id(national_id), database.add_patient,
+                     national_id, name, date_of_birth, gender, phone, address)
+
+def get_patient_by_national_id(national_id):
+    return _on_shard(shard_for_national_id(national_id), database.get_patient_by_national_id, national_id)
+
+def add_medical_record(patient_id, blood_pressure=None, glucose_level=None, temperature=None, notes=None):
+    return _on_shard(shard_for_id(patient_id), database.add_medical_record,
+                     patient_id, blood_pressure, glucose_level, temperature, notes)
+
+def get_patient_medical_records(patient_id, full_history=False):
+    return _on_shard(shard_for_id(patient_id), database.get_patient_medical_records, patient_id, full_history)
+
+def get_patient_medical_records_rows(patient_id, full_history=False):
+    return _on_shard(shard_for_id(patient_id), database.get_patient_medical_records_rows, patient_id, full_history)
+
+def get_records_between(patient_id, start, end):
+    return _on_shard(shard_for_id(patient_id), database.get_records_between, patient_id, start, end)
+
+def get_records_since(patient_id, since):
+    return _on_shard(shard_for_id(patient_id), database.get_records_since, patient_id, since)
+
+def save_patient_file(patient_id, uploaded_file, description=None):
+    return _on_shard(shard_for_id(patient_id), database.save_patient_file, patient_id, uploaded_file, description)
+
+def save_patient_file_debug(patient_id, uploaded_file, description=None):
+    return _on_shard(shard_for_id(patient_id), database.save_patient_file_debug, patient_id, uploaded_file, description)
+
+def save_patient_files_batch(patient_id, uploaded_files, description=None, max_workers=4):
+    return _on_shard(shard_for_id(patient_id), database.save_patient_files_batch,
+                     patient_id, uploaded_files, description, max_workers)
+
+def get_patient_files(patient_id):
+    return _on_shard(shard_for_id(patient_id), database.get_patient_files, patient_id)
+
+def get_patient_files_rows(patient_id):
+    return _on_shard(shard_for_id(patient_id), database.get_patient_files_rows, patient_id)
+
+def get_patient_file(file_id):
+    return _on_shard(shard_for_id(file_id), database.get_patient_file, file_id)
+
+def get_patient_files_debug(patient_id):
+    return _on_shard(shard_for_id(patient_id), database.get_patient_files_debug, patient_id)
+
+def save_file_to_blob(patient_id, uploaded_file, description=None):
+    return _on_shard(shard_for_id(patient_id), database.save_file_to_blob, patient_id, uploaded_file, description)
+
+def get_blob_files_rows(patient_id, full_history=False):
+    return _on_shard(shard_for_id(patient_id), database.get_blob_files_rows, patient_id, full_history)
+
+def get_blob_content(file_id):
+    return _on_shard(shard_for_id(file_id), database.get_blob_content, file_id)
+
+def get_patient_by_id(patient_id):
+    return _on_shard(shard_for_id(patient_id), database.get_patient_by_id, patient_id)
+
+def get_patient_alerts(patient_id):
+    return _on_shard(shard_for_id(patient_id), vitals_screening.get_patient_alerts, patient_id)
+
+def stream_patient_chart_zip(patient_id):
+    return chart_export.stream_patient_chart_zip(patient_id, shard_path(shard_for_id(patient_id)))
+
+# Cross-shard functions
+
+def get_all_patients_rows():
+    """All patients from every shard, merged by name"""
+    per_shard = _fan_out(database.get_all_patients_rows)
+    return list(heapq.merge(*per_shard, key=lambda row: row.name))
+
+def get_all_patients():
+    """All patients from every shard as a DataFrame, ordered by name"""
+    return database.rows_to_dataframe(get_all_patients_rows(), database.PatientRow)
+
+def get_patients_page_rows(offset=0, limit=50):
+    """One page of the patient list over all shards: the first offset+limit of each shard, merged"""
+    per_shard = _fan_out(database.get_patients_page_rows, 0, offset + limit)
+    merged = heapq.merge(*per_shard, key=lambda row: (row.name, row.id))
+    return list(itertools.islice(merged, offset, offset + limit))
+
+def count_patients():
+    return sum(_fan_out(database.count_patients))
+
+def get_statistics():
+    """Table counts summed over all shards, plus the per-shard breakdown"""
+    per_shard = _fan_out(database.get_statistics)
+    totals = {}
+    for stats in per_shard:
+        for key, value in stats.items():
+            totals[key] = totals.get(key, 0) + value
+    totals["shards"] = per_shard
+    return totals
+
+def search_documents(query, patient_id=None, limit=20):
+    """Full-text search in the patient's shard, or in every shard merged by rank"""
+    if patient_id is not None:
+        return _on_shard(shard_for_id(patient_id), document_index.search_documents, query, patient_id, limit)
+    per_shard = _fan_out(document_index.search_documents, query, None, limit)
+    return list(heapq.merge(*per_shard, key=lambda hit: hit.score))[:limit]
+
+def index_documents(max_workers=4, full=False):
+    """Index new or changed uploads shard by shard (each shard uses its own process pool)"""
+    results = [_on_shard(index, document_index.index_documents, max_workers, full) for index in range(shard_count())]
+    return {
+        "success": all(result["success"] for result in results),
+        "files_processed": sum(result.get("files_processed", 0) for result in results),
+        "files_indexed": sum(result.get("files_indexed", 0) for result in results),
+        "errors": [error for result in results for error in result.get("errors", [])],
+        "error": "; ".join(result["error"] for result in results if not result["success"]),
+        "shards": results,
+    }
+
+def start_background_indexing(max_workers=2, keys=None):
+    """Index new uploads in the background: the shards owning keys, or every shard without keys"""
+    if keys is None:
+        return document_index.start_background_indexing(shard_paths(), max_workers)
+    per_shard = {}
+    for key in keys:
+        per_shard.setdefault(shard_for_id(key[1]), []).append(key)
+    return all(
+        document_index.start_background_indexing([shard_path(index)], max_workers, shard_keys)
+        for index, shard_keys in per_shard.items()
+    )
+
+def get_index_status():
+    per_shard = _fan_out(document_index.get_index_status)
+    return {key: sum(status[key] for status in per_shard) for key in per_shard[0]}
+
+# Rebalancing
+
+def _copy_patient_batch(source, patients, targets, count, mapping):
+    """Copy a batch of patients with their records and files from source into the target shards"""
+    by_target = {}
+    for patient in patients:
+        by_target.setdefault(shard_for_national_id(patient[1], count), []).append(patient)
+
+    for target_index, group in by_target.items():
+        target = targets[target_index]
+        id_map = {}
+        for old_id, national_id, name, date_of_birth, gender, phone, address, registration_ts in group:
+            cursor = target.execute(
+                "INSERT INTO patients (national_id, name, date_of_birth, gender, phone, address, registration_ts) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (national_id, name, date_of_birth, gender, phone, address, registration_ts)
+            )
+            id_map[old_id] = cursor.lastrowid
+            mapping.append((old_id, cursor.lastrowid, national_id, target_index))
+
+        placeholders = ",".join("?" * len(id_map))
+        old_ids = list(id_map)
+        target.executemany(
+            "INSERT INTO medical_records (patient_id, blood_pressure, glucose_level, temperature, notes, record_ts) VALUES (?, ?, ?, ?, ?, ?)",
+            ((id_map[row[0]],) + row[1:] for row in source.execute(
+                f"SELECT patient_id, blood_pressure, glucose_level, temperature, notes, record_ts FROM medical_records WHERE patient_id IN ({placeholders}) ORDER BY id",
+                old_ids
+            ))
+        )
+        target.executemany(
+            "INSERT INTO patient_files (patient_id, file_name, file_path, file_type, description, upload_ts) VALUES (?, ?, ?, ?, ?, ?)",
+            ((id_map[row[0]],) + row[1:] for row in source.execute(
+                f"SELECT patient_id, file_name, file_path, file_type, description, upload_ts FROM patient_files WHERE patient_id IN ({placeholders}) ORDER BY id",
+                old_ids
+            ))
+        )
+        for row in source.execute(
+            f"SELECT patient_id, file_name, file_type, file_content, description, file_size, upload_ts FROM patient_files_blob WHERE patient_id IN ({placeholders}) ORDER BY id",
+            old_ids
+        ):
+            target.execute(
+                "INSERT INTO patient_files_blob (patient_id, file_name, file_type, file_content, description, file_size, upload_ts) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (id_map[row[0]],) + row[1:]
+            )
+
+def _reserve_ids(conn, table_name, count):
+    """Take count ids from a table's sequence, for rows that are stored in an archive instead"""
+    seq = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = ?", (table_name,)).fetchone()[0]
+    conn.execute("UPDATE sqlite_sequence SET seq = ? WHERE name = ?", (seq + count, table_name))
+    return range(seq + 1, seq + count + 1)
+
+def _copy_archives(source_path, targets, target_paths, id_map, batch_size):
+    """
+    Copy the archived records and files of the patients in id_map (old id -> (new id, shard))
+    from the archives of source_path into the archives of their new shards, with new ids
+    """
+    copied = 0
+    for year, path in archive.list_archives(source_path):
+        source = sqlite3.connect(f"file:{os.path.abspath(path)}?mode=ro", uri=True)
+        try:
+            for table_name, columns in archive.ARCHIVE_COLUMNS.items():
+                cursor = source.execute(f"SELECT {', '.join(columns[1:])} FROM {table_name} ORDER BY id")
+                while True:
+                    rows = cursor.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    by_target = {}
+                    for row in rows:
+                        if row[0] in id_map:
+                            new_patient_id, target_index = id_map[row[0]]
+                            by_target.setdefault(target_index, []).append((new_patient_id,) + row[1:])
+                    for target_index, group in by_target.items():
+                        new_ids = _reserve_ids(targets[target_index], table_name, len(group))
+                        targets[target_index].commit()
+                        archive.import_archived_rows(
+                            target_paths[target_index], year, table_name,
+                            [(new_id,) + row for new_id, row in zip(new_ids, group)]
+                        )
+                        copied += len(group)
+        finally:
+            source.close()
+    return copied
+
+def rebalance(new_count, batch_size=500):
+    """
+    Redistribute all patients over new_count shards (new_count >= 2).
+
+    The source is the current shard set, or the single DB_FILE when sharding is not enabled
+    yet. Data is copied into a fresh shard directory, which replaces SHARD_DIR at the end;
+    the previous shards are kept as <SHARD_DIR>_old_<timestamp>. Patients (and their records
+    and files) get new ids in their new shard's range; the old -> new patient id mapping is
+    written to shard_rebalance_map.csv in the new directory. Records and files already moved
+    to the yearly archives are copied into the archives of their new shard, with new ids as
+    well. When splitting the single-file database, it is renamed to
+    <DB_FILE>.pre_sharding_<timestamp> so no tool keeps reading its stale data. Files on disk
+    are not moved. Run it while the app is stopped.
+    """
+    if new_count < 2:
+        return {"success": False, "error": "Sharded mode needs at least 2 shards"}
+
+    started = time.perf_counter()
+    current = shard_count()
+    source_paths = [shard_path(i) for i in range(current)] if current > 1 else [database.DB_FILE]
+    stamp = datetime.now().strftime("%Y%m%d%H%M%S")
+    new_dir = f"{SHARD_DIR}_rebalance_{stamp}"
+    os.makedirs(new_dir)
+
+    mapping = []
+    targets = []
+    target_paths = [shard_path(index, new_dir) for index in range(new_count)]
+    archived_rows = 0
+    try:
+        for index in range(new_count):
+            _init_shard(target_paths[index], index, ID_BLOCK_OFFSET)
+            targets.append(sqlite3.connect(target_paths[index]))
+
+        for source_path in source_paths:
+            with database.use_database(source_path):
+                database.init_db_once()  # brings an old single-file database up to the current schema
+            source = sqlite3.connect(source_path)
+            try:
+                last_id = 0
+                while True:
+                    patients = source.execute(
+                        "SELECT id, national_id, name, date_of_birth, gender, phone, address, registration_ts FROM patients WHERE id > ? ORDER BY id LIMIT ?",
+                        (last_id, batch_size)
+                    ).fetchall()
+                    if not patients:
+                        break
+                    last_id = patients[-1][0]
+                    _copy_patient_batch(source, patients, targets, new_count, mapping)
+                    for target in targets:
+                        target.commit()
+            finally:
+                source.close()
+            id_map = {old_id: (new_id, target_index) for old_id, new_id, _, target_index in mapping}
+            archived_rows += _copy_archives(source_path, targets, target_paths, id_map, batch_size)
+    except Exception as e:
+        print(f"Error rebalancing shards: {str(e)}")
+        print(traceback.format_exc())
+        for target in targets:
+            target.close()
+        shutil.rmtree(new_dir, ignore_errors=True)
+        return {"success": False, "error": str(e)}
+
+    for target in targets:
+        target.close()
+
+    with open(os.path.join(new_dir, "shard_rebalance_map.csv"), "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(["old_patient_id", "new_patient_id", "national_id", "shard"])
+        writer.writerows(mapping)
+    with open(os.path.join(new_dir, SHARD_CONFIG_FILE), "w", encoding="utf-8") as f:
+        json.dump({"shard_count": new_count, "id_block_offset": ID_BLOCK_OFFSET, "created_at": stamp}, f, indent=2)
+
+    old_dir = None
+    if os.path.exists(SHARD_DIR):
+        old_dir = f"{SHARD_DIR}_old_{stamp}"
+        os.rename(SHARD_DIR, old_dir)
+    os.rename(new_dir, SHARD_DIR)
+    _config_cache.clear()
+
+    retired = None
+    if current <= 1:
+        retired = f"{database.DB_FILE}.pre_sharding_{stamp}"
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(database.DB_FILE + suffix):
+                os.rename(database.DB_FILE + suffix, retired + suffix)
+
+    return {
+        "success": True,
+        "shard_count": new_count,
+        "patients_moved": len(mapping),
+        "archived_rows_moved": archived_rows,
+        "previous_shards": old_dir,
+        "retired_database": retired,
+        "seconds": round(time.perf_counter() - started, 3),
+    }
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Split the database into shards or change the number of shards")
+    parser.add_argument("--shards", type=int, required=True, help="new number of shards (at least 2)")
+    parser.add_argument("--batch-size", type=int, default=500, help="patients copied per transaction")
+    args = parser.parse_args()
+
+    print(json.dumps(rebalance(args.shards, args.batch_size), indent=2))
@@ -0,0 +1,372 @@
+import os
+import time
+import traceback
+from datetime import datetime
+
+import database
+
+# Files up to this size go to SQLite BLOBs, larger ones to disk (override with MEDICAL_BLOB_MAX_BYTES)
+DEFAULT_BLOB_MAX_BYTES = int(os.environ.get("MEDICAL_BLOB_MAX_BYTES", 256 * 1024))
+
+# Chunk size for streaming file content between backends
+COPY_CHUNK_SIZE = 1024 * 1024
+
+def _file_type(file_name):
+    return file_name.split(".")[-1] if "." in file_name else ""
+
+class _SubstrBlobReader:
+    """Read-only stand-in for a sqlite3.Blob (Python < 3.11): reads the value piece by piece with substr()"""
+
+    def __init__(self, conn, table, column, row_id):
+        self._conn = conn
+        self._query = f"SELECT substr({column}, ?, ?) FROM {table} WHERE rowid = ?"
+        self._row_id = row_id
+        self._offset = 0
+
+    def read(self, length=-1):
+        if length is None or length < 0:
+            length = 2 ** 31 - 1
+        row = self._conn.execute(self._query, (self._offset + 1, length, self._row_id)).fetchone()
+        chunk = bytes(row[0]) if row and row[0] is not None else b""
+        self._offset += len(chunk)
+        return chunk
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def open_blob_reader(conn, table, column, row_id):
+    """Readable handle on a BLOB value: an incremental Blob on Python 3.11+, substr() reads before"""
+    if hasattr(conn, "blobopen"):
+        return conn.blobopen(table, column, row_id, readonly=True)
+    return _SubstrBlobReader(conn, table, column, row_id)
+
+class FilesystemBackend:
+    """Files on disk under patient_files/patient_<id>/, indexed by the patient_files table"""
+
+    name = "filesystem"
+    table = "patient_files"
+
+    def list_files(self, conn, after_id, limit):
+        """Return up to `limit` files with id > after_id as (id, patient_id, file_name, file_type, upload_ts, description, size)"""
+        rows = conn.execute(
+            "SELECT id, patient_id, file_name, file_type, upload_ts, description, file_path FROM patient_files WHERE id > ? ORDER BY id LIMIT ?",
+            (after_id, limit)
+        ).fetchall()
+        result = []
+        for row in rows:
+            try:
+                size = os.path.getsize(row[6])
+            except OSError:
+                size = None  # Missing file, reported by the integrity verifier
+            result.append(row[:6] + (size,))
+        return result
+
+    def open_reader(self, conn, file_id):
+        row = conn.execute("SELECT file_path FROM patient_files WHERE id = ?", (file_id,)).fetchone()
+        if row is None:
+            raise KeyError(f"File {file_id} not found in patient_files")
+        return open(row[0], "rb")
+
+    def write(self, conn, patient_id, file_name, reader, size, description=None, upload_ts=None):
+        """Write the file to disk and insert its row (the caller commits). Returns (file_id, written_path)"""
+        patient_dir = os.path.join(os.getcwd(), "patient_files", f"patient_{patient_id}")
+        os.makedirs(patient_dir, exist_ok=True)
+
+        timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
+        file_path = os.path.join(patient_dir, f"{timestamp}_{file_name}")
+        counter = 1
+        while os.path.exists(file_path):
+            file_path = os.path.join(patient_dir, f"{timestamp}_{counter}_{file_name}")
+            counter += 1
+
+        try:
+            with open(file_path, "wb") as f:
+                while True:
+                    chunk = reader.read(COPY_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+            cursor = conn.execute(
+                "INSERT INTO patient_files (patient_id, file_name, file_path, upload_ts, file_type, description) VALUES (?, ?, ?, ?, ?, ?)",
+                (patient_id, file_name, file_path, upload_ts or database.now_ts(), _file_type(file_name), description)
+            )
+        except Exception:
+            if os.path.exists(file_path):
+                os.remove(file_path)
+            raise
+        return cursor.lastrowid, file_path
+
+    def delete(self, conn, file_id):
+        """Delete the row (the caller commits) and return the path to remove once committed"""
+        row = conn.execute("SELECT file_path FROM patient_files WHERE id = ?", (file_id,)).fetchone()
+        conn.execute("DELETE FROM patient_files WHERE id = ?", (file_id,))
+        return row[0] if row else None
+
+class BlobBackend:
+    """Files stored inline in the patient_files_blob table"""
+
+    name = "blob"
+    table = "patient_files_blob"
+
+    def list_files(self, conn, after_id, limit):
+        """Return up to `limit` files with id > after_id as (id, patient_id, file_name, file_type, upload_ts, description, size)"""
+        return conn.execute(
+            "SELECT id, patient_id, file_name, file_type, upload_ts, description, length(file_content) FROM patient_files_blob WHERE id > ? ORDER BY id LIMIT ?",
+            (after_id, limit)
+        ).fetchall()
+
+    def open_reader(self, conn, file_id):
+        return open_blob_reader(conn, "patient_files_blob", "file_content", file_id)
+
+    def write(self, conn, patient_id, file_name, reader, size, description=None, upload_ts=None):
+        """Insert the row and stream the content into it (the caller commits). Returns (file_id, None)"""
+        if not hasattr(conn, "blobopen"):
+            # No incremental BLOB I/O before Python 3.11: bind the content in one piece
+            # (BLOB files are small, see SizePolicy)
+            content = b"".join(iter(lambda: reader.read(COPY_CHUNK_SIZE), b""))
+            cursor = conn.execute(
+                "INSERT INTO patient_files_blob (patient_id, file_name, file_type, file_content, upload_ts, description, file_size) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (patient_id, file_name, _file_type(file_name), content, upload_ts or database.now_ts(), description, len(content))
+            )
+            return cursor.lastrowid, None
+        cursor = conn.execute(
+            "INSERT INTO patient_files_blob (patient_id, file_name, file_type, file_content, upload_ts, description, file_size) VALUES (?, ?, ?, zeroblob(?), ?, ?, ?)",
+            (patient_id, file_name, _file_type(file_name), size, upload_ts or database.now_ts(), description, size)
+        )
+        file_id = cursor.lastrowid
+        if size:
+            with conn.blobopen("patient_files_blob", "file_content", file_id) as blob:
+                while True:
+                    chunk = reader.read(COPY_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    blob.write(chunk)
+        return file_id, None
+
+    def delete(self, conn, file_id):
+        conn.execute("DELETE FROM patient_files_blob WHERE id = ?", (file_id,))
+        return None
+
+FILESYSTEM = FilesystemBackend()
+BLOB = BlobBackend()
+
+class SizePolicy:
+    """Pick a backend by file size: small files in SQLite BLOBs, large files on disk"""
+
+    def __init__(self, blob_max_bytes=DEFAULT_BLOB_MAX_BYTES):
+        self.blob_max_bytes = blob_max_bytes
+
+    def backend_for(self, size):
+        return BLOB if size <= self.blob_max_bytes else FILESYSTEM
+
+    def belongs_in(self, backend, size):
+        return self.backend_for(size) is backend
+
+DEFAULT_POLICY = SizePolicy()
+
+class _MemoryReader:
+    """Minimal read(n) interface over an in-memory buffer"""
+
+    def __init__(self, data):
+        self._view = memoryview(data)
+        self._pos = 0
+
+    def read(self, size=-1):
+        if size < 0:
+            size = len(self._view) - self._pos
+        chunk = self._view[self._pos:self._pos + size]
+        self._pos += len(chunk)
+        return bytes(chunk)
+
+    def close(self):
+        pass
+
+def write_upload(conn, backend, patient_id, uploaded_file, description=None, upload_ts=None):
+    """Write an uploaded file to `backend` (the caller commits). Returns (file_id, written_path)"""
+    data = uploaded_file.getbuffer()
+    return backend.write(conn, patient_id, uploaded_file.name, _MemoryReader(data), len(data), description, upload_ts)
+
+def save_file(patient_id, uploaded_file, description=None, policy=None):
+    """Save an uploaded file to the backend chosen by the size policy"""
+    policy = policy or DEFAULT_POLICY
+    conn = database.connect()
+    file_path = None
+    try:
+        backend = policy.backend_for(len(uploaded_file.getbuffer()))
+        file_id, file_path = write_upload(conn, backend, patient_id, uploaded_file, description)
+        conn.commit()
+        return {"success": True, "file_id": file_id, "backend": backend.name, "file_path": file_path}
+    except Exception as e:
+        conn.rollback()
+        if file_path and os.path.exists(file_path):
+            os.remove(file_path)
+        print(f"Exception in save_file: {str(e)}")
+        print(traceback.format_exc())
+        return {"success": False, "error": str(e)}
+    finally:
+        conn.close()
+
+def _ensure_migration_table(conn):
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS storage_migrations (
+        name TEXT PRIMARY KEY,
+        last_source_id INTEGER NOT NULL DEFAULT 0,
+        files_moved INTEGER NOT NULL DEFAULT 0,
+        bytes_moved INTEGER NOT NULL DEFAULT 0,
+        updated_at TEXT
+    )
+    ''')
+    conn.commit()
+
+def _save_checkpoint(conn, migration_name, last_id, files, size):
+    conn.execute(
+        '''INSERT INTO storage_migrations (name, last_source_id, files_moved, bytes_moved, updated_at)
+           VALUES (?, ?, ?, ?, ?)
+           ON CONFLICT(name) DO UPDATE SET last_source_id = excluded.last_source_id,
+               files_moved = files_moved + excluded.files_moved,
+               bytes_moved = bytes_moved + excluded.bytes_moved,
+               updated_at = excluded.updated_at''',
+        (migration_name, last_id, files, size, datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+    )
+
+def migrate_files(source, target, policy=None, batch_size=50, max_bytes_per_sec=None,
+                  max_files=None, restart=False, progress_callback=None):
+    """
+    Move files from `source` to `target` backend, listing them in batches of batch_size.
+
+    Only files the policy assigns to `target` are moved (all files if policy is None).
+    Each file is copied to the target and then, in one short transaction, the target row is
+    inserted, the source row deleted and the checkpoint in storage_migrations advanced, so
+    readers always see every file in one of the two backends and an interrupted run resumes
+    where it stopped. max_bytes_per_sec throttles the copy; the pauses happen between
+    transactions, so other writers are never kept waiting on the database lock.
+
+    A moved file gets a new id in the target table (patient_files and patient_files_blob
+    have their own ids); links to the old id stop working once the move is committed.
+    """
+    if database.read_only_mode():
+        return {"success": False, "error": "The app is running on a read-only snapshot", "files_moved": 0, "bytes_moved": 0, "errors": []}
+    migration_name = f"{source.name}->{target.name}"
+    if policy is not None:
+        # A different threshold selects different files, so it gets its own checkpoint
+        migration_name += f"@{policy.blob_max_bytes}"
+    conn = database.connect()
+    started = time.perf_counter()
+    files_moved = 0
+    bytes_moved = 0
+    files_skipped = 0
+    errors = []
+
+    try:
+        _ensure_migration_table(conn)
+        if restart:
+            conn.execute("DELETE FROM storage_migrations WHERE name = ?", (migration_name,))
+            conn.commit()
+        row = conn.execute("SELECT last_source_id FROM storage_migrations WHERE name = ?", (migration_name,)).fetchone()
+        last_id = row[0] if row else 0
+
+        while max_files is None or files_moved < max_files:
+            candidates = source.list_files(conn, last_id, batch_size)
+            if not candidates:
+                break
+
+            for file_id, patient_id, file_name, file_type, upload_ts, description, size in candidates:
+                if max_files is not None and files_moved >= max_files:
+                    break
+                last_id = file_id
+                if size is None:
+                    errors.append({"file_id": file_id, "error": "source file missing"})
+                    continue
+                if policy is not None and not policy.belongs_in(target, size):
+                    files_skipped += 1
+                    continue
+
+                written_path = None
+                try:
+                    reader = source.open_reader(conn, file_id)
+                    try:
+                        _, written_path = target.write(conn, patient_id, file_name, reader, size, description, upload_ts)
+                    finally:
+                        reader.close()
+                    removed_path = source.delete(conn, file_id)
+                    _save_checkpoint(conn, migration_name, last_id, 1, size)
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    if written_path and os.path.exists(written_path):
+                        os.remove(written_path)
+                    raise
+
+                # The source file on disk is removed only once the move is committed
+                if removed_path:
+                    try:
+                        os.remove(removed_path)
+                    except OSError as e:
+                        errors.append({"file_path": removed_path, "error": str(e)})
+
+                files_moved += 1
+                bytes_moved += size
+
+                # Throttle against the overall target rate, outside any transaction
+                if max_bytes_per_sec:
+                    expected = bytes_moved / max_bytes_per_sec
+                    elapsed = time.perf_counter() - started
+                    if expected > elapsed:
+                        time.sleep(expected - elapsed)
+
+            # Remember skipped and missing files too, so a resumed run does not list them again
+            _save_checkpoint(conn, migration_name, last_id, 0, 0)
+            conn.commit()
+            if progress_callback:
+                progress_callback(files_moved, bytes_moved)
+
+        elapsed = time.perf_counter() - started
+        return {
+            "success": True,
+            "migration": migration_name,
+            "files_moved": files_moved,
+            "files_skipped": files_skipped,
+            "bytes_moved": bytes_moved,
+            "seconds": round(elapsed, 3),
+            "bytes_per_sec": round(bytes_moved / elapsed, 1) if elapsed > 0 else 0.0,
+            "last_source_id": last_id,
+            "errors": errors,
+        }
+    except Exception as e:
+        print(f"Exception in migrate_files: {str(e)}")
+        print(traceback.format_exc())
+        return {"success": False, "error": str(e), "files_moved": files_moved, "bytes_moved": bytes_moved, "errors": errors}
+    finally:
+        conn.close()
+
+def apply_policy(policy=None, **kwargs):
+    """Move files in both directions so every file sits in the backend the policy assigns it"""
+    policy = policy or DEFAULT_POLICY
+    return [
+        migrate_files(FILESYSTEM, BLOB, policy=policy, **kwargs),
+        migrate_files(BLOB, FILESYSTEM, policy=policy, **kwargs),
+    ]
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Move patient files between disk and BLOB storage")
+    parser.add_argument("--blob-max-bytes", type=int, default=DEFAULT_BLOB_MAX_BYTES, help="files up to this size go to BLOBs")
+    parser.add_argument("--batch-size", type=int, default=50)
+    parser.add_argument("--max-mb-per-sec", type=float, default=None, help="throttle the copy rate")
+    parser.add_argument("--restart", action="store_true", help="ignore saved progress and rescan from the start")
+    args = parser.parse_args()
+
+    import sharding
+    rate = int(args.max_mb_per_sec * 1024 * 1024) if args.max_mb_per_sec else None
+    for db_file in sharding.shard_paths() if sharding.sharding_enabled() else [database.DB_FILE]:
+        with database.use_database(db_file):
+            for report in apply_policy(SizePolicy(args.blob_max_bytes), batch_size=args.batch_size,
+                                       max_bytes_per_sec=rate, restart=args.restart):
+                print(db_file, report)
@@ -0,0 +1,344 @@
+"""
+Population-wide screening of vitals in medical_records for out-of-range values.
+
+Run from the project root:
+    python vitals_screening.py [--full] [--chunk-size 200000]
+
+Records are streamed from the database in chunks into NumPy arrays, in id order. Every value
+is checked against fixed clinical limits, and against the patient's own baseline (mean and
+standard deviation of their earlier values) as a z-score. Each patient's baseline is kept as
+running count, sum and sum of squares per vital in vitals_baselines, so the default
+incremental run only reads records added since the previous one. Each record is scored
+against the stored baseline plus the patient's earlier records in the same chunk (per-patient
+cumulative sums), and the chunk is then folded in. --full rebuilds baselines and alerts the
+same way from the first record, so a full run and a series of incremental runs flag the same
+records.
+
+Flagged values go to the vitals_alerts table; get_flagged_patients() summarizes them per
+patient. Records removed later (archived or deleted) stay counted in the baselines.
+"""
+import json
+import time
+import traceback
+
+import database
+
+# (name, SQL expression over medical_records, low limit, high limit, smallest standard deviation used)
+# The deviation floor keeps patients with very stable values from being flagged for tiny changes.
+# Blood pressure is stored as "120/80" text; CAST reads the leading number, and unparsable text
+# (0 after CAST) counts as missing.
+VITALS = [
+    ("glucose", "glucose_level", 54.0, 300.0, 10.0),
+    ("temperature", "temperature", 35.0, 39.5, 0.3),
+    ("systolic", "NULLIF(CAST(blood_pressure AS REAL), 0)", 90.0, 180.0, 8.0),
+    ("diastolic", "CASE WHEN instr(blood_pressure, '/') > 0 THEN NULLIF(CAST(substr(blood_pressure, instr(blood_pressure, '/') + 1) AS REAL), 0) END",
+     50.0, 120.0, 6.0),
+]
+
+Z_SCORE_LIMIT = 3.0
+# Baselines with fewer values than this are not used for z-scores
+MIN_BASELINE_VALUES = 5
+DEFAULT_CHUNK_SIZE = 200000
+
+def _np():
+    import numpy
+    return numpy
+
+def _ensure_tables(conn):
+    """Create the screening tables if needed; False on a read-only snapshot taken before any screening"""
+    if database.read_only_mode():
+        return database.table_exists(conn, "vitals_alerts")
+    stat_columns = ", ".join(
+        f"{name}_n INTEGER NOT NULL DEFAULT 0, {name}_sum REAL NOT NULL DEFAULT 0, {name}_sumsq REAL NOT NULL DEFAULT 0"
+        for name, _, _, _, _ in VITALS
+    )
+    conn.execute(f"CREATE TABLE IF NOT EXISTS vitals_baselines (patient_id INTEGER PRIMARY KEY, {stat_columns})")
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS vitals_alerts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        patient_id INTEGER NOT NULL,
+        record_id INTEGER NOT NULL,
+        vital TEXT NOT NULL,
+        value REAL,
+        reason TEXT NOT NULL,
+        z_score REAL,
+        baseline_mean REAL,
+        record_ts INTEGER,
+        created_ts INTEGER NOT NULL,
+        UNIQUE (record_id, vital, reason)
+    )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_vitals_alerts_patient ON vitals_alerts (patient_id, record_ts)")
+    conn.execute("CREATE TABLE IF NOT EXISTS vitals_screening_state (key TEXT PRIMARY KEY, value INTEGER)")
+    conn.commit()
+    return True
+
+class _Baselines:
+    """Per-patient running count/sum/sum of squares for every vital, indexed like patient_ids"""
+
+    def __init__(self, np, patient_ids):
+        self.np = np
+        self.patient_ids = patient_ids
+        shape = (len(patient_ids), len(VITALS))
+        self.n = np.zeros(shape)
+        self.sum = np.zeros(shape)
+        self.sumsq = np.zeros(shape)
+        self.touched = np.zeros(len(patient_ids), dtype=bool)
+
+    def load(self, conn):
+        np = self.np
+        rows = conn.execute("SELECT * FROM vitals_baselines ORDER BY patient_id").fetchall()
+        if not rows:
+            return
+        data = np.array(rows, dtype=np.float64)
+        index, found = self.index_of(data[:, 0].astype(np.int64))
+        index = index[found]
+        data = data[found]
+        self.n[index] = data[:, 1::3]
+        self.sum[index] = data[:, 2::3]
+        self.sumsq[index] = data[:, 3::3]
+
+    def index_of(self, record_patient_ids):
+        """Positions of patient ids in patient_ids, and a mask of the ids that exist"""
+        np = self.np
+        index = np.searchsorted(self.patient_ids, record_patient_ids)
+        index = np.minimum(index, max(len(self.patient_ids) - 1, 0))
+        found = (self.patient_ids[index] == record_patient_ids) if len(self.patient_ids) else np.zeros(len(record_patient_ids), dtype=bool)
+        return index, found
+
+    def add(self, index, values):
+        """Fold a chunk of values (rows x vitals, NaN for missing) into the baselines"""
+        np = self.np
+        size = len(self.patient_ids)
+        for column in range(len(VITALS)):
+            column_values = values[:, column]
+            present = ~np.isnan(column_values)
+            column_index = index[present]
+            column_values = column_values[present].astype(np.float64)
+            self.n[:, column] += np.bincount(column_index, minlength=size)
+            self.sum[:, column] += np.bincount(column_index, weights=column_values, minlength=size)
+            self.sumsq[:, column] += np.bincount(column_index, weights=column_values * column_values, minlength=size)
+        self.touched[index] = True
+
+    def prior_stats(self, index, values):
+        """
+        Count, sum and sum of squares of the values each record's patient had before it
+        (rows x vitals): the stored baseline plus the patient's earlier records in this
+        chunk, which must be in id order
+        """
+        np = self.np
+        # Group the chunk by patient; the stable sort keeps id order within a patient
+        order = np.argsort(index, kind="stable")
+        sorted_index = index[order]
+        group_start = np.ones(len(order), dtype=bool)
+        group_start[1:] = sorted_index[1:] != sorted_index[:-1]
+        first = np.maximum.accumulate(np.where(group_start, np.arange(len(order)), 0))
+
+        sorted_values = values[order].astype(np.float64)
+        present = ~np.isnan(sorted_values)
+        sorted_values = np.where(present, sorted_values, 0.0)
+        stats = []
+        for terms, stored in ((present.astype(np.float64), self.n), (sorted_values, self.sum),
+                              (sorted_values * sorted_values, self.sumsq)):
+            # Running total before each row, restarted at each patient's first row
+            before = np.cumsum(terms, axis=0) - terms
+            before -= before[first]
+            unsorted = np.empty_like(before)
+            unsorted[order] = before
+            stats.append(unsorted + stored[index])
+        return stats
+
+    def save(self, conn):
+        np = self.np
+        rows_index = np.nonzero(self.touched)[0]
+        columns = ", ".join(f"{name}_n, {name}_sum, {name}_sumsq" for name, _, _, _, _ in VITALS)
+        stats = np.empty((len(rows_index), 3 * len(VITALS)))
+        stats[:, 0::3] = self.n[rows_index]
+        stats[:, 1::3] = self.sum[rows_index]
+        stats[:, 2::3] = self.sumsq[rows_index]
+        conn.executemany(
+            f"INSERT OR REPLACE INTO vitals_baselines (patient_id, {columns}) VALUES ({', '.join('?' * (1 + 3 * len(VITALS)))})",
+            (
+                (int(patient_id),) + tuple(float(value) for value in row)
+                for patient_id, row in zip(self.patient_ids[rows_index], stats)
+            )
+        )
+
+def _read_chunks(conn, np, after_id, chunk_size):
+    """Yield (record ids, patient ids, values) arrays for records with id > after_id"""
+    expressions = ", ".join(expression for _, expression, _, _, _ in VITALS)
+    cursor = conn.execute(
+        f"SELECT id, patient_id, {expressions} FROM medical_records WHERE id > ? ORDER BY id",
+        (after_id,)
+    )
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+        data = np.array(rows, dtype=np.float64)
+        # float32 is plenty for vitals and halves the memory of a full pass
+        yield data[:, 0].astype(np.int64), data[:, 1].astype(np.int64), data[:, 2:].astype(np.float32)
+
+def _mean_and_std(np, n, total, total_sq):
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = total / n
+        variance = np.maximum(total_sq / n - mean * mean, 0.0)
+    floors = np.array([floor for _, _, _, _, floor in VITALS])
+    return mean, np.maximum(np.sqrt(variance), floors)
+
+def _score_chunk(np, baselines, record_ids, index, values):
+    """Return alert tuples for one chunk: fixed limits plus z-scores against each record's prior values"""
+    lows = np.array([low for _, _, low, _, _ in VITALS])
+    highs = np.array([high for _, _, _, high, _ in VITALS])
+    n, total, total_sq = baselines.prior_stats(index, values)
+    patient_mean, std = _mean_and_std(np, n, total, total_sq)
+    with np.errstate(invalid="ignore"):
+        out_of_range = (values < lows) | (values > highs)
+        z_scores = (values - patient_mean) / std
+        unusual = (np.abs(z_scores) >= Z_SCORE_LIMIT) & (n >= MIN_BASELINE_VALUES)
+
+    alerts = []
+    for reason, mask in (("threshold", out_of_range), ("zscore", unusual)):
+        rows, columns = np.nonzero(mask)
+        for row, column in zip(rows.tolist(), columns.tolist()):
+            z_score = z_scores[row, column]
+            baseline_mean = patient_mean[row, column]
+            alerts.append((
+                int(baselines.patient_ids[index[row]]), int(record_ids[row]), VITALS[column][0],
+                round(float(values[row, column]), 2), reason,
+                None if np.isnan(z_score) else round(float(z_score), 2),
+                None if np.isnan(baseline_mean) else round(float(baseline_mean), 2)
+            ))
+    return alerts
+
+def _record_times(conn, record_ids):
+    record_ts = {}
+    record_ids = sorted(set(record_ids))
+    for start in range(0, len(record_ids), 500):
+        batch = record_ids[start:start + 500]
+        record_ts.update(conn.execute(
+            f"SELECT id, record_ts FROM medical_records WHERE id IN ({','.join('?' * len(batch))})", batch
+        ).fetchall())
+    return record_ts
+
+def run_screening(full=False, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Screen medical records and write alerts. Incremental by default: only records with an id
+    above the last screened one are read. Returns a result dict with counts and timings.
+    """
+    started = time.perf_counter()
+    try:
+        np = _np()
+        conn = database.connect()
+        try:
+            _ensure_tables(conn)
+            patient_ids = np.array([row[0] for row in conn.execute("SELECT id FROM patients ORDER BY id")], dtype=np.int64)
+            baselines = _Baselines(np, patient_ids)
+            if full:
+                last_id = 0
+            else:
+                baselines.load(conn)
+                row = conn.execute("SELECT value FROM vitals_screening_state WHERE key = 'last_record_id'").fetchone()
+                last_id = row[0] if row else 0
+
+            alerts = []
+            records = 0
+            max_id = last_id
+            reader = database.connect_readonly()
+            try:
+                # Each chunk is scored against the values before each record, then folded in
+                for record_ids, record_patient_ids, values in _read_chunks(reader, np, last_id, chunk_size):
+                    index, found = baselines.index_of(record_patient_ids)
+                    alerts.extend(_score_chunk(np, baselines, record_ids[found], index[found], values[found]))
+                    baselines.add(index[found], values[found])
+                    records += len(record_ids)
+                    max_id = int(record_ids[-1])
+                record_ts = _record_times(reader, [alert[1] for alert in alerts])
+            finally:
+                reader.close()
+
+            # Alerts, baselines and the new position are written in one transaction
+            if full:
+                conn.execute("DELETE FROM vitals_alerts")
+                conn.execute("DELETE FROM vitals_baselines")
+            created_ts = database.now_ts()
+            conn.executemany(
+                "INSERT OR IGNORE INTO vitals_alerts (patient_id, record_id, vital, value, reason, z_score, baseline_mean, record_ts, created_ts) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (alert + (record_ts.get(alert[1]), created_ts) for alert in alerts)
+            )
+            baselines.save(conn)
+            conn.execute(
+                "INSERT INTO vitals_screening_state (key, value) VALUES ('last_record_id', ?) "
+                "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                (max_id,)
+            )
+            conn.commit()
+        finally:
+            conn.close()
+
+        elapsed = time.perf_counter() - started
+        return {
+            "success": True,
+            "mode": "full" if full else "incremental",
+            "records_screened": records,
+            "alerts": len(alerts),
+            "patients_flagged": len({alert[0] for alert in alerts}),
+            "last_record_id": max_id,
+            "seconds": round(elapsed, 3),
+            "records_per_sec": round(records / elapsed) if elapsed > 0 else 0,
+        }
+    except Exception as e:
+        print(f"Error screening vitals: {str(e)}")
+        print(traceback.format_exc())
+        return {"success": False, "error": str(e)}
+
+def get_flagged_patients(limit=100):
+    """Patients with alerts, most alerts first: id, name, alert count, worst |z|, last flagged record time"""
+    conn = database.connect()
+    try:
+        if not _ensure_tables(conn):
+            return []
+        rows = conn.execute('''
+            SELECT a.patient_id, p.national_id, p.name, COUNT(*) AS alerts,
+                   SUM(a.reason = 'threshold') AS threshold_alerts,
+                   MAX(ABS(a.z_score)) AS worst_z, datetime(MAX(a.record_ts), 'unixepoch') AS last_flagged
+            FROM vitals_alerts a
+            LEFT JOIN patients p ON p.id = a.patient_id
+            GROUP BY a.patient_id
+            ORDER BY alerts DESC, last_flagged DESC
+            LIMIT ?
+        ''', (limit,)).fetchall()
+        columns = ["patient_id", "national_id", "name", "alerts", "threshold_alerts", "worst_z", "last_flagged"]
+        return [dict(zip(columns, row)) for row in rows]
+    finally:
+        conn.close()
+
+def get_patient_alerts(patient_id):
+    """Alerts of one patient, newest record first"""
+    conn = database.connect()
+    try:
+        if not _ensure_tables(conn):
+            return []
+        rows = conn.execute(
+            "SELECT record_id, vital, value, reason, z_score, baseline_mean, datetime(record_ts, 'unixepoch') "
+            "FROM vitals_alerts WHERE patient_id = ? ORDER BY record_ts DESC, record_id DESC",
+            (patient_id,)
+        ).fetchall()
+        columns = ["record_id", "vital", "value", "reason", "z_score", "baseline_mean", "record_date"]
+        return [dict(zip(columns, row)) for row in rows]
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Screen medical records for out-of-range vitals")
+    parser.add_argument("--full", action="store_true", help="rebuild baselines and alerts from all records")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE, help="records read per chunk")
+    args = parser.parse_args()
+
+    import sharding
+    for db_file in sharding.shard_paths() if sharding.sharding_enabled() else [database.DB_FILE]:
+        with database.use_database(db_file):
+            print(db_file, json.dumps(run_screening(args.full, args.chunk_size), indent=2))